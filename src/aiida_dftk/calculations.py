@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 """`CalcJob` implementation for DFTK."""
+import copy
 import io
 import os
 import json
+import shlex
 import typing as ty
 
+import numpy as np
 from aiida import orm
 from aiida.common import datastructures, exceptions
 from aiida.engine import CalcJob, ExitCode
 from aiida_pseudo.data.pseudo import UpfData
 from pymatgen.core import units
 
+from aiida_dftk.nodes import DftkCalculationNode
+from aiida_dftk.utils import memory, pseudo_cache, resources, sysimage
+
 
 _AIIDA_DFTK_VERSION_SPEC = "0.2.0"
 
@@ -18,13 +24,30 @@ _AIIDA_DFTK_VERSION_SPEC = "0.2.0"
 class DftkCalculation(CalcJob):
     """`CalcJob` implementation for DFTK."""
 
+    # Node class whose hash leaves out the runtime options and parameters, see `aiida_dftk.nodes`
+    _node_class = DftkCalculationNode
+
     INPUT_FILENAME = 'run_dftk.json'
     LOGFILE = 'run_dftk.log'
     SCFRES_SUMMARY_NAME = 'self_consistent_field.json'
+    TIMINGS_FILENAME = 'timings.json'
+    MONITOR_STOPFILE = 'scf_monitor_stop.json'
+    # Written by the job script if the SCF checkpoint was written during the job, with its modification time
+    CHECKPOINT_STATFILE = 'aiida_dftk_checkpoint.txt'
+    BUNDLE_ARCHIVE = 'aiida_dftk_outputs.tar.gz'
+    BUNDLE_MANIFEST = 'aiida_dftk_outputs.txt'
     # TODO: don't limit postscf
     _SUPPORTED_POSTSCF = ['compute_forces_cart', 'compute_stresses_cart', 'compute_bands']
     _PSEUDO_SUBFOLDER = './pseudo/'
     _MIN_OUTPUT_BUFFER_TIME = 60
+    # How the output files can be retrieved, see the `retrieve_policy` option
+    _RETRIEVE_POLICIES = ('permanent', 'temporary', 'compressed')
+    # What to do when the estimated memory exceeds the memory of the machines, see the `memory_check` option
+    _MEMORY_CHECKS = ('error', 'warning', 'none')
+    # Default maximal number of elements of a list kept in the `output_parameters` Dict
+    _MAX_PARAMETERS_LIST_SIZE = 32
+    # Maximal number of atoms and k-points of an input file written with indentation
+    _MAX_INDENTED_INPUT_SIZE = 100
 
     @staticmethod
     def _merge_dicts(dict1, dict2):
@@ -46,6 +69,8 @@ class DftkCalculation(CalcJob):
         spec.input('kpoints', valid_type=orm.KpointsData, help='kpoint mesh or kpoint path')
         spec.input('parameters', valid_type=orm.Dict, help='input parameters')
         spec.input('parent_folder', valid_type=orm.RemoteData, required=False, help='A remote folder used for restarts.')
+        spec.input('bands_kpoints', valid_type=orm.KpointsData, required=False,
+            help='Explicit k-point path of `compute_bands`, used as its `kpath` instead of listing it in the parameters.')
 
         options = spec.inputs['metadata']['options']
 
@@ -56,6 +81,27 @@ class DftkCalculation(CalcJob):
         # TODO: Why is this here?
         options['resources'].default = {'num_machines': 1, 'num_mpiprocs_per_machine': 1}
         options['withmpi'].default = True
+        spec.input('metadata.options.use_sysimage', valid_type=bool, default=True,
+            help='Whether to start Julia with the sysimage registered for the code by `SysimageCalculation`, if any.')
+        spec.input('metadata.options.use_pseudo_cache', valid_type=bool, default=True,
+            help='Whether to use the remote pseudopotential cache of the computer, if enabled with '
+                 '`aiida_dftk.utils.set_pseudo_cache_directory`.')
+        spec.input('metadata.options.copy_parent_checkpoint', valid_type=bool, default=False,
+            help='Copy the checkpoint of the `parent_folder` instead of symlinking it, such that several calculations '
+                 'can restart concurrently from the same checkpoint without writing to the same file.')
+        spec.input('metadata.options.bundle_outputs', valid_type=bool, default=False,
+            help='Pack the output files in a single compressed archive on the remote side, and retrieve only the '
+                 'archive. This saves transfers when the transport has a high latency.')
+        spec.input('metadata.options.retrieve_policy', valid_type=dict, required=False,
+            help='How to retrieve each output file, e.g. `{"run_dftk.log": "compressed"}`. The policy is `permanent` '
+                 '(stored in the `retrieved` folder, the default), `temporary` (only retrieved for parsing) or '
+                 '`compressed` (stored compressed in the `retrieved` folder).')
+        spec.input('metadata.options.max_parameters_list_size', valid_type=int, default=cls._MAX_PARAMETERS_LIST_SIZE,
+            help='Lists of the SCF summary with more elements than this are stored in the `output_arrays` ArrayData '
+                 'instead of the `output_parameters` Dict, which keeps a reference to the array.')
+        spec.input('metadata.options.memory_check', valid_type=str, default='warning',
+            help='Whether to refuse the submission (`error`), report a warning (`warning`) or do nothing (`none`) '
+                 'when the estimated memory exceeds `max_memory_kb` or the default memory per machine of the computer.')
 
         # Exit codes
         # TODO: Codes 1xx are already used in the super class!
@@ -63,12 +109,17 @@ class DftkCalculation(CalcJob):
         spec.exit_code(102, 'ERROR_MISSING_FORCES_FILE', message='The output file containing forces is missing.')
         spec.exit_code(103, 'ERROR_MISSING_STRESSES_FILE', message='The output file containing stresses is missing.')
         spec.exit_code(104, 'ERROR_MISSING_BANDS_FILE',message='The output file containing bands is missing.')
-        spec.exit_code(500, 'ERROR_SCF_CONVERGENCE_NOT_REACHED', message='The SCF minimization cycle did not converge, and the POSTSCF functions were not executed.')
-        spec.exit_code(501, 'ERROR_SCF_OUT_OF_WALLTIME',message='The SCF was interuptted due to out of walltime. Non-recovarable error.')
-        spec.exit_code(502, 'ERROR_POSTSCF_OUT_OF_WALLTIME',message='The POSTSCF was interuptted due to out of walltime.')
+        spec.exit_code(500, 'ERROR_SCF_CONVERGENCE_NOT_REACHED', message='The SCF minimization cycle did not converge, and the POSTSCF functions were not executed.', invalidates_cache=True)
+        spec.exit_code(501, 'ERROR_SCF_OUT_OF_WALLTIME',message='The SCF was interuptted due to out of walltime. Non-recovarable error.', invalidates_cache=True)
+        spec.exit_code(502, 'ERROR_POSTSCF_OUT_OF_WALLTIME',message='The POSTSCF was interuptted due to out of walltime.', invalidates_cache=True)
         spec.exit_code(503, 'ERROR_BANDS_CONVERGENCE_NOT_REACHED', message='The BANDS minimization cycle did not converge.')
+        spec.exit_code(504, 'ERROR_SCF_STOPPED_BY_MONITOR', message='The SCF was stopped by the monitor because it was {reason}.', invalidates_cache=True)
+        spec.exit_code(505, 'ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED', message='The SCF was interrupted due to out of walltime after writing a checkpoint. Can be restarted from the checkpoint.', invalidates_cache=True)
         # Significant errors but calculation can be used to restart
-        spec.exit_code(400, 'ERROR_PACKAGE_IMPORT_FAILED', message="Failed to import AiiDA DFTK or write first log message. Typically indicates an environment issue.")
+        spec.exit_code(400, 'ERROR_PACKAGE_IMPORT_FAILED', message="Failed to import AiiDA DFTK or write first log message. Typically indicates an environment issue.", invalidates_cache=True)
+        spec.exit_code(401, 'ERROR_PSEUDO_CACHE_MISS', message='Pseudopotentials were missing from the remote pseudo cache: {md5s}. They are uploaded again on restart.', invalidates_cache=True)
+        spec.exit_code(402, 'ERROR_OUT_OF_MEMORY', message='The calculation ran out of memory, the peak memory of an MPI rank was {peak_memory}.', invalidates_cache=True)
+        spec.exit_code(403, 'ERROR_SYSIMAGE_MISSING', message='Julia could not load the sysimage `{sysimage}` registered for the code.', invalidates_cache=True)
 
         # Outputs
         spec.output('output_parameters', valid_type=orm.Dict, help='output parameters')
@@ -81,6 +132,14 @@ class DftkCalculation(CalcJob):
         spec.output('output_forces', valid_type=orm.ArrayData, required=False, help='forces array')
         spec.output('output_stresses', valid_type=orm.ArrayData, required=False, help='stresses array')
         spec.output('output_bands', valid_type=orm.BandsData, required=False, help='bandstructure')
+        spec.output('output_eigenvalues', valid_type=orm.ArrayData, required=False,
+            help='eigenvalues and occupations of the SCF, shaped (spin, k-point, band), with the k-point weights')
+        spec.output('output_arrays', valid_type=orm.ArrayData, required=False,
+            help='large numeric lists of the SCF summary, referenced from `output_parameters`')
+        spec.output('output_scf_trace', valid_type=orm.ArrayData, required=False,
+            help='energy, norm of the density change, diagonalization iterations and wall time of each SCF iteration')
+        spec.output('output_timings', valid_type=orm.Dict, required=False,
+            help='breakdown of the time spent in the DFTK run per phase, parsed from the DFTK timers')
 
         # TODO: bands and DOS implementation required on DFTK side
         # spec.output('output_bands', valid_type=orm.BandsData, required=False,
@@ -94,6 +153,8 @@ class DftkCalculation(CalcJob):
         
         Check that the wihmpi option is set to True if the number of mpiprocs is greater than 1.
         Check max_wallclock_seconds is greater than the min_output_buffer_time.
+        Check that the retrieve policy of each output file is known.
+        Check that the memory check is known.
         """
         options = self.inputs.metadata.options
         if options.withmpi is False and options.resources.get('num_mpiprocs_per_machine', 1) > 1:
@@ -103,6 +164,61 @@ class DftkCalculation(CalcJob):
             raise exceptions.InputValidationError(
                 f'max_wallclock_seconds must be greater than {self._MIN_OUTPUT_BUFFER_TIME}.'
             )
+        for file_name, policy in options.get('retrieve_policy', {}).items():
+            if policy not in self._RETRIEVE_POLICIES:
+                raise exceptions.InputValidationError(
+                    f'Unknown retrieve policy `{policy}` for `{file_name}`, expected one of {self._RETRIEVE_POLICIES}.'
+                )
+        if options.memory_check not in self._MEMORY_CHECKS:
+            raise exceptions.InputValidationError(
+                f'Unknown memory check `{options.memory_check}`, expected one of {self._MEMORY_CHECKS}.'
+            )
+
+    def _check_resource_estimate(self, items: list) -> None:
+        """Estimate the size and the memory of the calculation, and compare it with the memory of the machines.
+
+        The estimate is stored on the node, see `DftkCalculationNode.get_resource_estimate`. Depending on the
+        `memory_check` option, the submission is refused if it exceeds the memory per machine.
+
+        :param items: tuples of the structure, pseudopotentials and parameters dict of the DFTK runs of the job,
+            which run one after the other, such that the largest one determines the peak memory.
+        """
+        options = self.inputs.metadata.options
+        computer = self.inputs.code.computer
+        num_mpiprocs_per_machine = 1
+        if options.withmpi:
+            num_mpiprocs_per_machine = (
+                options.resources.get('num_mpiprocs_per_machine', None)
+                or computer.get_default_mpiprocs_per_machine() or 1
+            )
+        num_mpiprocs = num_mpiprocs_per_machine * options.resources.get('num_machines', 1)
+
+        estimates = [
+            resources.estimate_memory(structure, pseudos, parameters, self.inputs.kpoints, num_mpiprocs)
+            for structure, pseudos, parameters in items
+        ]
+        estimates = [estimate for estimate in estimates if estimate is not None]
+        if not estimates:
+            return
+        estimate = max(estimates, key=lambda estimate: estimate['memory_per_mpiproc'])
+
+        # Both the `max_memory_kb` option and the default memory of the computer are in kB
+        available_memory_kb = options.get('max_memory_kb', None) or computer.get_default_memory_per_machine()
+        estimate['memory_per_machine'] = num_mpiprocs_per_machine * estimate['memory_per_mpiproc']
+        estimate['available_memory_per_machine'] = 1024 * available_memory_kb if available_memory_kb else None
+        self.node.set_resource_estimate(estimate)
+
+        if estimate['available_memory_per_machine'] is None or options.memory_check == 'none':
+            return
+        if estimate['memory_per_machine'] > estimate['available_memory_per_machine']:
+            message = (
+                f"the estimated memory of {estimate['memory_per_machine'] / 2**30:.1f} GiB per machine exceeds the "
+                f"available {estimate['available_memory_per_machine'] / 2**30:.1f} GiB: use more machines, fewer "
+                'MPI ranks per machine or a smaller basis.'
+            )
+            if options.memory_check == 'error':
+                raise exceptions.InputValidationError(f'Refusing to submit, {message}')
+            self.report(f'WARNING: {message}')
 
     def _validate_inputs(self):
         """Validate input parameters."""
@@ -111,6 +227,9 @@ class DftkCalculation(CalcJob):
             for postscf in parameters['postscf']:
                 if postscf['$function'] not in self._SUPPORTED_POSTSCF:
                     raise exceptions.InputValidationError(f"Unsupported postscf function: {postscf['$function']}")
+        if 'bands_kpoints' in self.inputs:
+            if not any(postscf['$function'] == 'compute_bands' for postscf in parameters.get('postscf', [])):
+                raise exceptions.InputValidationError('`bands_kpoints` requires `compute_bands` in the postscf.')
 
         # We want the option to be set for `verdi calcjob inputcat` to work,
         # but we don't allow overriding it because it would affect the name of the log file.
@@ -165,13 +284,13 @@ class DftkCalculation(CalcJob):
             'scf': {},
             'postscf': [],
         }
-        data['periodic_system']['bounding_box'] = [[x * units.ang_to_bohr for x in vec] for vec in structure.cell]
-        data['periodic_system']['atoms'] = []
-        for site in structure.sites:
-            data['periodic_system']['atoms'].append({
-                'symbol': site.kind_name,
-                'position': [X * units.ang_to_bohr for X in list(site.position)],
-            })
+        data['periodic_system']['bounding_box'] = (np.array(structure.cell) * units.ang_to_bohr).tolist()
+        # Read the raw sites rather than `structure.sites`, which creates a `Site` object per atom
+        sites = structure.base.attributes.get('sites')
+        positions = (np.array([site['position'] for site in sites], dtype=float) * units.ang_to_bohr).tolist()
+        data['periodic_system']['atoms'] = [
+            {'symbol': site['kind_name'], 'position': position} for site, position in zip(sites, positions)
+        ]
         for symbol, pseudo in pseudos.items():
             data['pseudopotentials'][symbol] = f'{self._PSEUDO_SUBFOLDER}{pseudo.filename}'
             local_copy_pseudo_list.append((pseudo.uuid, pseudo.filename, f'{self._PSEUDO_SUBFOLDER}{pseudo.filename}'))
@@ -185,28 +304,173 @@ class DftkCalculation(CalcJob):
             0.9 * self.inputs.metadata.options.max_wallclock_seconds,
         )
         data['scf']['maxtime'] = maxtime
-        
+
         DftkCalculation._merge_dicts(data, parameters.get_dict())
 
+        # The k-point path is stored as an array in the repository, and only expanded in the input file
+        if 'bands_kpoints' in self.inputs:
+            kpath = self.inputs.bands_kpoints.get_kpoints().tolist()
+            for postscf in data['postscf']:
+                if postscf['$function'] == 'compute_bands':
+                    postscf.setdefault('$kwargs', {})['kpath'] = kpath
+
         return data, local_copy_pseudo_list
 
-    def _generate_retrieve_list(self, parameters: orm.Dict) -> list:
+    def _write_inputfile(self, filename: str, content: dict) -> None:
+        """Write the DFTK input dict as JSON.
+
+        Small inputs are indented for readability, large ones are written compactly to keep the file small.
+        """
+        size = len(content['periodic_system']['atoms']) + sum(
+            len(postscf.get('$kwargs', {}).get('kpath', [])) for postscf in content['postscf']
+        )
+        with io.open(filename, 'w', encoding='utf-8') as stream:
+            if size <= self._MAX_INDENTED_INPUT_SIZE:
+                json.dump(content, stream, indent=4)
+            else:
+                json.dump(content, stream, separators=(',', ':'))
+
+    def _use_pseudo_cache(self, calcinfo: datastructures.CalcInfo) -> None:
+        """Symlink the pseudopotentials from the remote pseudo cache of the computer instead of uploading them.
+
+        Pseudopotentials not yet in the cache are uploaded as usual, and copied to the cache by the job script.
+        """
+        computer = self.inputs.code.computer
+        directory = pseudo_cache.get_pseudo_cache_directory(computer)
+        if directory is None or not self.inputs.metadata.options.use_pseudo_cache:
+            return
+
+        cached = pseudo_cache.get_cached_pseudos(computer)
+        pseudos = {pseudo.uuid: pseudo for pseudo in self.inputs.pseudos.values()}
+        uploaded, symlinked, local_copy_list = {}, {}, []
+        for uuid, filename, target in calcinfo.local_copy_list:
+            if uuid not in pseudos:
+                local_copy_list.append((uuid, filename, target))
+            elif pseudos[uuid].md5 in cached:
+                symlinked[pseudos[uuid].md5] = target
+                calcinfo.remote_symlink_list.append(
+                    (computer.uuid, pseudo_cache.get_pseudo_cache_path(directory, pseudos[uuid].md5), target)
+                )
+            else:
+                uploaded[pseudos[uuid].md5] = target
+                local_copy_list.append((uuid, filename, target))
+
+        calcinfo.local_copy_list = local_copy_list
+        calcinfo.prepend_text = pseudo_cache.get_pseudo_cache_script(directory, uploaded, symlinked)
+        self.node.base.extras.set(pseudo_cache.PSEUDO_CACHE_UPLOADED_EXTRA, sorted(uploaded))
+
+    def _apply_retrieve_policy(self, folder, calcinfo: datastructures.CalcInfo, checkpoints: list) -> None:
+        """Sort the output files of the retrieve list according to the `retrieve_policy` and `bundle_outputs` options.
+
+        Files with the `temporary` policy are only retrieved for parsing, and files with the `compressed` policy are
+        compressed by the job script. If the outputs are bundled, they are packed in a single compressed archive
+        instead, whose files are listed in the `BUNDLE_MANIFEST` input file. The archive is then retrieved temporarily
+        if all its files are temporary.
+
+        The files are compressed and packed as well if the job is terminated by the scheduler, such that calculations
+        running out of walltime can still be parsed. Before that, the `CHECKPOINT_STATFILE` is written next to each SCF
+        checkpoint modified since the start of the job, for the parser to know whether the SCF can be resumed from it.
+
+        :param checkpoints: the `(directory, checkpointfile)` of the SCF checkpoints of the job
+        """
+        options = self.inputs.metadata.options
+        policies = options.get('retrieve_policy', {})
+
+        def get_path(entry):
+            return entry if isinstance(entry, str) else entry[0]
+
+        def get_policy(entry):
+            return policies.get(os.path.basename(get_path(entry)), 'permanent')
+
+        # A checkpoint copied from the parent folder is older than the start of the job
+        commands = [
+            f'if [ -f {path} ] && [ "$(stat -L -c %Y {path})" -ge "$aiida_dftk_job_start" ]; then '
+            f'stat -L -c %Y {path} > {shlex.quote(os.path.join(directory, self.CHECKPOINT_STATFILE))}; fi'
+            for directory, path in (
+                (directory, shlex.quote(os.path.join(directory, checkpointfile))) for directory, checkpointfile in checkpoints
+            )
+        ]
+        retrieve_list, retrieve_temporary_list = [], []
+        if options.bundle_outputs:
+            paths = [get_path(entry) for entry in calcinfo.retrieve_list]
+            with folder.open(self.BUNDLE_MANIFEST, 'w') as handle:
+                handle.write('\n'.join(paths) + '\n')
+            # Output files that were not produced are skipped
+            commands.append(f'tar -czf {self.BUNDLE_ARCHIVE} --ignore-failed-read -T {self.BUNDLE_MANIFEST} 2> /dev/null')
+            if all(get_policy(entry) == 'temporary' for entry in calcinfo.retrieve_list):
+                retrieve_temporary_list.append(self.BUNDLE_ARCHIVE)
+            else:
+                retrieve_list.append(self.BUNDLE_ARCHIVE)
+        else:
+            for entry in calcinfo.retrieve_list:
+                policy = get_policy(entry)
+                if policy == 'temporary':
+                    retrieve_temporary_list.append(entry)
+                elif policy == 'compressed':
+                    path = shlex.quote(get_path(entry))
+                    commands.append(f'if [ -f {path} ]; then gzip -c {path} > {path}.gz; fi')
+                    retrieve_list.append(
+                        f'{entry}.gz' if isinstance(entry, str) else (f'{entry[0]}.gz',) + tuple(entry[1:])
+                    )
+                else:
+                    retrieve_list.append(entry)
+
+        calcinfo.retrieve_list = retrieve_list
+        calcinfo.retrieve_temporary_list = retrieve_temporary_list
+        if commands:
+            finalize = '\n'.join(['aiida_dftk_finalize() {'] + [f'    {command}' for command in commands] + ['}'])
+            trap = "trap 'aiida_dftk_finalize; exit 143' TERM"
+            start = 'aiida_dftk_job_start=$(date +%s)' if checkpoints else None
+            calcinfo.prepend_text = '\n'.join(
+                text for text in (calcinfo.prepend_text, start, finalize, trap) if text
+            )
+            calcinfo.append_text = 'aiida_dftk_finalize'
+
+    def _generate_retrieve_list(self, parameters: dict) -> list:
         """Generate the list of files to retrieve based on the type of calculation requested in the input parameters.
 
-        :param parameters: input parameters
+        :param parameters: the DFTK input dict, as generated by `_generate_inputdata`
         :returns: list of files to retreive
         """
-        parameters = parameters.get_dict()
-        # Retrieve the postscf files, all function.hdf5 except compute_bands.json
-        retrieve_list = [
-            f"{item['$function']}.json" if item['$function'] == 'compute_bands' else f"{item['$function']}.hdf5"
-            for item in parameters['postscf']
-        ]
+        # Retrieve the postscf files, all function.hdf5. The bands are written to compute_bands.json by AiidaDFTK
+        # versions without binary band output, in which case it is parsed instead.
+        retrieve_list = [f"{item['$function']}.hdf5" for item in parameters['postscf']]
+        if 'compute_bands.hdf5' in retrieve_list:
+            retrieve_list.append('compute_bands.json')
         retrieve_list.append(self.LOGFILE)
-        retrieve_list.append('timings.json')
+        retrieve_list.append(self.TIMINGS_FILENAME)
+        # Only exists if the job was stopped by `monitor_scf_convergence`
+        retrieve_list.append(self.MONITOR_STOPFILE)
         retrieve_list.append(f'{self.SCFRES_SUMMARY_NAME}')
+        if 'checkpointfile' in parameters['scf']:
+            retrieve_list.append(self.CHECKPOINT_STATFILE)
         return retrieve_list
 
+    def _get_julia_cmdline_params(self, script: str) -> list:
+        """Return the Julia command line parameters to run the given script after loading AiidaDFTK.
+
+        The time spent loading AiidaDFTK and running the script are printed to stdout,
+        such that the startup latency can be analysed with `aiida_dftk.utils.get_startup_latency`,
+        followed by the peak memory of the process, see `aiida_dftk.utils.parse_peak_memory`.
+        """
+        cmdline_params = [
+            # Precompilation under MPI generally deadlocks. Make sure everything is already precompiled.
+            '--compiled-modules=strict',
+            '-e', (
+                f't0 = time(); using AiidaDFTK; t1 = time(); println("{sysimage.LOAD_TIME_PRINT}$(t1 - t0)"); '
+                f'{script}; println("{sysimage.RUN_TIME_PRINT}$(time() - t1)"); '
+                f'println("{memory.PEAK_MEMORY_PRINT}$(Sys.maxrss())")'
+            ),
+        ]
+
+        if self.inputs.metadata.options.use_sysimage:
+            sysimage_path = sysimage.get_sysimage(self.inputs.code, _AIIDA_DFTK_VERSION_SPEC)
+            if sysimage_path is not None:
+                cmdline_params.insert(0, f'--sysimage={sysimage_path}')
+                self.node.base.extras.set(sysimage.SYSIMAGE_USED_EXTRA, sysimage_path)
+
+        return cmdline_params
+
     def prepare_for_submission(self, folder):
         """Create the input file(s) from the input nodes.
 
@@ -219,6 +483,9 @@ class DftkCalculation(CalcJob):
         self._validate_inputs()
         self._validate_pseudos()
         self._validate_kpoints()
+        self._check_resource_estimate(
+            [(self.inputs.structure, self.inputs.pseudos, self.inputs.parameters.get_dict())]
+        )
 
         # Create lists which specify files to copy and symlink
         remote_copy_list = []
@@ -228,12 +495,12 @@ class DftkCalculation(CalcJob):
         input_filecontent, local_copy_list = self._generate_inputdata(self.inputs.parameters, self.inputs.structure, self.inputs.pseudos, self.inputs.kpoints)
 
         # write input file
-        input_filename = folder.get_abs_path(self.metadata.options.input_filename)
-        with io.open(input_filename, 'w', encoding='utf-8') as stream:
-            json.dump(input_filecontent, stream, indent=4)
+        self._write_inputfile(folder.get_abs_path(self.metadata.options.input_filename), input_filecontent)
 
         # List the files (scfres.jld2) to copy or symlink in the case of a restart
         if 'parent_folder' in self.inputs:
+            if 'checkpointfile' not in self.inputs.parameters.get('scf', {}):
+                raise exceptions.InputValidationError('`parent_folder` requires `scf.checkpointfile` in the parameters.')
             # Symlink if on the same computer, otherwise copy
             same_computer = self.inputs.code.computer.uuid == self.inputs.parent_folder.computer.uuid
             checkpointfile_info = (
@@ -241,23 +508,21 @@ class DftkCalculation(CalcJob):
                 os.path.join(self.inputs.parent_folder.get_remote_path(), self.inputs.parameters['scf']['checkpointfile']),
                 self.inputs.parameters['scf']['checkpointfile']
             )
-            if same_computer:
+            if same_computer and not self.inputs.metadata.options.copy_parent_checkpoint:
                 remote_symlink_list.append(checkpointfile_info)
             else:
                 remote_copy_list.append(checkpointfile_info)
 
         # prepare command line parameters
-        cmdline_params = [
-            # Precompilation under MPI generally deadlocks. Make sure everything is already precompiled.
-            '--compiled-modules=strict',
-            '-e', 'using AiidaDFTK; AiidaDFTK.run(inputfile="{}", allowed_versions="{}")'.format(
+        cmdline_params = self._get_julia_cmdline_params(
+            'AiidaDFTK.run(inputfile="{}", allowed_versions="{}")'.format(
                 self.metadata.options.input_filename,
                 _AIIDA_DFTK_VERSION_SPEC,
-            ),
-        ]
+            )
+        )
 
         # prepare retrieve list
-        retrieve_list = self._generate_retrieve_list(self.inputs.parameters)
+        retrieve_list = self._generate_retrieve_list(input_filecontent)
 
         # Set up the `CodeInfo` to pass to `CalcInfo`
         codeinfo = datastructures.CodeInfo()
@@ -271,9 +536,159 @@ class DftkCalculation(CalcJob):
         calcinfo.remote_symlink_list = remote_symlink_list
         calcinfo.remote_copy_list = remote_copy_list
         calcinfo.local_copy_list = local_copy_list
+        self._use_pseudo_cache(calcinfo)
+        checkpointfile = input_filecontent['scf'].get('checkpointfile', None)
+        self._apply_retrieve_policy(folder, calcinfo, [('.', checkpointfile)] if checkpointfile else [])
 
         return calcinfo
 
+
+class DftkBatchCalculation(DftkCalculation):
+    """`CalcJob` implementation running several independent DFTK calculations in a single Julia process.
+
+    Each item of the `structures` namespace gets its own subfolder with its own input file, and is run in turn by the
+    same Julia session, such that the Julia startup and package loading cost is only paid once.
+    The `parameters`, `kpoints` and `pseudos` are shared by all items;
+    per-item parameters can be merged on top through the `item_parameters` namespace.
+    A failing item does not prevent the other items from running and being parsed.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        super().define(spec)
+        # Inputs
+        spec.inputs.pop('structure')
+        spec.inputs.pop('parent_folder')
+        spec.input_namespace('structures', valid_type=orm.StructureData, dynamic=True,
+            help='The structures to run, the keys are used as item labels.')
+        spec.input_namespace('item_parameters', valid_type=orm.Dict, dynamic=True, required=False,
+            help='Optional input parameters merged on top of `parameters` for the item with the same label.')
+
+        options = spec.inputs['metadata']['options']
+        options['parser_name'].default = 'dftk.batch'
+
+        # Exit codes
+        spec.exit_code(310, 'ERROR_BATCH_ITEMS_FAILED',
+            message='At least one item of the batch failed, the outputs of the successful items were attached.',
+            invalidates_cache=True)
+
+        # Outputs
+        for name in [name for name in spec.outputs if name.startswith('output_')]:
+            port = spec.outputs.pop(name)
+            spec.output_namespace(name, valid_type=port.valid_type, dynamic=True, required=False,
+                help=f'{port.help}, for each item')
+
+    @property
+    def item_labels(self) -> ty.List[str]:
+        """Return the sorted labels of the items of the batch."""
+        return sorted(self.inputs.structures.keys())
+
+    def _get_item_parameters(self, label: str) -> dict:
+        """Return the input parameters of the item with the given label."""
+        parameters = copy.deepcopy(self.inputs.parameters.get_dict())
+        if label in self.inputs.get('item_parameters', {}):
+            DftkCalculation._merge_dicts(parameters, self.inputs.item_parameters[label].get_dict())
+        return parameters
+
+    def _validate_inputs(self):
+        """Validate input parameters, including the per-item parameters."""
+        super()._validate_inputs()
+        unknown = set(self.inputs.get('item_parameters', {}).keys()) - set(self.item_labels)
+        if unknown:
+            raise exceptions.InputValidationError(f'item_parameters given for unknown items: {unknown}')
+        for label in self.item_labels:
+            for postscf in self._get_item_parameters(label).get('postscf', []):
+                if postscf['$function'] not in self._SUPPORTED_POSTSCF:
+                    raise exceptions.InputValidationError(f"Unsupported postscf function: {postscf['$function']}")
+
+    def _validate_pseudos(self):
+        """Validate the pseudopotentials.
+
+        Check that there is a one-to-one map of the kinds of all structures to pseudopotentials.
+        """
+        kinds = set(kind.name for structure in self.inputs.structures.values() for kind in structure.kinds)
+        pseudos = set(self.inputs.pseudos.keys())
+        if kinds != pseudos:
+            raise exceptions.InputValidationError(
+                'Mismatch between the defined pseudos and the list of kinds of the structures.\n'
+                f'Pseudos: {pseudos};\nKinds:{kinds}'
+            )
+
+    def prepare_for_submission(self, folder):
+        """Create the input file(s) from the input nodes.
+
+        :param folder: an `aiida.common.folders.Folder` where the plugin should temporarily place all files needed by
+            the calculation.
+        :return: `aiida.common.datastructures.CalcInfo` instance
+        """
+
+        self._validate_options()
+        self._validate_inputs()
+        self._validate_pseudos()
+        self._validate_kpoints()
+        self._check_resource_estimate([
+            (self.inputs.structures[label], self.inputs.pseudos, self._get_item_parameters(label))
+            for label in self.item_labels
+        ])
+
+        local_copy_list = []
+        retrieve_list = []
+        checkpoints = []
+
+        # The items run one after the other, so split the default SCF time budget evenly between them
+        nitems = len(self.item_labels)
+        for label in self.item_labels:
+            structure = self.inputs.structures[label]
+            structure_pseudos = {kind.name: self.inputs.pseudos[kind.name] for kind in structure.kinds}
+            item_parameters = self._get_item_parameters(label)
+            input_filecontent, pseudo_copy_list = self._generate_inputdata(
+                orm.Dict(item_parameters), structure, structure_pseudos, self.inputs.kpoints
+            )
+            # An explicit `maxtime` is the budget of the item itself
+            if 'maxtime' not in item_parameters.get('scf', {}):
+                input_filecontent['scf']['maxtime'] /= nitems
+            # The pseudopotentials are shared by all items and live in the parent folder
+            for symbol, pseudo in structure_pseudos.items():
+                input_filecontent['pseudopotentials'][symbol] = os.path.normpath(
+                    os.path.join('..', self._PSEUDO_SUBFOLDER, pseudo.filename)
+                )
+            local_copy_list.extend(entry for entry in pseudo_copy_list if entry not in local_copy_list)
+
+            subfolder = folder.get_subfolder(label, create=True)
+            self._write_inputfile(subfolder.get_abs_path(self.INPUT_FILENAME), input_filecontent)
+
+            if 'checkpointfile' in input_filecontent['scf']:
+                checkpoints.append((label, input_filecontent['scf']['checkpointfile']))
+            # Keep the item subfolder in the retrieved folder
+            retrieve_list.extend(
+                (os.path.join(label, filename), '.', 2) for filename in self._generate_retrieve_list(input_filecontent)
+            )
+
+        # Run all items in the same Julia session, catching errors such that one item cannot take down the others
+        items = ', '.join(f'"{label}"' for label in self.item_labels)
+        run = f'AiidaDFTK.run(inputfile="{self.INPUT_FILENAME}", allowed_versions="{_AIIDA_DFTK_VERSION_SPEC}")'
+        cmdline_params = self._get_julia_cmdline_params(
+            f'for dir in [{items}]; try; cd(() -> {run}, dir); '
+            'catch e; @error "Batch item $dir failed" exception=(e, catch_backtrace()); end; end'
+        )
+
+        codeinfo = datastructures.CodeInfo()
+        codeinfo.code_uuid = self.inputs.code.uuid
+        codeinfo.cmdline_params = cmdline_params
+
+        calcinfo = datastructures.CalcInfo()
+        calcinfo.codes_info = [codeinfo]
+        calcinfo.retrieve_list = retrieve_list
+        calcinfo.remote_symlink_list = []
+        calcinfo.remote_copy_list = []
+        calcinfo.local_copy_list = local_copy_list
+        self._use_pseudo_cache(calcinfo)
+        self._apply_retrieve_policy(folder, calcinfo, checkpoints)
+
+        return calcinfo
+
+
 class PrecompileCalculation(CalcJob):
     """Calcjob implementation to precompile AiidaDFTK."""
 
@@ -322,3 +737,108 @@ class PrecompileCalculation(CalcJob):
                 self.report(f'could not parse scheduler output: the `{filename_stdout}` file is missing')
 
         return self.exit_codes.ERROR_UNSPECIFIED
+
+
+class SysimageCalculation(CalcJob):
+    """Calcjob implementation to build a sysimage of AiidaDFTK with PackageCompiler.
+
+    On success, the sysimage is registered on the code for the AiidaDFTK version it contains, if that version is
+    allowed by the plugin, and subsequent `DftkCalculation`s with the same code will start Julia with it.
+    PackageCompiler must be available in the Julia environment of the code.
+    """
+
+    _SUCCESS_PRINT = "Sysimage built successfully"
+    _VERSION_PRINT = "AiidaDFTK version: "
+
+    @staticmethod
+    def _validate_sysimage_path(value, _):
+        """Validate that the sysimage path is absolute, such that it is not inside the working directory."""
+        if value is not None and not os.path.isabs(value.value):
+            return f'The `sysimage_path` must be an absolute path, got `{value.value}`.'
+        return None
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        super().define(spec)
+        spec.input('sysimage_path', valid_type=orm.Str, validator=cls._validate_sysimage_path,
+            help='Absolute path of the sysimage to build on the remote computer. It must be outside of the working '
+                 'directory of the calculation, which may be cleaned after the calculation.')
+
+        options = spec.inputs['metadata']['options']
+        options['resources'].default = {'num_machines': 1, 'num_mpiprocs_per_machine': 1}
+        options['max_wallclock_seconds'].default = 3600
+
+        spec.output('output_parameters', valid_type=orm.Dict, required=False,
+            help='The path of the sysimage and the AiidaDFTK version it contains.')
+
+        spec.exit_code(320, 'ERROR_SYSIMAGE_IN_WORKDIR',
+            message='The sysimage was built in the working directory of the calculation and was not registered.')
+        spec.exit_code(321, 'ERROR_SYSIMAGE_VERSION_NOT_ALLOWED',
+            message='The sysimage contains AiidaDFTK {version}, which is not allowed by the plugin ({version_spec}). '
+                    'It was not registered.')
+
+    def prepare_for_submission(self, folder):
+        sysimage_path = self.inputs.sysimage_path.value
+
+        # Set up the `CodeInfo` to pass to `CalcInfo`
+        codeinfo = datastructures.CodeInfo()
+        codeinfo.code_uuid = self.inputs.code.uuid
+        codeinfo.cmdline_params = [
+            '-e', (
+                f'using PackageCompiler; create_sysimage(["AiidaDFTK"]; sysimage_path="{sysimage_path}"); '
+                f'using AiidaDFTK; println("{self._VERSION_PRINT}", pkgversion(AiidaDFTK)); '
+                f'println("{self._SUCCESS_PRINT}")'
+            )
+        ]
+        codeinfo.withmpi = False
+
+        # Set up the `CalcInfo` so AiiDA knows what to do with everything
+        calcinfo = datastructures.CalcInfo()
+        calcinfo.codes_info = [codeinfo]
+
+        return calcinfo
+
+    # Easier to override the parse method than to write a parser.
+    def parse(self, *args, **kwargs):
+        exit_code = super().parse(*args, **kwargs)
+        if exit_code.status != 0:
+            return exit_code
+
+        retrieved = self.node.outputs.retrieved
+        filename_stdout = self.node.get_option('scheduler_stdout')
+
+        if filename_stdout is None:
+            self.report('could not determine `stdout` filename because `scheduler_stdout` option was not set.')
+            return self.exit_codes.ERROR_UNSPECIFIED
+
+        try:
+            scheduler_stdout = retrieved.base.repository.get_object_content(filename_stdout, mode='r')
+        except FileNotFoundError:
+            self.report(f'could not parse scheduler output: the `{filename_stdout}` file is missing')
+            return self.exit_codes.ERROR_UNSPECIFIED
+
+        if self._SUCCESS_PRINT not in scheduler_stdout:
+            return self.exit_codes.ERROR_UNSPECIFIED
+
+        version = None
+        for line in scheduler_stdout.splitlines():
+            if line.startswith(self._VERSION_PRINT):
+                version = line[len(self._VERSION_PRINT):].strip()
+
+        sysimage_path = os.path.normpath(self.inputs.sysimage_path.value)
+        workdir = os.path.normpath(self.node.get_remote_workdir() or '/nonexistent')
+        # The working directory may be cleaned or purged later, leaving the code with a missing sysimage
+        if os.path.commonpath([sysimage_path, workdir]) == workdir:
+            return self.exit_codes.ERROR_SYSIMAGE_IN_WORKDIR
+        if version is None or not sysimage.is_version_allowed(version, _AIIDA_DFTK_VERSION_SPEC):
+            return self.exit_codes.ERROR_SYSIMAGE_VERSION_NOT_ALLOWED.format(
+                version=version, version_spec=_AIIDA_DFTK_VERSION_SPEC
+            )
+
+        sysimage.register_sysimage(self.inputs.code, version, sysimage_path)
+        self.report(f'registered sysimage `{sysimage_path}` for AiidaDFTK {version} on {self.inputs.code.full_label}')
+
+        self.out('output_parameters', orm.Dict({'sysimage_path': sysimage_path, 'aiidadftk_version': version}))
+
+        return ExitCode(0)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Command line interface of the aiida-dftk plugin."""
+import click
+from aiida.cmdline.groups import VerdiCommandGroup
+from aiida.cmdline.params import arguments, options, types
+from aiida.cmdline.utils import decorators, echo
+
+
+@click.group('aiida-dftk', cls=VerdiCommandGroup, context_settings={'help_option_names': ['-h', '--help']})
+@options.VERBOSITY()
+@options.PROFILE(type=types.ProfileParamType(load_profile=True), expose_value=False)
+def cmd_root():
+    """Command line interface of the aiida-dftk plugin."""
+
+
+@cmd_root.command('cache-report')
+@arguments.GROUP()
+@decorators.with_dbenv()
+def cmd_cache_report(group):
+    """Report how often the DFTK calculations of GROUP were reused from the cache.
+
+    The calculations called by the workflows of the group are included.
+    """
+    from aiida_dftk.utils import get_cache_report
+
+    report = get_cache_report(group.nodes)
+    if not report['calculations']:
+        echo.echo_warning(f'Group<{group.label}> contains no DFTK calculations.')
+        return
+
+    echo.echo(f"Calculations:        {report['calculations']} ({report['unique']} unique)")
+    echo.echo(f"From cache:          {report['from_cache']}")
+    echo.echo(f"Missed cache hits:   {report['missed_hits']}")
+    echo.echo(f"Hit rate:            {report['hit_rate']:.1%}")
+    echo.echo(f"Potential hit rate:  {report['potential_hit_rate']:.1%}")
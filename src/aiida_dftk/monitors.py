@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""`CalcJob` monitors for DFTK."""
+import io
+import json
+import math
+import os
+import shlex
+import typing as ty
+
+from aiida.engine.processes.calcjobs.monitors import CalcJobMonitorResult
+from aiida.orm import CalcJobNode
+from aiida.transports import Transport
+
+from aiida_dftk.calculations import DftkCalculation
+from aiida_dftk.utils import parse_dftk_log
+
+# Extended regexes matching the header and the rows of the DFTK SCF table, see `aiida_dftk.utils.logs`
+_SCF_TABLE_HEADER = '^[[:space:]]*n[[:space:]]+Energy[[:space:]]'
+_SCF_TABLE_ROW = '^[[:space:]]*[0-9]+[[:space:]]+[-+]?[0-9]'
+
+
+def get_scf_stop_reason(
+    norm_delta_rho: ty.Sequence[float], window: int, stagnation_ratio: float, divergence_factor: float
+) -> ty.Optional[str]:
+    """Return why the SCF should be stopped given the `norm_delta_rho` of its last `2 * window` iterations, or `None`.
+
+    The SCF is considered stagnating if the smallest `norm_delta_rho` of the last `window` iterations did not decrease
+    below `stagnation_ratio` times the smallest value of the `window` iterations before, and diverging if the last value
+    is `divergence_factor` times larger than the smallest.
+    """
+    norm_delta_rho = [value for value in norm_delta_rho if not math.isnan(value)][-2 * window:]
+    if len(norm_delta_rho) < 2 * window:
+        return None
+
+    previous, last = norm_delta_rho[:window], norm_delta_rho[window:]
+    if last[-1] > divergence_factor * min(norm_delta_rho):
+        return f'diverging: norm_delta_rho increased from {min(norm_delta_rho):.3e} to {last[-1]:.3e}'
+    if min(last) > stagnation_ratio * min(previous):
+        return f'stagnating: norm_delta_rho did not decrease below {min(previous):.3e} in {window} iterations'
+    return None
+
+
+def _is_checkpoint_settled(transport: Transport, logfile: str, checkpointfile: str, settle_seconds: float) -> bool:
+    """Return whether the checkpoint was written after the last SCF iteration in the log, and not since a while.
+
+    DFTK writes the checkpoint right after printing an SCF iteration. A checkpoint that is newer than the log and was
+    not modified for `settle_seconds` is therefore complete, and the SCF is busy with the next iteration.
+
+    Since the log is also modified at every SCF iteration, this is never the case if the SCF iterations take less than
+    `settle_seconds`.
+    """
+    command = f'date +%s; stat -L -c %Y {shlex.quote(checkpointfile)} {shlex.quote(logfile)}'
+    retval, stdout, _ = transport.exec_command_wait(command)
+    try:
+        now, checkpoint_mtime, log_mtime = (int(line) for line in stdout.split())
+    except ValueError:
+        return False
+    return retval == 0 and checkpoint_mtime >= log_mtime and now - checkpoint_mtime >= settle_seconds
+
+
+def monitor_scf_convergence(
+    node: CalcJobNode,
+    transport: Transport,
+    window: int = 10,
+    stagnation_ratio: float = 0.9,
+    divergence_factor: float = 100.0,
+    settle_seconds: float = 10.0,
+) -> ty.Optional[CalcJobMonitorResult]:
+    """Stop a `DftkCalculation` whose SCF is stagnating or diverging.
+
+    The last SCF iterations are read from the remote log without copying it, and the norm of the density change
+    `norm_delta_rho` of the last `window` iterations is compared to the `window` iterations before,
+    see `get_scf_stop_reason`.
+
+    If `scf.checkpointfile` is set, the job is only killed between two checkpoints, once the checkpoint of the last
+    iteration in the log is completely written; otherwise the check is repeated at the next poll. Right before the job
+    is killed, the reason is written to the working directory, such that the parser can return
+    `ERROR_SCF_STOPPED_BY_MONITOR` and `DftkBaseWorkChain` can restart with a smaller damping.
+
+    :param window: number of SCF iterations compared at a time
+    :param stagnation_ratio: minimal relative decrease of `norm_delta_rho` over `window` iterations
+    :param divergence_factor: maximal relative increase of `norm_delta_rho` compared to its smallest value
+    :param settle_seconds: time since the last modification of the checkpoint after which it is considered complete;
+        must be shorter than an SCF iteration, otherwise a job with `scf.checkpointfile` is never stopped
+    """
+    workdir = node.get_remote_workdir()
+    logfile = os.path.join(workdir, DftkCalculation.LOGFILE)
+    command = (
+        f"grep -m 1 -A 1 -E '{_SCF_TABLE_HEADER}' {shlex.quote(logfile)}; "
+        f"grep -E '{_SCF_TABLE_ROW}' {shlex.quote(logfile)} | tail -n {2 * window}"
+    )
+    _, stdout, _ = transport.exec_command_wait(command)
+
+    norm_delta_rho = parse_dftk_log(io.StringIO(stdout))['trace']['norm_delta_rho']
+    reason = get_scf_stop_reason(norm_delta_rho, window, stagnation_ratio, divergence_factor)
+    if reason is None:
+        return None
+
+    checkpointfile = node.inputs.parameters.get('scf', {}).get('checkpointfile', None)
+    if checkpointfile is not None and not _is_checkpoint_settled(
+        transport, logfile, os.path.join(workdir, checkpointfile), settle_seconds
+    ):
+        return None
+
+    stopfile = shlex.quote(os.path.join(workdir, DftkCalculation.MONITOR_STOPFILE))
+    transport.exec_command_wait(f'echo {shlex.quote(json.dumps({"reason": reason}))} > {stopfile}')
+
+    # Keep the exit code of the parser, which recognizes the stop file
+    return CalcJobMonitorResult(message=f'the SCF is {reason}', override_exit_code=False)
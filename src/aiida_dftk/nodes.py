@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""`Node` implementation of the DFTK calculations, with a hash that only depends on the physics of the calculation."""
+import copy
+import typing as ty
+
+from aiida.common.hashing import make_hash
+from aiida.common.lang import classproperty
+from aiida.orm import CalcJobNode
+from aiida.orm.nodes.process.calculation.calcjob import CalcJobNodeCaching
+
+# Options that only control the resources of the calculation, and which output files are kept. The options setting up
+# the environment, such as `prepend_text` and `environment_variables`, are hashed: they can select the Julia project,
+# and therefore the versions of DFTK and AiidaDFTK.
+_RUNTIME_OPTIONS = (
+    'resources',
+    'withmpi',
+    'mpirun_extra_params',
+    'append_text',
+    'rerunnable',
+    'stash',
+    'use_pseudo_cache',
+    'copy_parent_checkpoint',
+    'bundle_outputs',
+    'retrieve_policy',
+)
+# Environment variables that only set the number of threads of the calculation
+_RUNTIME_ENVIRONMENT_VARIABLES = ('JULIA_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+# Keys of the `scf` section of the parameters that only control how the SCF runs, not its result. The `checkpointfile`
+# is hashed: later calculations restart from the checkpoint of this name in the `remote_folder`.
+_RUNTIME_SCF_KEYS = ('maxtime',)
+# Keyword arguments of the SCF that only control what is printed
+_RUNTIME_SCF_KWARGS = ('callback',)
+# Inputs that only control how the calculation runs
+_RUNTIME_INPUT_PREFIXES = ('monitors__',)
+
+
+def get_physical_parameters(parameters: dict) -> dict:
+    """Return a copy of the DFTK input parameters without the keys that do not change the result of the calculation.
+
+    These are the time limit of the SCF and its callback.
+    """
+    parameters = copy.deepcopy(parameters)
+    scf = parameters.get('scf', {})
+    for key in _RUNTIME_SCF_KEYS:
+        scf.pop(key, None)
+    for key in _RUNTIME_SCF_KWARGS:
+        scf.get('$kwargs', {}).pop(key, None)
+    return parameters
+
+
+class DftkCalculationNodeCaching(CalcJobNodeCaching):
+    """Interface to control caching of a DFTK calculation node.
+
+    The hash leaves out the runtime options and the runtime parameters of the SCF, such that an identical SCF is
+    reused from the cache after changing, for example, the walltime or the resources. The options
+    setting up the environment of the job are kept, since they can select different versions of DFTK.
+    """
+
+    def get_objects_to_hash(self):
+        """Return the objects included in the hash, with the `parameters` input replaced by its physical part.
+
+        The environment variables setting the number of threads are left out as well.
+        """
+        objects = super().get_objects_to_hash()
+        environment_variables = {
+            key: value for key, value in objects['attributes'].pop('environment_variables', {}).items()
+            if key not in _RUNTIME_ENVIRONMENT_VARIABLES
+        }
+        if environment_variables:
+            objects['attributes']['environment_variables'] = environment_variables
+        inputs = {
+            label: node_hash for label, node_hash in objects['inputs'].items()
+            if not label.startswith(_RUNTIME_INPUT_PREFIXES)
+        }
+        if 'parameters' in inputs:
+            inputs['parameters'] = make_hash(get_physical_parameters(self._node.inputs.parameters.get_dict()))
+        objects['inputs'] = inputs
+        return objects
+
+
+class DftkCalculationNode(CalcJobNode):
+    """ORM class of the nodes of `DftkCalculation` and `DftkBatchCalculation`."""
+
+    RESOURCE_ESTIMATE_KEY = 'resource_estimate'
+
+    _CLS_NODE_CACHING = DftkCalculationNodeCaching
+
+    @classproperty
+    def _updatable_attributes(cls):  # pylint: disable=no-self-argument
+        return super()._updatable_attributes + (cls.RESOURCE_ESTIMATE_KEY,)
+
+    @classproperty
+    def _hash_ignored_attributes(cls):  # pylint: disable=no-self-argument
+        return super()._hash_ignored_attributes + _RUNTIME_OPTIONS + (cls.RESOURCE_ESTIMATE_KEY,)
+
+    def set_resource_estimate(self, estimate: dict) -> None:
+        """Set the size and memory of the calculation estimated before its submission.
+
+        :param estimate: the estimate, see `aiida_dftk.utils.estimate_memory`
+        """
+        self.base.attributes.set(self.RESOURCE_ESTIMATE_KEY, estimate)
+
+    def get_resource_estimate(self) -> ty.Optional[dict]:
+        """Return the size and memory of the calculation estimated before its submission, if any."""
+        return self.base.attributes.get(self.RESOURCE_ESTIMATE_KEY, None)
@@ -1,19 +1,31 @@
 # -*- coding: utf-8 -*-
 """`Parser` implementation for DFTK."""
+import contextlib
+import gzip
+import io
 import json
 import pathlib as pl
+import re
+import shutil
+import tarfile
+import tempfile
 import numpy as np
 
 from aiida.engine import ExitCode
-from aiida.orm import ArrayData, Dict
+from aiida.orm import ArrayData, Dict, FolderData
 from aiida.parsers import Parser
 from aiida.plugins import DataFactory
 
 
 from aiida_dftk.calculations import DftkCalculation
+from aiida_dftk.utils import is_out_of_memory, parse_dftk_log, parse_peak_memory, parse_timings, pseudo_cache
+from aiida_dftk.utils.sysimage import SYSIMAGE_USED_EXTRA
 
 import h5py
 
+# Maximal number of bytes of an HDF5 dataset read at once when copying it into an `ArrayData`
+_HDF5_BLOCK_SIZE = 16 * 1024**2
+
 # DataFactory is used to create the BandsData object
 BandsData = DataFactory('core.array.bands')
 
@@ -29,28 +41,231 @@ class DftkParser(Parser):
     _DEFAULT_BANDS_FUNCNAME = 'compute_bands'
     _DEFAULT_BANDS_UNIT = 'hartree'
 
+    # Output files unpacked from the retrieved archive, if the outputs were bundled
+    _bundle = None
+    # Folder of the output files retrieved only for parsing, if any
+    _temporary_folder = None
+
+    @property
+    def retrieved(self):
+        """Return the retrieved folder, or the unpacked outputs if they were retrieved as a single archive."""
+        if self._bundle is not None:
+            return self._bundle
+        return super().retrieved
+
     def parse(self, **kwargs):
         """Parse DFTK output files."""
+        exit_code = self._parse_pseudo_cache()
+        if exit_code is not None:
+            return exit_code
+        self._prepare_retrieved(kwargs.get('retrieved_temporary_folder', None))
+
         # if ran_out_of_walltime (terminated illy)
         if self.node.exit_status == DftkCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status:
             # if SCF summary file is not in the list of retrieved files, SCF terminated illy
-            if DftkCalculation.SCFRES_SUMMARY_NAME not in self.retrieved.list_object_names():
-                return self.exit_codes.ERROR_SCF_OUT_OF_WALLTIME
+            if not self._is_retrieved(DftkCalculation.SCFRES_SUMMARY_NAME):
+                return self._parse_scf_out_of_walltime()
             # POSTSCF terminated illy
             else:
                 return self.exit_codes.ERROR_POSTSCF_OUT_OF_WALLTIME
         
-        # Check error file
+        return self._parse_run()
+
+    def _item_path(self, file_name):
+        """Return the path of an output file of the run in the retrieved folder."""
+        return file_name
+
+    def _parse_pseudo_cache(self):
+        """Update the record of the remote pseudo cache of the computer from the output of the job script.
+
+        The pseudopotentials uploaded to the cache by the job are recorded, and the cached pseudopotentials reported
+        missing by the job script are forgotten, such that they are uploaded again by the next calculation.
+        """
         try:
-            errors_log = self.retrieved.base.repository.get_object_content(DftkCalculation.LOGFILE)
-            if "Imports succeeded" not in errors_log:
-                return self.exit_codes.ERROR_PACKAGE_IMPORT_FAILED
+            with self.retrieved.base.repository.open(self.node.get_option('scheduler_stdout'), 'rb') as handle:
+                missing = [
+                    line[len(pseudo_cache.PSEUDO_CACHE_MISS_PRINT):].strip()
+                    for line in io.TextIOWrapper(handle, encoding='utf-8', errors='replace')
+                    if line.startswith(pseudo_cache.PSEUDO_CACHE_MISS_PRINT)
+                ]
+        except (FileNotFoundError, TypeError):
+            return None
+
+        if missing:
+            pseudo_cache.unregister_cached_pseudos(self.node.computer, missing)
+            return self.exit_codes.ERROR_PSEUDO_CACHE_MISS.format(md5s=', '.join(missing))
+
+        pseudo_cache.register_cached_pseudos(
+            self.node.computer, self.node.base.extras.get(pseudo_cache.PSEUDO_CACHE_UPLOADED_EXTRA, [])
+        )
+        return None
+
+    def _prepare_retrieved(self, retrieved_temporary_folder=None):
+        """Locate the output files retrieved only for parsing, and unpack the archive of the bundled outputs if any.
+
+        The archive is unpacked in a temporary `FolderData`, streamed member by member such that it is never fully
+        loaded in memory. If the archive is missing, for example because the job was killed, the outputs are parsed as
+        missing.
+        """
+        if retrieved_temporary_folder is not None:
+            self._temporary_folder = pl.Path(retrieved_temporary_folder)
+        if not self.node.get_option('bundle_outputs'):
+            return
+
+        bundle = FolderData()
+        try:
+            with self._open(DftkCalculation.BUNDLE_ARCHIVE) as handle:
+                with tarfile.open(fileobj=handle, mode='r|gz') as archive:
+                    for member in archive:
+                        if member.isfile():
+                            bundle.base.repository.put_object_from_filelike(archive.extractfile(member), member.name)
+        except (FileNotFoundError, tarfile.TarError) as exception:
+            self.logger.warning(f'could not unpack the output archive `{DftkCalculation.BUNDLE_ARCHIVE}`: {exception}')
+        self._bundle = bundle
+
+    def _get_expected_files(self):
+        """Return the paths of the output files the calculation was asked to retrieve."""
+        if self.node.get_option('bundle_outputs'):
+            return self.node.base.repository.get_object_content(DftkCalculation.BUNDLE_MANIFEST).splitlines()
+        retrieve_list = (self.node.get_retrieve_list() or []) + (self.node.get_retrieve_temporary_list() or [])
+        # For tuple entries of the retrieve list, the remote source path is kept as is
+        paths = [entry if isinstance(entry, str) else entry[0] for entry in retrieve_list]
+        # Files with the `compressed` retrieve policy are retrieved with a `.gz` suffix
+        return [path[:-len('.gz')] if path.endswith('.gz') else path for path in paths]
+
+    def _get_compressed_path(self, file_name):
+        """Return the path of the compressed copy of an output file in the retrieved folder, or `None`."""
+        if self._bundle is None and self._is_in_retrieved(f'{file_name}.gz'):
+            return f'{file_name}.gz'
+        return None
+
+    @contextlib.contextmanager
+    def _open(self, file_name):
+        """Open an output file in binary mode, wherever it was retrieved to.
+
+        The file is looked up in the temporary folder, then as a compressed copy and finally as is in the retrieved
+        folder. Compressed copies are decompressed on the fly.
+        """
+        if self._temporary_folder is not None and (self._temporary_folder / file_name).is_file():
+            with open(self._temporary_folder / file_name, 'rb') as handle:
+                yield handle
+        elif self._get_compressed_path(file_name) is not None:
+            with self.retrieved.base.repository.open(self._get_compressed_path(file_name), 'rb') as handle:
+                with gzip.open(handle, 'rb') as decompressed:
+                    yield decompressed
+        else:
+            with self.retrieved.base.repository.open(file_name, 'rb') as handle:
+                yield handle
+
+    @contextlib.contextmanager
+    def _as_path(self, file_name):
+        """Return the filesystem path of an output file, wherever it was retrieved to.
+
+        Compressed copies are decompressed to a temporary file, which is removed on exit.
+        """
+        if self._temporary_folder is not None and (self._temporary_folder / file_name).is_file():
+            yield self._temporary_folder / file_name
+        elif self._get_compressed_path(file_name) is not None:
+            with tempfile.TemporaryDirectory() as dirpath:
+                file_path = pl.Path(dirpath) / pl.PurePosixPath(file_name).name
+                with self._open(file_name) as source, open(file_path, 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                yield file_path
+        else:
+            with self.retrieved.base.repository.as_path(file_name) as file_path:
+                yield file_path
+
+    def _parse_log(self):
+        """Parse the retrieved log, or return `None` if it is missing."""
+        # Stream the log, since verbose logs can be very large
+        try:
+            with self._open(self._item_path(DftkCalculation.LOGFILE)) as handle:
+                return parse_dftk_log(io.TextIOWrapper(handle, encoding='utf-8', errors='replace'))
         except FileNotFoundError:
+            return None
+
+    def _parse_scf_out_of_walltime(self):
+        """Parse an SCF killed by the scheduler, and check whether it wrote a checkpoint it can be restarted from.
+
+        The job script writes the `CHECKPOINT_STATFILE` when it is terminated, if the checkpoint was written since the
+        job started. A job killed before it could do so is conservatively treated as not resumable.
+        """
+        log = self._parse_log()
+        if log is not None and log['trace']['iteration']:
+            self._parse_output_scf_trace(log['trace'])
+
+        if ('checkpointfile' not in self.node.inputs.parameters.get('scf', {})
+                or not self._is_retrieved(self._item_path(DftkCalculation.CHECKPOINT_STATFILE))):
+            return self.exit_codes.ERROR_SCF_OUT_OF_WALLTIME
+
+        return self.exit_codes.ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED
+
+    def _read_scheduler_output(self, option):
+        """Return the content of the scheduler stdout or stderr given by the option, or an empty string."""
+        try:
+            # The scheduler output is never part of the archive of the bundled outputs
+            return super().retrieved.base.repository.get_object_content(self.node.get_option(option), mode='r')
+        except (FileNotFoundError, TypeError):
+            return ''
+
+    def _get_peak_memory(self):
+        """Return the peak memory of an MPI rank in bytes, or `None` if it is not available."""
+        return parse_peak_memory(self._read_scheduler_output('scheduler_stdout'), self.node.get_detailed_job_info())
+
+    def _is_out_of_memory(self, log):
+        """Return whether the run was killed for running out of memory, by the scheduler or in Julia."""
+        return (
+            self.node.exit_status == DftkCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_MEMORY.status
+            or (log is not None and log['out_of_memory'])
+            or is_out_of_memory(self._read_scheduler_output('scheduler_stderr'))
+        )
+
+    def _is_sysimage_missing(self):
+        """Return whether Julia failed to start because the sysimage it was started with could not be loaded."""
+        sysimage_path = self.node.base.extras.get(SYSIMAGE_USED_EXTRA, None)
+        if not sysimage_path:
+            return False
+        return any(
+            sysimage_path in line and ('not found' in line or 'could not load' in line.lower())
+            for line in self._read_scheduler_output('scheduler_stderr').splitlines()
+        )
+
+    def _parse_run(self):
+        """Parse the log and the output files of a single DFTK run."""
+        # Check error file
+        log = self._parse_log()
+        if (log is None or not log['finished_successfully']) and self._is_out_of_memory(log):
+            peak_memory = self._get_peak_memory()
+            peak_memory = 'unknown' if peak_memory is None else f'{peak_memory / 2**30:.2f} GiB'
+            return self.exit_codes.ERROR_OUT_OF_MEMORY.format(peak_memory=peak_memory)
+
+        if (log is None or not log['imports_succeeded']) and self._is_sysimage_missing():
+            return self.exit_codes.ERROR_SYSIMAGE_MISSING.format(sysimage=self.node.base.extras.get(SYSIMAGE_USED_EXTRA))
+
+        if log is None:
             return self.exit_codes.ERROR_PACKAGE_IMPORT_FAILED
 
-        if "Finished successfully" not in errors_log:
+        if not log['imports_succeeded']:
+            return self.exit_codes.ERROR_PACKAGE_IMPORT_FAILED
+
+        if log['trace']['iteration']:
+            self._parse_output_scf_trace(log['trace'])
+
+        stopfile_path = self._item_path(DftkCalculation.MONITOR_STOPFILE)
+        if self._is_retrieved(stopfile_path):
+            with self._open(stopfile_path) as handle:
+                reason = json.load(handle)['reason']
+            return self.exit_codes.ERROR_SCF_STOPPED_BY_MONITOR.format(reason=reason)
+
+        if not log['finished_successfully']:
             return self.exit_codes.ERROR_UNSPECIFIED
 
+        # The timings are not essential, don't fail if they are missing
+        timings_path = self._item_path(DftkCalculation.TIMINGS_FILENAME)
+        if self._is_retrieved(timings_path):
+            with self._as_path(timings_path) as file_path:
+                self._parse_output_timings(file_path)
+
         # Check retrieve list to know which files the calculation is expected to have produced.
         try:
             self._parse_optional_result(
@@ -71,8 +286,12 @@ class DftkParser(Parser):
                 self._parse_output_stresses,
             )
 
+            # Prefer the binary band output, the JSON one is written by older AiidaDFTK versions
+            bands_file_name = f'{self._DEFAULT_BANDS_FUNCNAME}.hdf5'
+            if not self._is_retrieved(self._item_path(bands_file_name)):
+                bands_file_name = f'{self._DEFAULT_BANDS_FUNCNAME}.json'
             self._parse_optional_result(
-                f'{self._DEFAULT_BANDS_FUNCNAME}.json',
+                bands_file_name,
                 self.exit_codes.ERROR_MISSING_BANDS_FILE,
                 self._parse_output_bands,
             )
@@ -82,25 +301,37 @@ class DftkParser(Parser):
         return ExitCode(0)
 
     def _parse_optional_result(self, file_name, missing_file_exitcode, parser):
-        # Files passed to the CalcInfo to be retrieved
-        retrieve_list = self.node.base.attributes.get('retrieve_list')
-        # Files that were actually retrieved
-        retrieved_files = self.retrieved.base.repository.list_object_names()
+        file_name = self._item_path(file_name)
 
-        if file_name in retrieve_list:
-            if file_name not in retrieved_files:
+        if file_name in self._get_expected_files():
+            if not self._is_retrieved(file_name):
                 raise ParsingFailedException(missing_file_exitcode)
-            with self.retrieved.base.repository.as_path(file_name) as file_path:
-                parser(file_path)
+            with self._as_path(file_name) as file_path:
+                exit_code = parser(file_path)
+            if exit_code is not None:
+                raise ParsingFailedException(exit_code)
+
+    def _is_retrieved(self, file_name):
+        """Return whether the given output file was retrieved, temporarily, compressed or as is."""
+        if self._temporary_folder is not None and (self._temporary_folder / file_name).is_file():
+            return True
+        return self._is_in_retrieved(file_name) or self._get_compressed_path(file_name) is not None
+
+    def _is_in_retrieved(self, file_name):
+        """Return whether the given path exists in the retrieved folder."""
+        path = pl.PurePosixPath(file_name)
+        directory = None if str(path.parent) == '.' else str(path.parent)
+        try:
+            return path.name in self.retrieved.base.repository.list_object_names(directory)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
 
     def _parse_output_parameters(self, file_path):
         with open(file_path, 'r', encoding='utf-8') as json_file:
             data = json.load(json_file)
 
-        # Ignore the 'occupation' and 'eigenvalues' keys
-        # TODO: add back for bands after implementation in DFTK
-        data.pop('occupation', None)
-        data.pop('eigenvalues', None)
+        # The arrays over k-points and bands are stored in `output_eigenvalues`, not in the Dict
+        self._parse_output_eigenvalues(data)
 
         # Rename the special keys
         data['norm_delta_rho'] = data.pop('norm_Δρ', None)
@@ -113,6 +344,21 @@ class DftkParser(Parser):
 
         data['fermi_level_unit'] = self._DEFAULT_ENERGY_UNIT
 
+        # Peak memory of the MPI ranks, for capacity planning
+        peak_memory = self._get_peak_memory()
+        if peak_memory is not None:
+            data['peak_memory_per_mpiproc'] = peak_memory
+            data['peak_memory_per_mpiproc_unit'] = 'bytes'
+
+        # Keep the Dict small, such that it stays cheap to store and query
+        arrays = ArrayData()
+        max_list_size = self.node.get_option('max_parameters_list_size')
+        if max_list_size is None:
+            max_list_size = DftkCalculation._MAX_PARAMETERS_LIST_SIZE
+        self._move_large_lists(data, arrays, max_list_size)
+        if arrays.get_arraynames():
+            self.out('output_arrays', arrays)
+
         self.out('output_parameters', Dict(dict=data))
         
         # Check for 'converged'
@@ -121,22 +367,82 @@ class DftkParser(Parser):
 
         return None
 
-    def _parse_output_forces(self, file_path):
-        with h5py.File(file_path, 'r') as h5file:
-            force_dict = DftkParser._hdf5_to_dict(h5file)
+    @staticmethod
+    def _move_large_lists(data, arrays, max_list_size, prefix=''):
+        """Move the numeric lists with more than `max_list_size` elements from the dict into the `ArrayData`.
+
+        Nested dicts are searched recursively, and the array of a list is named after its path of keys.
+        Each moved list is replaced in the dict by a reference to its array in `output_arrays`.
+        Lists that are not numeric arrays, e.g. lists of strings or ragged lists, are left in the dict.
+        """
+        for key, value in data.items():
+            name = prefix + re.sub('[^0-9a-zA-Z_]', '_', str(key))
+            if isinstance(value, dict):
+                DftkParser._move_large_lists(value, arrays, max_list_size, prefix=f'{name}__')
+                continue
+            if not isinstance(value, list):
+                continue
+            try:
+                array = np.array(value)
+            except ValueError:
+                continue
+            if array.size > max_list_size and array.dtype.kind in 'biuf':
+                arrays.set_array(name, array)
+                data[key] = {'array_output': 'output_arrays', 'array_name': name, 'shape': list(array.shape)}
+
+    def _parse_output_eigenvalues(self, data):
+        """Move the eigenvalues, occupations and k-points out of the SCF summary into the `output_eigenvalues`.
+
+        The eigenvalues and occupations are shaped (spin, k-point, band), with the k-points of all spin components
+        listed one spin after the other as in DFTK.
+        """
+        eigenvalues = data.pop('eigenvalues', None)
+        occupation = data.pop('occupation', None)
+        kweights = data.pop('kweights', None)
+        kcoords = data.pop('kcoords', None)
+        if eigenvalues is None:
+            return
+
+        eigenvalues = np.array(eigenvalues, dtype=float)
+        nspin = data.get('n_spin_components', 1)
+        shape = (nspin, data.get('n_kpoints', eigenvalues.shape[0] // nspin), -1)
+        eigenvalues_array = ArrayData()
+        eigenvalues_array.set_array('eigenvalues', eigenvalues.reshape(shape))
+        if occupation is not None:
+            eigenvalues_array.set_array('occupations', np.array(occupation, dtype=float).reshape(shape))
+        if kweights is not None:
+            eigenvalues_array.set_array('kweights', np.array(kweights, dtype=float))
+        if kcoords is not None:
+            eigenvalues_array.set_array('kpoints', np.array(kcoords, dtype=float))
+        self.out('output_eigenvalues', eigenvalues_array)
+
+    def _parse_output_scf_trace(self, trace):
+        scf_trace = ArrayData()
+        for name, values in trace.items():
+            dtype = np.int64 if name == 'iteration' else np.float64
+            scf_trace.set_array(name, np.array(values, dtype=dtype))
+        self.out('output_scf_trace', scf_trace)
+        return None
 
+    def _parse_output_timings(self, file_path):
+        with open(file_path, 'r', encoding='utf-8') as json_file:
+            timings = json.load(json_file)
+
+        self.out('output_timings', Dict(parse_timings(timings)))
+        return None
+
+    def _parse_output_forces(self, file_path):
         # TODO: add a check for the forces array agrees with number of atoms
         force_array = ArrayData()
-        force_array.set_array('output_forces', force_dict['results'])
+        with h5py.File(file_path, 'r') as h5file:
+            DftkParser._set_array_from_hdf5(force_array, 'output_forces', h5file['results'])
         self.out('output_forces', force_array)
         return None
 
     def _parse_output_stresses(self, file_path):
-        with h5py.File(file_path, 'r') as h5file:
-            stress_dict = DftkParser._hdf5_to_dict(h5file)
-
         stress_array = ArrayData()
-        stress_array.set_array('output_stresses', stress_dict['results'])
+        with h5py.File(file_path, 'r') as h5file:
+            DftkParser._set_array_from_hdf5(stress_array, 'output_stresses', h5file['results'])
         self.out('output_stresses', stress_array)
         return None
     
@@ -144,13 +450,27 @@ class DftkParser(Parser):
         if not pl.Path(file_path).exists():
             return self.exit_codes.ERROR_MISSING_BANDS_FILE
 
-        with open(file_path, 'r', encoding='utf-8') as json_file:
-            bands_dict = json.load(json_file)
-        
-        if bands_dict['diagonalization']['converged'] is False:
+        if pl.Path(file_path).suffix == '.hdf5':
+            converged, kpath, bands = self._read_bands_hdf5(file_path)
+        else:
+            converged, kpath, bands = self._read_bands_json(file_path)
+
+        if not converged:
             return self.exit_codes.ERROR_BANDS_CONVERGENCE_NOT_REACHED
-        
+
         bands_data = BandsData()
+        bands_data.set_kpoints(kpoints=kpath)
+        bands_data.set_bands(bands, units=self._DEFAULT_BANDS_UNIT)
+        self.out('output_bands', bands_data)
+
+        return None
+
+    @staticmethod
+    def _read_bands_json(file_path):
+        """Read the convergence, k-points and bands shaped (spin, k-point, band) from `compute_bands.json`."""
+        with open(file_path, 'r', encoding='utf-8') as json_file:
+            bands_dict = json.load(json_file)
+
         kpath = bands_dict['kcoords']
         eigen_array = np.array(bands_dict['eigenvalues'])
         nspin = bands_dict['n_spin_components']
@@ -158,31 +478,111 @@ class DftkParser(Parser):
         nbands = bands_dict['n_bands']
 
         bands = eigen_array.reshape(nspin, nkpoints, nbands)
+        return bands_dict['diagonalization']['converged'] is not False, kpath, bands
 
-        bands_data.set_kpoints(kpoints=kpath)
-        bands_data.set_bands(bands, units=self._DEFAULT_BANDS_UNIT)
-        self.out('output_bands', bands_data)
+    @staticmethod
+    def _read_bands_hdf5(file_path):
+        """Read the convergence, k-points and bands shaped (spin, k-point, band) from `compute_bands.hdf5`.
 
-        return None
+        The arrays are read directly into NumPy buffers. Julia writes the arrays in column-major order, which reverses
+        their axes in the file, so they are always transposed back; the shape alone cannot tell the layouts apart, e.g.
+        for 3 k-points.
+        """
+        def read(dataset, shape):
+            buffer = np.empty(dataset.shape, dtype=float)
+            dataset.read_direct(buffer)
+            return np.ascontiguousarray(buffer.T.reshape(shape))
+
+        with h5py.File(file_path, 'r') as h5file:
+            nspin = int(h5file['n_spin_components'][()])
+            nkpoints = int(h5file['n_kpoints'][()])
+            nbands = int(h5file['n_bands'][()])
+            converged = bool(h5file['diagonalization']['converged'][()])
+            kpath = read(h5file['kcoords'], (nkpoints, 3))
+            bands = read(h5file['eigenvalues'], (nspin, nkpoints, nbands))
+
+        return converged, kpath, bands
 
     @staticmethod
-    def _hdf5_to_dict(hdf5_file):
-        """Convert an HDF5 file to a Python dictionary.
+    def _set_array_from_hdf5(array_data, name, dataset):
+        """Copy an HDF5 dataset into an array of an `ArrayData`, without loading the whole dataset in memory.
 
-        :param hdf5_file: File or group object from h5py (HDF5 file handle or subgroup)
-        :return: Dictionary representation of the HDF5 file or group.
+        The dataset is copied block by block along its first axis into a memory-mapped `.npy` file,
+        which is then added to the repository of the node like `ArrayData.set_array` does.
+
+        :param array_data: the `ArrayData` to store the array in
+        :param name: the name of the array
+        :param dataset: the h5py dataset, only read when copied
         """
-        result = {}
-
-        for key, item in hdf5_file.items():
-            if isinstance(item, h5py.Dataset):  # item is a dataset
-                value = item[()]
-                if isinstance(value, bytes):  # Check if the value is bytes and decode if necessary
-                    value = value.decode('utf-8')
-                result[key] = value
-            elif isinstance(item, h5py.Group):  # item is a group
-                result[key] = DftkParser._hdf5_to_dict(item)
-        return result
+        if dataset.ndim == 0:
+            array_data.set_array(name, np.asarray(dataset[()]))
+            return
+
+        row_size = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=int))
+        rows_per_block = max(1, _HDF5_BLOCK_SIZE // max(row_size, 1))
+        with tempfile.TemporaryDirectory() as dirpath:
+            file_path = pl.Path(dirpath) / f'{name}.npy'
+            array = np.lib.format.open_memmap(file_path, mode='w+', dtype=dataset.dtype, shape=dataset.shape)
+            for start in range(0, dataset.shape[0], rows_per_block):
+                block = np.s_[start:start + rows_per_block]
+                dataset.read_direct(array, source_sel=block, dest_sel=block)
+            array.flush()
+            del array
+
+            with open(file_path, 'rb') as handle:
+                array_data.base.repository.put_object_from_filelike(handle, f'{name}.npy')
+        array_data.base.attributes.set(f'{array_data.array_prefix}{name}', list(dataset.shape))
+
+
+class DftkBatchParser(DftkParser):
+    """`Parser` implementation for `DftkBatchCalculation`.
+
+    Every item is parsed like a single DFTK run, from its own subfolder of the retrieved folder.
+    Its outputs are attached in the output namespaces, under the label of the item.
+    """
+
+    _item = None
+
+    def parse(self, **kwargs):
+        """Parse the outputs of all items of the batch."""
+        exit_code = self._parse_pseudo_cache()
+        if exit_code is not None:
+            return exit_code
+        self._prepare_retrieved(kwargs.get('retrieved_temporary_folder', None))
+
+        exit_codes = {}
+        for label in sorted(self.node.inputs.structures.keys()):
+            self._item = label
+            exit_codes[label] = self._parse_run()
+
+        failed = {label: exit_code for label, exit_code in exit_codes.items() if exit_code.status != 0}
+        for label, exit_code in failed.items():
+            self.logger.warning(f'batch item `{label}` failed with exit status {exit_code.status}: {exit_code.message}')
+
+        if not failed:
+            return ExitCode(0)
+        # The items run in turn, so the first failed item is the one interrupted by the walltime
+        if self.node.exit_status == DftkCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status:
+            self._item = next(iter(failed))
+            if not self._is_retrieved(self._item_path(DftkCalculation.SCFRES_SUMMARY_NAME)):
+                return self.exit_codes.ERROR_SCF_OUT_OF_WALLTIME
+            return self.exit_codes.ERROR_POSTSCF_OUT_OF_WALLTIME
+        if all(exit_code == self.exit_codes.ERROR_PACKAGE_IMPORT_FAILED for exit_code in exit_codes.values()):
+            return self.exit_codes.ERROR_PACKAGE_IMPORT_FAILED
+        # The items after the one that ran out of memory did not run
+        for exit_code in exit_codes.values():
+            if exit_code.status == self.exit_codes.ERROR_OUT_OF_MEMORY.status:
+                return exit_code
+        return self.exit_codes.ERROR_BATCH_ITEMS_FAILED
+
+    def _item_path(self, file_name):
+        """Return the path of an output file of the current item in the retrieved folder."""
+        return f'{self._item}/{file_name}'
+
+    def out(self, link_label, node):
+        """Register an output of the current item, in the namespace of the given link label."""
+        super().out(f'{link_label}.{self._item}', node)
+
 
 class ParsingFailedException(Exception):
     def __init__(self, exitcode: ExitCode):
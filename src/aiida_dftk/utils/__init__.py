@@ -2,10 +2,18 @@
 """aiida-abinit utility functions."""
 
 #from .dictionary import *
+from .bands import *
+from .caching import *
+from .cost_model import *
 from .kpoints import *
+from .logs import *
+from .memory import *
+from .precompilation import *
+from .pseudo_cache import *
 from .pseudos import *
+from .resources import *
 from .seekpath import *
+from .sysimage import *
+from .timings import *
 
-#from .resources import *
-
-__all__ = kpoints.__all__ + pseudos.__all__ + seekpath.__all__ # pylint: disable=undefined-variable
+__all__ = bands.__all__ + caching.__all__ + cost_model.__all__ + kpoints.__all__ + logs.__all__ + memory.__all__ + precompilation.__all__ + pseudo_cache.__all__ + pseudos.__all__ + resources.__all__ + seekpath.__all__ + sysimage.__all__ + timings.__all__ # pylint: disable=undefined-variable
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Band structure utility functions."""
+from aiida import orm
+from aiida.engine import calcfunction
+import numpy as np
+
+__all__ = ('split_kpoints', 'merge_bands')
+
+
+@calcfunction
+def split_kpoints(kpoints: orm.KpointsData, chunks: orm.Int) -> dict:
+    """Split an explicit k-point path into consecutive chunks of nearly equal size.
+
+    :param kpoints: the KpointsData of the whole path
+    :param chunks: the number of chunks
+    :returns: a dict of KpointsData with keys `chunk_<index>` in the order of the path
+    """
+    result = {}
+    for index, chunk in enumerate(np.array_split(kpoints.get_kpoints(), chunks.value)):
+        chunk_kpoints = orm.KpointsData()
+        chunk_kpoints.set_cell(kpoints.cell, kpoints.pbc)
+        chunk_kpoints.set_kpoints(chunk)
+        result[f'chunk_{index}'] = chunk_kpoints
+    return result
+
+
+@calcfunction
+def merge_bands(kpoints: orm.KpointsData, **bands: orm.BandsData) -> orm.BandsData:
+    """Merge the bands computed on consecutive chunks of a k-point path into the band structure of the whole path.
+
+    :param kpoints: the KpointsData of the whole path, whose cell and labels are kept
+    :param bands: the BandsData of each chunk, with keys `chunk_<index>` giving the order of the chunks along the path
+    :returns: a BandsData with the kpoints and labels of the path and the bands of all chunks
+    """
+    ordered = [bands[key] for key in sorted(bands, key=lambda key: int(key.rsplit('_', 1)[1]))]
+    # The k-points are the second to last axis, also with a leading spin axis
+    merged_bands = np.concatenate([chunk.get_bands() for chunk in ordered], axis=-2)
+
+    merged = orm.BandsData()
+    merged.set_kpointsdata(kpoints)
+    merged.set_bands(merged_bands, units=ordered[0].units)
+    return merged
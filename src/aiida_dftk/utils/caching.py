@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Utilities to analyse the reuse of DFTK calculations through the AiiDA cache."""
+import collections
+import typing as ty
+
+from aiida import orm
+
+__all__ = ('get_cache_report',)
+
+
+def get_cache_report(nodes: ty.Iterable[orm.ProcessNode]) -> dict:
+    """Report how often DFTK calculations were reused from the cache.
+
+    Workflows are searched for the DFTK calculations they called. Calculations that were run although an earlier
+    calculation with the same hash exists are counted as missed hits, they typically ran with caching disabled.
+
+    :param nodes: process nodes, for example the nodes of a group
+    :return: a dict with the number of `calculations`, of calculations created `from_cache` and of `missed_hits`,
+        the `hit_rate` and the `potential_hit_rate` had all missed hits been taken from the cache,
+        and the `unique` number of calculations, i.e. of distinct hashes.
+    """
+    from aiida_dftk.nodes import DftkCalculationNode
+
+    calculations = {}
+    for node in nodes:
+        candidates = node.called_descendants if isinstance(node, orm.WorkflowNode) else [node]
+        for candidate in candidates:
+            if isinstance(candidate, DftkCalculationNode):
+                calculations[candidate.uuid] = candidate
+
+    from_cache = 0
+    missed_hits = 0
+    runs_per_hash = collections.Counter()
+    for node in sorted(calculations.values(), key=lambda node: node.ctime):
+        node_hash = node.base.caching.compute_hash()
+        if node.base.caching.is_created_from_cache:
+            from_cache += 1
+        elif runs_per_hash[node_hash] > 0:
+            missed_hits += 1
+        runs_per_hash[node_hash] += 1
+
+    total = len(calculations)
+    return {
+        'calculations': total,
+        'unique': len(runs_per_hash),
+        'from_cache': from_cache,
+        'missed_hits': missed_hits,
+        'hit_rate': from_cache / total if total else 0.0,
+        'potential_hit_rate': (from_cache + missed_hits) / total if total else 0.0,
+    }
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Utilities to predict the walltime of DFTK calculations from the timings of finished ones."""
+import math
+import statistics
+import typing as ty
+
+import numpy as np
+from aiida import orm
+
+from .resources import _DEFAULT_STARTUP_TIME, _DFTK_DEFAULT_SCF_TOL, _get_max_wallclock_seconds, estimate_memory
+from .sysimage import get_startup_latency
+
+__all__ = ('fit_cost_model', 'predict_walltime')
+
+# Features of the log-linear model of the time spent in DFTK, the time scales as a power of the sizes
+_FEATURES = ('intercept', 'log_nkpoints_per_mpiproc', 'log_nplanewaves', 'log_nbands', 'scf_tolerance_decades')
+
+
+def _get_num_mpiprocs(options: ty.Mapping, computer: orm.Computer) -> int:
+    """Return the total number of MPI ranks requested by the options of a calculation."""
+    resources = options.get('resources', {})
+    num_mpiprocs_per_machine = 1
+    if options.get('withmpi', True):
+        num_mpiprocs_per_machine = (
+            resources.get('num_mpiprocs_per_machine', None) or computer.get_default_mpiprocs_per_machine() or 1
+        )
+    return num_mpiprocs_per_machine * resources.get('num_machines', 1)
+
+
+def _get_features(
+    structure: orm.StructureData,
+    pseudos: ty.Mapping,
+    parameters: dict,
+    kpoints: orm.KpointsData,
+    num_mpiprocs: int,
+) -> ty.Optional[list]:
+    """Return the features of a calculation for the cost model, or `None` if its size cannot be estimated."""
+    estimate = estimate_memory(structure, pseudos, parameters, kpoints, num_mpiprocs)
+    if estimate is None:
+        return None
+    tol = parameters.get('scf', {}).get('$kwargs', {}).get('tol', _DFTK_DEFAULT_SCF_TOL)
+    return [
+        1.0,
+        math.log(estimate['nkpoints_per_mpiproc']),
+        math.log(estimate['nplanewaves']),
+        math.log(estimate['nbands']),
+        -math.log10(tol),
+    ]
+
+
+def fit_cost_model(nodes: ty.Iterable[orm.ProcessNode]) -> orm.Dict:
+    """Fit a model of the walltime of DFTK calculations to the timings of finished calculations.
+
+    The logarithm of the time spent in DFTK is fitted as a linear function of the logarithms of the number of
+    k-points per MPI rank, of plane waves and of bands, and of the number of decades of the SCF tolerance.
+    The Julia startup time is taken as the median over the calculations where it was measured.
+    Workflows are searched for the DFTK calculations they called.
+
+    :param nodes: process nodes, for example the nodes of a group
+    :return: an unstored `Dict` with the `features` and the fitted `coefficients`, the standard deviation `sigma`
+        of the residuals of the logarithm of the time, the `startup_time` and the `num_calculations` used.
+    :raises ValueError: if there are not enough successful calculations with timings to fit the model.
+    """
+    calculations = {}
+    for node in nodes:
+        candidates = node.called_descendants if isinstance(node, orm.WorkflowNode) else [node]
+        for candidate in candidates:
+            if (
+                candidate.process_type == 'aiida.calculations:dftk' and candidate.is_finished_ok
+                and 'output_timings' in candidate.outputs
+            ):
+                calculations[candidate.uuid] = candidate
+
+    features, times, startup_times = [], [], []
+    for node in calculations.values():
+        node_features = _get_features(
+            node.inputs.structure,
+            node.inputs.pseudos,
+            node.inputs.parameters.get_dict(),
+            node.inputs.kpoints,
+            _get_num_mpiprocs(node.get_options(), node.computer),
+        )
+        time = node.outputs.output_timings['total_time']
+        if node_features is None or not time > 0:
+            continue
+        features.append(node_features)
+        times.append(math.log(time))
+        startup_latency = get_startup_latency(node)
+        if startup_latency is not None:
+            startup_times.append(startup_latency['startup_latency'])
+
+    if len(times) <= len(_FEATURES):
+        raise ValueError(
+            f'Need more than {len(_FEATURES)} successful DFTK calculations with timings, found {len(times)}.'
+        )
+
+    features, times = np.array(features), np.array(times)
+    coefficients, *_ = np.linalg.lstsq(features, times, rcond=None)
+    residuals = times - features @ coefficients
+    sigma = math.sqrt(float(residuals @ residuals) / (len(times) - len(_FEATURES)))
+
+    return orm.Dict({
+        'features': list(_FEATURES),
+        'coefficients': coefficients.tolist(),
+        'sigma': sigma,
+        'startup_time': statistics.median(startup_times) if startup_times else _DEFAULT_STARTUP_TIME,
+        'num_calculations': len(times),
+    })
+
+
+def predict_walltime(
+    model: ty.Union[orm.Dict, dict],
+    inputs: ty.Mapping,
+    num_sigma: float = 2.0,
+) -> ty.Optional[dict]:
+    """Predict the walltime of a DFTK calculation with a model fitted by `fit_cost_model`.
+
+    :param model: the cost model
+    :param inputs: the builder of a `DftkCalculation`, or its inputs
+    :param num_sigma: the number of standard deviations of the model added to the predicted time as a safety margin
+    :return: a dict with the predicted `dftk_time` spent in DFTK and the `max_wallclock_seconds` to request,
+        or `None` if the size of the calculation cannot be estimated, e.g. because `Ecut` is not set.
+    """
+    if isinstance(model, orm.Dict):
+        model = model.get_dict()
+    if tuple(model['features']) != _FEATURES:
+        raise ValueError(f"The cost model has the features {model['features']}, expected {_FEATURES}.")
+
+    options = inputs.get('metadata', {}).get('options', {})
+    features = _get_features(
+        inputs['structure'],
+        inputs['pseudos'],
+        inputs['parameters'].get_dict(),
+        inputs['kpoints'],
+        _get_num_mpiprocs(options, inputs['code'].computer),
+    )
+    if features is None:
+        return None
+
+    log_time = float(np.dot(model['coefficients'], features))
+    return {
+        'dftk_time': math.exp(log_time),
+        'max_wallclock_seconds': _get_max_wallclock_seconds(
+            model['startup_time'], math.exp(log_time + num_sigma * model['sigma'])
+        ),
+    }
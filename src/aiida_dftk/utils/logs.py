@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Utilities to parse the log written by AiidaDFTK."""
+import math
+import re
+import typing as ty
+
+from aiida import orm
+from aiida.engine import calcfunction
+import numpy as np
+
+from .memory import is_out_of_memory
+
+__all__ = ('parse_dftk_log', 'merge_scf_traces')
+
+IMPORTS_SUCCEEDED_PRINT = 'Imports succeeded'
+FINISHED_SUCCESSFULLY_PRINT = 'Finished successfully'
+
+# Header of the table printed by the default DFTK SCF callback, e.g.
+# n     Energy            log10(ΔE)   log10(Δρ)   Diag   Δtime
+# ---   ---------------   ---------   ---------   ----   ------
+#   1   -7.921245648316                   -0.69    5.0    27.4ms
+_SCF_TABLE_HEADER = re.compile(r'^\s*n\s+Energy\s')
+_SCF_TABLE_ROW = re.compile(r'^\s*\d+\s')
+# Column of the DFTK SCF table and the name of the corresponding trace
+_SCF_COLUMNS = {
+    'n': 'iteration',
+    'Energy': 'energy',
+    'log10(Δρ)': 'norm_delta_rho',
+    'Diag': 'diagonalization_iterations',
+    'Δtime': 'wall_time',
+}
+# Column of the DFTK SCF table that is empty in the first iteration
+_SCF_DELTA_ENERGY_COLUMN = 'log10(ΔE)'
+_TIME_UNITS = {'ns': 1e-9, 'μs': 1e-6, 'µs': 1e-6, 'us': 1e-6, 'ms': 1e-3, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+_TIME_REGEX = re.compile(r'^([0-9.eE+-]+)\s*([a-zμµ]*)$')
+
+
+def _parse_time(value: str) -> float:
+    """Parse a time such as `27.4ms` as printed by DFTK, into seconds."""
+    match = _TIME_REGEX.match(value)
+    if match is None:
+        return math.nan
+    return float(match.group(1)) * _TIME_UNITS.get(match.group(2) or 's', math.nan)
+
+
+def _parse_scf_row(columns: ty.List[str], line: str) -> ty.Optional[dict]:
+    """Parse a row of the DFTK SCF table, or return `None` if the line is not a valid row."""
+    values = line.split()
+    if len(values) == len(columns) - 1 and _SCF_DELTA_ENERGY_COLUMN in columns:
+        # The energy change is not printed in the first iteration
+        values.insert(columns.index(_SCF_DELTA_ENERGY_COLUMN), 'NaN')
+    if len(values) != len(columns):
+        return None
+
+    row = {}
+    try:
+        for column, value in zip(columns, values):
+            if column == 'n':
+                row['iteration'] = int(value)
+            elif column == 'Δtime':
+                row['wall_time'] = _parse_time(value)
+            elif column == 'log10(Δρ)':
+                row['norm_delta_rho'] = 10**float(value)
+            elif column in _SCF_COLUMNS:
+                row[_SCF_COLUMNS[column]] = float(value)
+    except ValueError:
+        return None
+    return row
+
+
+def parse_dftk_log(stream: ty.Iterable[str]) -> dict:
+    """Parse an AiidaDFTK log in a single pass over its lines, without loading it in memory.
+
+    The per-iteration values of the SCF tables printed by DFTK are collected into the `trace`.
+    If the log contains several SCF tables, for example after a restart, their rows are concatenated.
+
+    :param stream: an iterable over the lines of the log, such as an open text file
+    :return: a dict with the booleans `imports_succeeded`, `finished_successfully` and `out_of_memory`, the latter if
+        an out-of-memory error was logged, and the `trace`: a dict of lists
+        with the `iteration` number, total `energy`, `norm_delta_rho`, number of `diagonalization_iterations` and
+        `wall_time` in seconds of each SCF iteration.
+    """
+    result = {
+        'imports_succeeded': False,
+        'finished_successfully': False,
+        'out_of_memory': False,
+        'trace': {name: [] for name in _SCF_COLUMNS.values()},
+    }
+
+    columns = None
+    in_table = False
+    for line in stream:
+        if in_table:
+            row = _parse_scf_row(columns, line) if _SCF_TABLE_ROW.match(line) else None
+            if row is not None:
+                for name, values in result['trace'].items():
+                    values.append(row.get(name, math.nan))
+                continue
+            in_table = False
+
+        if columns is not None and line.lstrip().startswith('---'):
+            # The separator line below the header starts the table
+            in_table = True
+            continue
+        columns = line.split() if _SCF_TABLE_HEADER.match(line) else None
+
+        if IMPORTS_SUCCEEDED_PRINT in line:
+            result['imports_succeeded'] = True
+        elif FINISHED_SUCCESSFULLY_PRINT in line:
+            result['finished_successfully'] = True
+        elif not result['out_of_memory'] and is_out_of_memory(line):
+            result['out_of_memory'] = True
+
+    return result
+
+
+@calcfunction
+def merge_scf_traces(**traces: orm.ArrayData) -> orm.ArrayData:
+    """Concatenate the SCF traces of a chain of calculations, each restarted from the checkpoint of the previous one.
+
+    The iterations are numbered continuously, as if the SCF had been run in a single calculation.
+
+    :param traces: the `output_scf_trace` of each calculation, with keys `chunk_<index>` giving the order of the chain
+    :returns: an ArrayData with the same arrays as the individual traces
+    """
+    ordered = [traces[key] for key in sorted(traces, key=lambda key: int(key.rsplit('_', 1)[1]))]
+
+    merged = orm.ArrayData()
+    for name in ordered[0].get_arraynames():
+        merged.set_array(name, np.concatenate([trace.get_array(name) for trace in ordered]))
+    merged.set_array('iteration', np.arange(1, len(merged.get_array('iteration')) + 1, dtype=np.int64))
+    return merged
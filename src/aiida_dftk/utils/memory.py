@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Utilities to detect DFTK calculations that ran out of memory, and to recover their peak memory."""
+import re
+import typing as ty
+
+__all__ = ('is_out_of_memory', 'parse_peak_memory')
+
+PEAK_MEMORY_PRINT = 'AiidaDFTK peak memory (bytes): '
+
+# Messages of Julia, MPI and the schedulers when a process runs out of memory or is killed by the OOM killer
+_OUT_OF_MEMORY_REGEX = re.compile(
+    r'OutOfMemoryError|out[ -]of[ -]memory|oom[ -]kill|exceeded (job )?memory limit|cannot allocate memory|bad_alloc',
+    re.IGNORECASE,
+)
+# Memory as reported by the accounting of SLURM, e.g. `123456K`
+_MEMORY_REGEX = re.compile(r'^([0-9.]+)([KMGT]?)$')
+_MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def is_out_of_memory(text: str) -> bool:
+    """Return whether the text, e.g. a line of the log or the scheduler stderr, reports an out-of-memory error."""
+    return _OUT_OF_MEMORY_REGEX.search(text) is not None
+
+
+def parse_peak_memory(stdout: str = '', detailed_job_info: ty.Optional[dict] = None) -> ty.Optional[int]:
+    """Return the peak memory of the MPI ranks of a DFTK calculation, in bytes.
+
+    Every rank prints its peak resident memory to stdout at the end of the run. If a rank was killed before,
+    the `MaxRSS` of the steps in the detailed job info of the scheduler is used, which only SLURM reports.
+
+    :param stdout: the scheduler stdout of the calculation
+    :param detailed_job_info: the detailed job info of the calculation, see `CalcJobNode.get_detailed_job_info`
+    :return: the largest peak memory of an MPI rank, or `None` if it is not available
+    """
+    peaks = []
+    for line in stdout.splitlines():
+        if line.startswith(PEAK_MEMORY_PRINT):
+            try:
+                peaks.append(int(line[len(PEAK_MEMORY_PRINT):]))
+            except ValueError:
+                continue
+
+    lines = (detailed_job_info or {}).get('stdout', '').splitlines()
+    if not peaks and lines and 'MaxRSS' in lines[0].split('|'):
+        fields = lines[0].split('|')
+        for line in lines[1:]:
+            values = line.split('|')
+            match = _MEMORY_REGEX.match(values[fields.index('MaxRSS')].strip()) if len(values) == len(fields) else None
+            if match is not None:
+                peaks.append(int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)]))
+
+    return max(peaks) if peaks else None
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Code-level bookkeeping of the precompilation of AiidaDFTK, shared by all workchains using the same code."""
+import typing as ty
+
+from aiida import orm
+from aiida.common import exceptions
+
+__all__ = (
+    'PRECOMPILATION_SUCCEEDED',
+    'PRECOMPILATION_FAILED',
+    'get_precompilation_state',
+    'set_precompilation_state',
+    'reset_precompilation_state',
+    'acquire_precompilation_lock',
+    'release_precompilation_lock',
+    'set_precompilation_lock_process',
+    'get_running_precompilation',
+    'PrecompilationLockGroup',
+)
+
+PRECOMPILATION_SUCCEEDED = 'succeeded'
+PRECOMPILATION_FAILED = 'failed'
+
+# Extra of the `Code` mapping AiidaDFTK version specs to the outcome of the last precompilation
+_PRECOMPILATION_STATE_EXTRA = 'aiida_dftk_precompilation'
+# Extra of the lock group with the UUID of the precompilation submitted by the process holding the lock
+_LOCK_PROCESS_EXTRA = 'process'
+
+
+def _lock_label(code: orm.AbstractCode, version_spec: str) -> str:
+    return f'aiida_dftk/precompilation_lock/{code.uuid}/{version_spec}'
+
+
+def get_precompilation_state(code: orm.AbstractCode, version_spec: str) -> ty.Optional[dict]:
+    """Return the outcome of the last precompilation of the given AiidaDFTK version spec with the code, if any.
+
+    :return: `None` if the code was never precompiled, or a dict with the `state`, either `PRECOMPILATION_SUCCEEDED`
+        or `PRECOMPILATION_FAILED`, and the UUID of the `PrecompileCalculation` under `process`.
+    """
+    return code.base.extras.get(_PRECOMPILATION_STATE_EXTRA, {}).get(version_spec, None)
+
+
+def set_precompilation_state(code: orm.AbstractCode, version_spec: str, state: str, process: orm.ProcessNode) -> None:
+    """Record the outcome of a precompilation of the given AiidaDFTK version spec with the code."""
+    states = code.base.extras.get(_PRECOMPILATION_STATE_EXTRA, {})
+    states[version_spec] = {'state': state, 'process': process.uuid}
+    code.base.extras.set(_PRECOMPILATION_STATE_EXTRA, states)
+
+
+def reset_precompilation_state(code: orm.AbstractCode, version_spec: str) -> None:
+    """Forget the outcome of the last precompilation, for example after fixing a broken Julia environment."""
+    states = code.base.extras.get(_PRECOMPILATION_STATE_EXTRA, {})
+    states.pop(version_spec, None)
+    code.base.extras.set(_PRECOMPILATION_STATE_EXTRA, states)
+
+
+class PrecompilationLockGroup(orm.Group):
+    """Group used as the lock of the precompilation of AiidaDFTK with a code.
+
+    A dedicated group type keeps the locks out of `verdi group list` and of the operations on the groups of the user.
+    """
+
+
+def get_running_precompilation(code: orm.AbstractCode, version_spec: str) -> ty.Optional[orm.CalcJobNode]:
+    """Return the precompilation submitted by the process holding the lock of the code, if any.
+
+    A lock held by a process that already terminated is stale, for example because the workchain was killed, and is
+    released. While the process holding the lock has not submitted its precompilation yet, `None` is returned.
+    """
+    try:
+        group = PrecompilationLockGroup.collection.get(label=_lock_label(code, version_spec))
+    except exceptions.NotExistent:
+        return None
+
+    try:
+        owner = orm.load_node(group.description)
+        uuid = group.base.extras.get(_LOCK_PROCESS_EXTRA, None)
+        node = orm.load_node(uuid) if uuid is not None else None
+    except exceptions.NotExistent:
+        owner = None
+
+    if owner is None or owner.is_terminated or (node is not None and node.is_terminated):
+        PrecompilationLockGroup.collection.delete(group.pk)
+        return None
+    return node
+
+
+def acquire_precompilation_lock(code: orm.AbstractCode, version_spec: str, owner: orm.ProcessNode) -> bool:
+    """Try to become the only process precompiling AiidaDFTK with the code.
+
+    The lock is a group with a unique label, such that the database guarantees that only one caller can acquire it.
+    The UUID of the process holding the lock is stored in the description of the group. The lock must be acquired
+    before submitting the precompilation, which is then recorded with `set_precompilation_lock_process`.
+
+    :return: whether the lock was acquired.
+    """
+    try:
+        PrecompilationLockGroup(label=_lock_label(code, version_spec), description=owner.uuid).store()
+    except exceptions.IntegrityError:
+        return False
+    return True
+
+
+def set_precompilation_lock_process(
+    code: orm.AbstractCode, version_spec: str, owner: orm.ProcessNode, process: orm.ProcessNode
+) -> None:
+    """Record the precompilation submitted by the process holding the lock, for the other processes to wait for it."""
+    group = PrecompilationLockGroup.collection.get(label=_lock_label(code, version_spec))
+    if group.description == owner.uuid:
+        group.base.extras.set(_LOCK_PROCESS_EXTRA, process.uuid)
+
+
+def release_precompilation_lock(code: orm.AbstractCode, version_spec: str, owner: orm.ProcessNode) -> None:
+    """Release the precompilation lock of the code, if it is held by the given process."""
+    try:
+        group = PrecompilationLockGroup.collection.get(label=_lock_label(code, version_spec))
+        if group.description == owner.uuid:
+            PrecompilationLockGroup.collection.delete(group.pk)
+    except exceptions.NotExistent:
+        pass
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of pseudopotentials on the remote computer, shared by all calculations on the computer."""
+import os
+import shlex
+import typing as ty
+
+from aiida import orm
+
+__all__ = (
+    'set_pseudo_cache_directory',
+    'unset_pseudo_cache_directory',
+    'get_pseudo_cache_directory',
+    'validate_pseudo_cache',
+)
+
+# Property of the `Computer` with the cache `directory` and the `md5` of the pseudopotentials known to be in it
+_PSEUDO_CACHE_PROPERTY = 'aiida_dftk_pseudo_cache'
+# Extra of a `DftkCalculation` with the md5 of the pseudopotentials it uploads to the cache
+PSEUDO_CACHE_UPLOADED_EXTRA = 'aiida_dftk_pseudo_cache_uploaded'
+# Printed by the job script for each cached pseudopotential that is missing
+PSEUDO_CACHE_MISS_PRINT = 'AiidaDFTK pseudo cache miss: '
+
+
+def _get_cache(computer: orm.Computer) -> dict:
+    return computer.get_property(_PSEUDO_CACHE_PROPERTY, {})
+
+
+def set_pseudo_cache_directory(computer: orm.Computer, directory: str) -> None:
+    """Enable the pseudopotential cache of the computer, in the given absolute directory on the computer.
+
+    Calculations on the computer then upload each pseudopotential to the cache only once, and symlink it afterwards.
+    """
+    if not os.path.isabs(directory):
+        raise ValueError(f'the pseudo cache directory must be an absolute path, got `{directory}`')
+    computer.set_property(_PSEUDO_CACHE_PROPERTY, {'directory': directory, 'md5': []})
+
+
+def unset_pseudo_cache_directory(computer: orm.Computer) -> None:
+    """Disable the pseudopotential cache of the computer. The files in the cache directory are left untouched."""
+    metadata = computer.metadata
+    metadata.pop(_PSEUDO_CACHE_PROPERTY, None)
+    computer.metadata = metadata
+
+
+def get_pseudo_cache_directory(computer: orm.Computer) -> ty.Optional[str]:
+    """Return the pseudopotential cache directory of the computer, or `None` if the cache is not enabled."""
+    return _get_cache(computer).get('directory', None)
+
+
+def get_pseudo_cache_path(directory: str, md5: str) -> str:
+    """Return the path of the pseudopotential with the given md5 in the cache directory."""
+    return os.path.join(directory, f'{md5}.upf')
+
+
+def get_cached_pseudos(computer: orm.Computer) -> ty.Set[str]:
+    """Return the md5 of the pseudopotentials known to be in the cache of the computer."""
+    return set(_get_cache(computer).get('md5', []))
+
+
+def register_cached_pseudos(computer: orm.Computer, md5s: ty.Iterable[str]) -> None:
+    """Record that the pseudopotentials with the given md5 were uploaded to the cache of the computer."""
+    cache = _get_cache(computer)
+    if cache:
+        cache['md5'] = sorted(set(cache['md5']).union(md5s))
+        computer.set_property(_PSEUDO_CACHE_PROPERTY, cache)
+
+
+def unregister_cached_pseudos(computer: orm.Computer, md5s: ty.Iterable[str]) -> None:
+    """Record that the pseudopotentials with the given md5 are missing from the cache of the computer."""
+    cache = _get_cache(computer)
+    if cache:
+        cache['md5'] = sorted(set(cache['md5']).difference(md5s))
+        computer.set_property(_PSEUDO_CACHE_PROPERTY, cache)
+
+
+def get_pseudo_cache_script(directory: str, uploaded: ty.Dict[str, str], symlinked: ty.Dict[str, str]) -> str:
+    """Return the job script lines maintaining the pseudopotential cache.
+
+    :param directory: the cache directory
+    :param uploaded: the md5 of the uploaded pseudopotentials, mapped to their path in the working directory.
+        They are copied to the cache after checking their md5, through a temporary file to be safe from concurrent jobs.
+    :param symlinked: the md5 of the pseudopotentials symlinked from the cache, mapped to their path in the working
+        directory. If one of them is missing, the job stops and reports the cache miss.
+    """
+    lines = []
+    for md5, path in symlinked.items():
+        lines.append(f'[ -r {shlex.quote(path)} ] || {{ echo "{PSEUDO_CACHE_MISS_PRINT}{md5}"; exit 1; }}')
+    if uploaded:
+        lines.append(f'mkdir -p {shlex.quote(directory)}')
+    for md5, path in uploaded.items():
+        cached = shlex.quote(get_pseudo_cache_path(directory, md5))
+        temporary = f'{cached}.tmp.$$'
+        lines.append(
+            f'[ -f {cached} ] || {{ cp {shlex.quote(path)} {temporary} && echo "{md5}  "{temporary} | md5sum -c --status '
+            f'&& mv {temporary} {cached}; rm -f {temporary}; }}'
+        )
+    return '\n'.join(lines)
+
+
+def validate_pseudo_cache(computer: orm.Computer, remove_unused: bool = False) -> dict:
+    """Check the md5 of the files in the pseudopotential cache of the computer, and remove the corrupted ones.
+
+    The record of the pseudopotentials in the cache is reset to the valid files.
+
+    :param remove_unused: also remove the pseudopotentials that do not correspond to any `UpfData` in the profile
+    :return: a dict with the md5 of the `valid`, `corrupted` and `unused` pseudopotentials
+    """
+    from aiida_pseudo.data.pseudo import UpfData
+
+    directory = get_pseudo_cache_directory(computer)
+    if directory is None:
+        raise ValueError(f'the pseudo cache is not enabled for computer `{computer.label}`')
+
+    with computer.get_transport() as transport:
+        if not transport.isdir(directory):
+            files = {}
+        else:
+            _, stdout, _ = transport.exec_command_wait(f'cd {shlex.quote(directory)} && md5sum -- *.upf')
+            files = {}
+            for line in stdout.splitlines():
+                md5, _, filename = line.partition('  ')
+                files[filename] = md5
+
+        corrupted = sorted(filename[:-4] for filename, md5 in files.items() if filename != f'{md5}.upf')
+        valid = {md5 for filename, md5 in files.items() if filename == f'{md5}.upf'}
+        unused = []
+        if remove_unused:
+            known = set(orm.QueryBuilder().append(UpfData, project='attributes.md5').all(flat=True))
+            unused = sorted(valid.difference(known))
+            valid.difference_update(unused)
+
+        for md5 in corrupted + unused:
+            transport.remove(get_pseudo_cache_path(directory, md5))
+
+    computer.set_property(_PSEUDO_CACHE_PROPERTY, {'directory': directory, 'md5': sorted(valid)})
+    return {'valid': sorted(valid), 'corrupted': corrupted, 'unused': unused}
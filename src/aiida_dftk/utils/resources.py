@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""Utilities to estimate the resources of DFTK calculations."""
+import math
+import typing as ty
+
+import numpy as np
+from aiida import orm
+from aiida.common.constants import elements
+
+from .sysimage import get_startup_latency
+
+__all__ = (
+    'estimate_scf_restart',
+    'get_irreducible_kpoints_count',
+    'estimate_plane_waves',
+    'get_automatic_parallelization',
+    'estimate_fft_size',
+    'estimate_memory',
+)
+
+# Default SCF tolerance on the norm of the density change of DFTK `self_consistent_field`
+_DFTK_DEFAULT_SCF_TOL = 1e-6
+# Number of last SCF iterations used to measure the iteration cost and the convergence rate
+_CONVERGENCE_WINDOW = 10
+# Julia startup and package loading time assumed if it could not be measured
+_DEFAULT_STARTUP_TIME = 120.0
+# Bohr radius in Angstrom
+_BOHR_RADIUS = 0.529177210903
+# Minimal k-point parallel efficiency: fraction of MPI ranks busy with a k-point in the slowest round
+_MIN_KPOINT_PARALLEL_EFFICIENCY = 0.9
+# Number of plane waves per k-point below which an additional thread per MPI rank does not pay off
+_PLANE_WAVES_PER_THREAD = 2000
+# Memory of the Julia process after loading DFTK and AiidaDFTK, in bytes
+_JULIA_BASE_MEMORY = 2**30
+# Number of nonlocal projectors per atom assumed, e.g. two per s, p and d channel
+_PROJECTORS_PER_ATOM = 18
+# Number of blocks of the size of the wavefunctions of a k-point in the LOBPCG workspace
+_LOBPCG_BLOCKS = 9
+# Number of real-space arrays per spin component: densities, potentials and the history of the Anderson mixing
+_REAL_SPACE_ARRAYS = 30
+
+
+def estimate_scf_restart(
+    node: orm.CalcJobNode,
+    safety_factor: float = 1.5,
+    min_iterations: int = 5,
+    max_wallclock_seconds: ty.Optional[int] = None,
+) -> ty.Optional[dict]:
+    """Estimate the `maxiter` and `max_wallclock_seconds` needed to finish the SCF of a failed `DftkCalculation`.
+
+    The number of remaining iterations is extrapolated from the convergence rate of the norm of the density change
+    over the last SCF iterations, and the walltime from the measured cost per iteration.
+    If the SCF is not converging, as many iterations as in the failed calculation are requested again,
+    and at most twice as many if it converges very slowly.
+
+    :param node: a `DftkCalculation` with an `output_scf_trace`
+    :param safety_factor: factor applied to the number of remaining iterations
+    :param min_iterations: minimal `maxiter` of the restart
+    :param max_wallclock_seconds: upper bound on the estimated walltime
+    :return: a dict with the `maxiter` and `max_wallclock_seconds` of the restart, the `remaining_iterations`,
+        the `seconds_per_iteration` and the `convergence_rate` in decades of `norm_delta_rho` per iteration,
+        or `None` if the calculation has no usable SCF trace.
+    """
+    try:
+        trace = node.outputs.output_scf_trace
+    except AttributeError:
+        return None
+
+    norm_delta_rho = trace.get_array('norm_delta_rho')
+    wall_time = trace.get_array('wall_time')
+    converging = np.isfinite(norm_delta_rho) & (norm_delta_rho > 0)
+    if not converging.any():
+        return None
+
+    tol = node.inputs.parameters.get('scf', {}).get('$kwargs', {}).get('tol', _DFTK_DEFAULT_SCF_TOL)
+    log_norm = np.log10(norm_delta_rho[converging])[-_CONVERGENCE_WINDOW:]
+    convergence_rate = np.polyfit(np.arange(len(log_norm)), log_norm, 1)[0] if len(log_norm) > 1 else math.nan
+
+    if log_norm[-1] <= math.log10(tol):
+        remaining_iterations = 0
+    elif convergence_rate < 0:
+        # A nearly stagnating SCF extrapolates to absurd numbers of iterations
+        remaining_iterations = min(
+            math.ceil((math.log10(tol) - log_norm[-1]) / convergence_rate), 2 * len(norm_delta_rho)
+        )
+    else:
+        remaining_iterations = len(norm_delta_rho)
+    maxiter = max(min_iterations, math.ceil(safety_factor * remaining_iterations))
+
+    seconds_per_iteration = float(np.nanmedian(wall_time[-_CONVERGENCE_WINDOW:]))
+    if not np.isfinite(seconds_per_iteration) and 'output_timings' in node.outputs:
+        seconds_per_iteration = node.outputs.output_timings['scf_time'] / len(wall_time)
+    if not np.isfinite(seconds_per_iteration):
+        return None
+
+    # Time outside of the SCF: Julia startup, setup of the basis and post-SCF calculations
+    overhead = (get_startup_latency(node) or {}).get('startup_latency', _DEFAULT_STARTUP_TIME)
+    if 'output_timings' in node.outputs:
+        overhead += node.outputs.output_timings['total_time'] - node.outputs.output_timings['scf_time']
+
+    walltime = _get_max_wallclock_seconds(overhead, maxiter * seconds_per_iteration)
+    if max_wallclock_seconds is not None:
+        walltime = min(walltime, max_wallclock_seconds)
+
+    return {
+        'maxiter': maxiter,
+        'max_wallclock_seconds': int(walltime),
+        'remaining_iterations': remaining_iterations,
+        'seconds_per_iteration': seconds_per_iteration,
+        'convergence_rate': float(convergence_rate),
+    }
+
+
+def _get_max_wallclock_seconds(overhead: float, scf_time: float) -> int:
+    """Return the walltime of a job running an SCF of the given duration after the given overhead."""
+    from aiida_dftk.calculations import DftkCalculation
+
+    # Leave room for the margin `DftkCalculation` keeps between the SCF `maxtime` and the walltime
+    walltime = overhead + max(scf_time + DftkCalculation._MIN_OUTPUT_BUFFER_TIME, scf_time / 0.9)
+    # Round up to minutes, as schedulers do
+    return max(60 * math.ceil(walltime / 60), 2 * DftkCalculation._MIN_OUTPUT_BUFFER_TIME)
+
+
+def get_irreducible_kpoints_count(structure: orm.StructureData, kpoints: orm.KpointsData, symprec: float = 1e-5) -> int:
+    """Return the number of irreducible k-points of a k-point mesh, using the symmetries of the structure.
+
+    Time reversal symmetry is used, as DFTK does. For an explicit list of k-points, its length is returned.
+
+    :param structure: the structure, whose kinds with different names are considered different
+    :param kpoints: a k-point mesh or an explicit list of k-points
+    :param symprec: the tolerance of the symmetry search of spglib
+    """
+    import spglib
+
+    try:
+        mesh, offset = kpoints.get_kpoints_mesh()
+    except AttributeError:
+        return len(kpoints.get_kpoints())
+    if math.prod(mesh) == 1:
+        return 1
+
+    # Read the raw sites rather than `structure.sites`, which creates a `Site` object per atom
+    sites = structure.base.attributes.get('sites')
+    kind_names, numbers = np.unique([site['kind_name'] for site in sites], return_inverse=True)
+    cell = (
+        np.array(structure.cell),
+        np.array([site['position'] for site in sites], dtype=float) @ np.linalg.inv(np.array(structure.cell)),
+        numbers,
+    )
+    # spglib only supports the unshifted mesh and the shift by half a grid step
+    is_shift = [1 if abs(shift) > 1e-8 else 0 for shift in offset]
+    mapping, _ = spglib.get_ir_reciprocal_mesh(mesh, cell, is_shift=is_shift, symprec=symprec)
+    return len(np.unique(mapping))
+
+
+def estimate_plane_waves(structure: orm.StructureData, ecut: float) -> int:
+    """Estimate the number of plane waves per k-point of the basis of a structure.
+
+    This is the number of reciprocal lattice vectors in the sphere of kinetic energy `ecut`.
+
+    :param structure: the structure
+    :param ecut: the kinetic energy cutoff in Hartree, i.e. `basis_kwargs.Ecut` of the DFTK parameters
+    """
+    volume = structure.get_cell_volume() / _BOHR_RADIUS**3
+    return int(volume * (2 * ecut)**1.5 / (6 * math.pi**2))
+
+
+def get_automatic_parallelization(
+    nkpoints: int,
+    num_cores_per_machine: int,
+    max_num_machines: int = 1,
+    nplanewaves: ty.Optional[int] = None,
+) -> dict:
+    """Choose the MPI ranks and threads of a DFTK calculation on a computer.
+
+    DFTK distributes the k-points over the MPI ranks, which is efficient as long as all ranks get the same number
+    of k-points. The largest number of ranks that keeps the k-point parallel efficiency, i.e. the fraction of ranks
+    busy with a k-point on average, above 90% is used, filling as few machines as possible.
+    The remaining cores of the machines are used as threads of the ranks, as long as the basis is large enough.
+
+    :param nkpoints: the number of irreducible k-points, times two for collinear spin
+    :param num_cores_per_machine: the number of cores of a machine of the computer
+    :param max_num_machines: the maximal number of machines to use
+    :param nplanewaves: the estimated number of plane waves per k-point, if known
+    :return: a dict with the `num_machines`, `num_mpiprocs_per_machine` and `num_threads_per_mpiproc`,
+        and the `kpoint_parallel_efficiency`
+    """
+    max_num_ranks = max(1, min(nkpoints, num_cores_per_machine * max_num_machines))
+
+    def efficiency(num_ranks):
+        return nkpoints / (num_ranks * math.ceil(nkpoints / num_ranks))
+
+    def get_num_machines(num_ranks):
+        """Return the fewest machines the ranks can be spread evenly on, or `None`."""
+        for num_machines in range(math.ceil(num_ranks / num_cores_per_machine), max_num_machines + 1):
+            if num_ranks % num_machines == 0:
+                return num_machines
+        return None
+
+    # A single rank always qualifies
+    for num_ranks in range(max_num_ranks, 0, -1):
+        num_machines = get_num_machines(num_ranks)
+        if num_machines is not None and efficiency(num_ranks) >= _MIN_KPOINT_PARALLEL_EFFICIENCY:
+            break
+
+    num_mpiprocs_per_machine = num_ranks // num_machines
+    num_threads = max(1, num_cores_per_machine // num_mpiprocs_per_machine)
+    if nplanewaves is not None:
+        num_threads = max(1, min(num_threads, nplanewaves // _PLANE_WAVES_PER_THREAD))
+
+    return {
+        'num_machines': num_machines,
+        'num_mpiprocs_per_machine': num_mpiprocs_per_machine,
+        'num_threads_per_mpiproc': num_threads,
+        'kpoint_parallel_efficiency': efficiency(num_ranks),
+    }
+
+
+def _next_fft_size(size: int) -> int:
+    """Return the smallest integer not smaller than `size` whose only prime factors are 2, 3 and 5."""
+    while True:
+        remainder = size
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return size
+        size += 1
+
+
+def estimate_fft_size(structure: orm.StructureData, ecut: float, supersampling: float = 2) -> list:
+    """Estimate the size of the FFT grid of the basis of a structure, as chosen by DFTK.
+
+    :param structure: the structure
+    :param ecut: the kinetic energy cutoff in Hartree, i.e. `basis_kwargs.Ecut` of the DFTK parameters
+    :param supersampling: the supersampling of the density with respect to the wavefunctions
+    """
+    gmax = supersampling * math.sqrt(2 * ecut)
+    lengths = np.linalg.norm(np.array(structure.cell), axis=1) / _BOHR_RADIUS
+    return [_next_fft_size(2 * math.ceil(gmax * length / (2 * math.pi)) + 1) for length in lengths]
+
+
+def estimate_memory(
+    structure: orm.StructureData,
+    pseudos: dict,
+    parameters: dict,
+    kpoints: orm.KpointsData,
+    num_mpiprocs: int = 1,
+) -> ty.Optional[dict]:
+    """Estimate the size and the peak memory per MPI rank of a DFTK calculation.
+
+    The memory is dominated by the wavefunctions and nonlocal projectors of the k-points of a rank, the LOBPCG
+    workspace of the k-point being diagonalized and the real-space arrays of the densities, potentials and mixing.
+    The number of bands follows the defaults of DFTK, with extra bands for metals.
+
+    :param structure: the structure
+    :param pseudos: the pseudopotentials per kind, used for the number of valence electrons
+    :param parameters: the DFTK input parameters
+    :param kpoints: a k-point mesh or an explicit list of k-points
+    :param num_mpiprocs: the total number of MPI ranks, over which the k-points are distributed
+    :return: a dict with the `nkpoints`, i.e. the irreducible k-points times the spin components, the
+        `nkpoints_per_mpiproc`, the `nplanewaves` per k-point, the `fft_size`, the `nbands` and the
+        `memory_per_mpiproc` in bytes, or `None` if `Ecut` is not set.
+    """
+    ecut = parameters.get('basis_kwargs', {}).get('Ecut', None)
+    if ecut is None:
+        return None
+
+    model_kwargs = parameters.get('model_kwargs', {})
+    collinear = model_kwargs.get('spin_polarization') == ':collinear' or 'magnetic_moments' in model_kwargs
+    nspin = 2 if collinear else 1
+    nkpoints = nspin * get_irreducible_kpoints_count(structure, kpoints)
+    nkpoints_per_mpiproc = math.ceil(nkpoints / max(1, num_mpiprocs))
+    nplanewaves = estimate_plane_waves(structure, ecut)
+    fft_size = estimate_fft_size(structure, ecut)
+
+    # Without a valence charge, all electrons of the element are counted
+    atomic_numbers = {element['symbol']: number for number, element in elements.items()}
+    valence = {}
+    for kind in structure.kinds:
+        z_valence = getattr(pseudos[kind.name], 'z_valence', None)
+        valence[kind.name] = z_valence if z_valence is not None else atomic_numbers.get(kind.symbol, 0)
+    sites = structure.base.attributes.get('sites')
+    kind_names, counts = np.unique([site['kind_name'] for site in sites], return_counts=True)
+    nelectrons = sum(valence[name] * int(count) for name, count in zip(kind_names, counts))
+    nbands = math.ceil(nelectrons / (1 if collinear else 2))
+    if model_kwargs.get('temperature', 0):
+        nbands = max(nbands + 4, math.ceil(1.2 * nbands))
+    nbands += max(3, math.ceil(0.1 * nbands))
+
+    wavefunction_bytes = 16 * nbands * nplanewaves
+    memory = (
+        _JULIA_BASE_MEMORY
+        # Wavefunctions and the guess of the next SCF step for the k-points of the rank
+        + 2 * nkpoints_per_mpiproc * wavefunction_bytes
+        + nkpoints_per_mpiproc * 16 * _PROJECTORS_PER_ATOM * len(sites) * nplanewaves
+        + _LOBPCG_BLOCKS * wavefunction_bytes
+        + _REAL_SPACE_ARRAYS * nspin * 8 * math.prod(fft_size)
+    )
+
+    return {
+        'nkpoints': nkpoints,
+        'nkpoints_per_mpiproc': nkpoints_per_mpiproc,
+        'nplanewaves': nplanewaves,
+        'fft_size': fft_size,
+        'nbands': nbands,
+        'memory_per_mpiproc': int(memory),
+    }
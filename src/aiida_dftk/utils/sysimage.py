@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Registry of the Julia sysimages built for AiidaDFTK, and startup latency reporting."""
+import json
+import statistics
+import typing as ty
+
+from aiida import orm
+
+from .timings import parse_timings
+
+__all__ = (
+    'register_sysimage',
+    'unregister_sysimage',
+    'get_sysimage',
+    'is_version_allowed',
+    'get_startup_latency',
+    'compare_startup_latency',
+)
+
+# Extra of the `Code` mapping AiidaDFTK versions to the sysimage built for them
+_SYSIMAGE_REGISTRY_EXTRA = 'aiida_dftk_sysimages'
+# Extra of a `DftkCalculation` recording the sysimage it was run with
+SYSIMAGE_USED_EXTRA = 'aiida_dftk_sysimage'
+
+LOAD_TIME_PRINT = 'AiidaDFTK load time (s): '
+RUN_TIME_PRINT = 'AiidaDFTK run time (s): '
+
+
+def _parse_version(version: str) -> ty.Tuple[int, int, int]:
+    """Parse a version such as `0.2.1` or `0.2` into a tuple of three integers."""
+    parts = [int(part) for part in version.strip().split('+')[0].split('-')[0].split('.')]
+    return tuple((parts + [0, 0, 0])[:3])
+
+
+def is_version_allowed(version: str, version_spec: str) -> bool:
+    """Return whether a version satisfies a Julia version spec, such as the `allowed_versions` of AiidaDFTK.
+
+    The spec is a comma-separated list of versions, which are interpreted as caret specifiers, as by Julia's `Pkg`:
+    `0.2.0` allows the versions from `0.2.0` up to, but excluding, `0.3.0`.
+
+    :param version: the version, e.g. `0.2.1`
+    :param version_spec: the version spec, e.g. `0.2.0`
+    """
+    try:
+        version = _parse_version(version)
+    except ValueError:
+        return False
+    for spec in version_spec.split(','):
+        lower = _parse_version(spec)
+        # The first non-zero component of the spec must match, as must all components before it
+        significant = next((index for index, part in enumerate(lower) if part != 0), 2)
+        if version >= lower and version[:significant + 1] == lower[:significant + 1]:
+            return True
+    return False
+
+
+def register_sysimage(code: orm.AbstractCode, version: str, path: str) -> None:
+    """Register a sysimage of the given AiidaDFTK version on the computer of the code.
+
+    :param code: the Julia code the sysimage was built with
+    :param version: the version of AiidaDFTK contained in the sysimage
+    :param path: the absolute path of the sysimage on the computer of the code
+    """
+    registry = code.base.extras.get(_SYSIMAGE_REGISTRY_EXTRA, {})
+    registry[version] = path
+    code.base.extras.set(_SYSIMAGE_REGISTRY_EXTRA, registry)
+
+
+def unregister_sysimage(code: orm.AbstractCode, version: ty.Optional[str] = None, path: ty.Optional[str] = None) -> None:
+    """Remove sysimages from the registry of the code, for example after updating packages or deleting the sysimage.
+
+    :param code: the Julia code the sysimages were built with
+    :param version: remove only the sysimage of this AiidaDFTK version
+    :param path: remove only the sysimages with this path
+    :note: without `version` and `path`, all the sysimages of the code are removed.
+    """
+    registry = code.base.extras.get(_SYSIMAGE_REGISTRY_EXTRA, {})
+    registry = {
+        key: value for key, value in registry.items()
+        if (version is not None and key != version) or (path is not None and value != path)
+    }
+    code.base.extras.set(_SYSIMAGE_REGISTRY_EXTRA, registry)
+
+
+def get_sysimage(code: orm.AbstractCode, version_spec: str) -> ty.Optional[str]:
+    """Return the path of the sysimage of the most recent AiidaDFTK version allowed by the spec, or `None`."""
+    registry = code.base.extras.get(_SYSIMAGE_REGISTRY_EXTRA, {})
+    # Entries of older plugin versions were keyed by the version spec, with a dict value
+    versions = [
+        version for version, path in registry.items()
+        if isinstance(path, str) and is_version_allowed(version, version_spec)
+    ]
+    if not versions:
+        return None
+    return registry[max(versions, key=_parse_version)]
+
+
+def get_startup_latency(node: orm.CalcJobNode) -> ty.Optional[dict]:
+    """Return the startup latency of a finished `DftkCalculation`.
+
+    The latency is the time spent by Julia outside of the sections timed by DFTK in `timings.json`:
+    loading AiidaDFTK, and just-in-time compilation of the code around the timed sections.
+    Compilation inside the timed sections is not separable and shows up in `timed_time` instead.
+
+    :param node: a finished `DftkCalculation` node
+    :return: a dict with the `load_time`, `run_time`, `timed_time` and `startup_latency` in seconds,
+        or `None` if the times could not be recovered from the retrieved files.
+    """
+    from aiida_dftk.calculations import DftkCalculation
+
+    try:
+        retrieved = node.outputs.retrieved
+        stdout = retrieved.base.repository.get_object_content(node.get_option('scheduler_stdout'))
+        # The timings file is not in the retrieved folder if the outputs were retrieved as a single archive
+        if 'output_timings' in node.outputs:
+            timed_time = node.outputs.output_timings['total_time']
+        else:
+            timings = json.loads(retrieved.base.repository.get_object_content(DftkCalculation.TIMINGS_FILENAME))
+            timed_time = parse_timings(timings)['total_time']
+    except (AttributeError, FileNotFoundError, TypeError, ValueError):
+        return None
+
+    times = {}
+    for line in stdout.splitlines():
+        for key, prefix in (('load_time', LOAD_TIME_PRINT), ('run_time', RUN_TIME_PRINT)):
+            # Each MPI rank prints the times, keep the first one
+            if line.startswith(prefix) and key not in times:
+                times[key] = float(line[len(prefix):])
+    if len(times) != 2:
+        return None
+
+    times['timed_time'] = timed_time
+    times['startup_latency'] = times['load_time'] + max(times['run_time'] - times['timed_time'], 0.0)
+    return times
+
+
+def compare_startup_latency(nodes: ty.Iterable[orm.CalcJobNode]) -> dict:
+    """Compare the startup latency of calculations run with and without a sysimage.
+
+    :param nodes: finished `DftkCalculation` nodes, for example the nodes of a group
+    :return: a dict with keys `with_sysimage` and `without_sysimage`, each containing the number of calculations
+        and the mean and median of their times as returned by `get_startup_latency`.
+    """
+    latencies = {'with_sysimage': [], 'without_sysimage': []}
+    for node in nodes:
+        times = get_startup_latency(node)
+        if times is None:
+            continue
+        key = 'with_sysimage' if node.base.extras.get(SYSIMAGE_USED_EXTRA, None) else 'without_sysimage'
+        latencies[key].append(times)
+
+    report = {}
+    for key, values in latencies.items():
+        report[key] = {'count': len(values)}
+        for name in ('load_time', 'run_time', 'timed_time', 'startup_latency'):
+            if values:
+                report[key][f'mean_{name}'] = statistics.mean(times[name] for times in values)
+                report[key][f'median_{name}'] = statistics.median(times[name] for times in values)
+    return report
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Utilities to analyse the `timings.json` written by AiidaDFTK."""
+import re
+import typing as ty
+
+__all__ = ('parse_timings',)
+
+# Phases promoted to the top level of the parsed timings, with the regex matching the names of their DFTK timers
+_PHASES = {
+    'scf': re.compile(r'^self_consistent_field$'),
+    'hamiltonian': re.compile(r'Hamiltonian multiplication'),
+    'diagonalization': re.compile(r'^(LOBPCG|diagonalize.*)$'),
+    'fft': re.compile(r'^i?fft!?$'),
+}
+
+
+def _convert_timer(timer: dict) -> dict:
+    """Convert a TimerOutputs timer dict into a lighter hierarchy with times in seconds."""
+    converted = {
+        'time': timer.get('time_ns', 0) * 1e-9,
+        'ncalls': timer.get('n_calls', 0),
+    }
+    if 'allocated_bytes' in timer:
+        converted['allocated_bytes'] = timer['allocated_bytes']
+    if timer.get('inner_timers'):
+        converted['children'] = {name: _convert_timer(child) for name, child in timer['inner_timers'].items()}
+    return converted
+
+
+def _accumulate_phase(timers: dict, pattern: ty.Pattern) -> ty.Tuple[float, int]:
+    """Return the total time and number of calls of the timers matching the pattern.
+
+    Matching timers are not searched for nested matches, to avoid counting the same time twice.
+    """
+    time, ncalls = 0.0, 0
+    for name, timer in timers.items():
+        if pattern.search(name):
+            time += timer['time']
+            ncalls += timer['ncalls']
+        else:
+            child_time, child_ncalls = _accumulate_phase(timer.get('children', {}), pattern)
+            time += child_time
+            ncalls += child_ncalls
+    return time, ncalls
+
+
+def parse_timings(timings: dict) -> dict:
+    """Parse the content of a `timings.json` file written by AiidaDFTK.
+
+    :param timings: the dict representation of the DFTK `TimerOutput`
+    :return: a dict with the hierarchical breakdown of the timers under `timers`, and for each phase of the
+        calculation (`scf`, `hamiltonian`, `diagonalization`, `fft` and `postscf`) its total time in seconds and number
+        of calls as `<phase>_time` and `<phase>_ncalls`. The `postscf` phase only counts the top-level timers of the
+        supported postscf functions. The `total_time` is the sum of all top-level timers.
+    """
+    timers = {name: _convert_timer(timer) for name, timer in timings.get('inner_timers', {}).items()}
+
+    from aiida_dftk.calculations import DftkCalculation
+
+    result = {'total_time': sum(timer['time'] for timer in timers.values())}
+    for phase, pattern in _PHASES.items():
+        result[f'{phase}_time'], result[f'{phase}_ncalls'] = _accumulate_phase(timers, pattern)
+
+    # Only the top-level timers are the postscf steps: DFTK uses `compute_*` timers inside the SCF too
+    postscf = [timers[name] for name in DftkCalculation._SUPPORTED_POSTSCF if name in timers]
+    result['postscf_time'] = sum(timer['time'] for timer in postscf)
+    result['postscf_ncalls'] = sum(timer['ncalls'] for timer in postscf)
+    result['timers'] = timers
+
+    return result
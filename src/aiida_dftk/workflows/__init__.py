@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Workchains."""
 
+from .bands import DftkBandsWorkChain
 from .base import DftkBaseWorkChain
 
-__all__ = ('DftkBaseWorkChain',)
+__all__ = ('DftkBandsWorkChain', 'DftkBaseWorkChain')
@@ -1,15 +1,14 @@
 """DFTK bands WorkChain implementation."""
 
-from aiida.engine import WorkChain, ToContext, if_
+from aiida.engine import WorkChain, ToContext, append_, if_
 from aiida.orm import BandsData
 
 
 from aiida import orm
-from aiida.common import AttributeDict, exceptions
-from aiida.engine import BaseRestartWorkChain, ProcessHandlerReport, process_handler, while_
+from aiida.common import AttributeDict
 from aiida.plugins import CalculationFactory
 
-from aiida_dftk.utils import create_kpoints_from_distance, validate_and_prepare_pseudos_inputs, seekpath_structure_analysis
+from aiida_dftk.utils import merge_bands, seekpath_structure_analysis, split_kpoints
 
 from aiida_dftk.workflows.base import DftkBaseWorkChain
 
@@ -18,9 +17,16 @@ DftkCalculation = CalculationFactory('dftk')
 
 
 class DftkBandsWorkChain(WorkChain):
-    """ DFTK Bands Workchain to perform a DFT calculation. Validates parameters and restart."""
+    """ DFTK Bands Workchain to compute a band structure.
+
+    The bands are computed non self-consistently, starting from the checkpoint of an SCF calculation. The SCF is run
+    first, unless the `remote_folder` of an existing `DftkCalculation` is passed as `scf_parent_folder`.
+    """
 
     _process_class = DftkCalculation
+    # Minimal number of k-points per MPI rank of a BANDS calculation when splitting the k-point path automatically
+    _min_kpoints_per_rank = 4
+    _max_bands_chunks = 16
 
     @classmethod
     def define(cls, spec):
@@ -32,20 +38,30 @@ class DftkBandsWorkChain(WorkChain):
             help='Explicit kpoints to use for the BANDS calculation. Specify either this or `bands_kpoints_distance`.')
         spec.input('bands_kpoints_distance', valid_type=orm.Float, required=False,
             help='Minimum kpoints distance for the BANDS calculation. Specify either this or `bands_kpoints`.')
+        spec.input('scf_parent_folder', valid_type=orm.RemoteData, required=False,
+            help='The `remote_folder` of a finished `DftkCalculation` to compute the bands from. If not specified, the '
+                 'SCF is run first with the inputs of `dftk_base`.')
+        spec.input('bands_options', valid_type=orm.Dict, required=False,
+            help='The `metadata.options` of the BANDS calculation, e.g. its `resources` and `max_wallclock_seconds`. '
+                 'They are merged on top of the options of `dftk_base`.')
+        spec.input('bands_chunks', valid_type=orm.Int, required=False,
+            help='Number of chunks the k-point path is split into, each computed by a concurrent BANDS calculation. '
+                 'By default, it is chosen from the number of k-points and the resources of the BANDS calculations.')
         spec.expose_inputs(DftkBaseWorkChain, namespace='dftk_base')
 
         spec.outline(
             cls.setup,
-            # cls.validate_parameters,
-            # cls.validate_kpoints,
-            # cls.validate_pseudos,
-            # cls.validate_resources,
+            cls.validate_kpath,
+            cls.validate_scf_parent_folder,
             if_(cls.should_run_seekpath)(
                 cls.run_seekpath,
             ),
-            # cls.prepare_process,
-            cls.run_process,
-            # cls.inspect_process,
+            if_(cls.should_run_scf)(
+                cls.run_scf,
+                cls.inspect_scf,
+            ),
+            cls.run_bands,
+            cls.inspect_bands,
             cls.results,
         )
 
@@ -63,22 +79,40 @@ class DftkBandsWorkChain(WorkChain):
 
         spec.exit_code(301, 'ERROR_INVALID_INPUT_KPATH',
             message='Neither the `bands_kpoints` nor the `bands_kpoints_distance` input was specified, or both were specified.')
+        spec.exit_code(302, 'ERROR_INVALID_INPUT_SCF_PARENT_FOLDER',
+            message='The `scf_parent_folder` was not created by a `DftkCalculation` writing an SCF checkpoint.')
+        spec.exit_code(401, 'ERROR_SUB_PROCESS_FAILED_SCF',
+            message='The SCF DftkBaseWorkChain sub process failed.')
+        spec.exit_code(402, 'ERROR_SUB_PROCESS_FAILED_BANDS',
+            message='The BANDS DftkBaseWorkChain sub process failed.')
 
     def setup(self):
         """ create the inputs dictionary in `self.ctx.inputs`. """
 
         self.ctx.inputs = AttributeDict(self.exposed_inputs(DftkBaseWorkChain, 'dftk_base'))
+        self.ctx.scf_parent_folder = self.inputs.get('scf_parent_folder', None)
+        if 'bands_kpoints' in self.inputs:
+            self.ctx.bands_kpoints = self.inputs.bands_kpoints
 
     def validate_kpath(self):
         """Validate the inputs related to k-points.
-        Either an explicit `KpointsData` with given path, or a desired kpath distance should be specified. 
+        Either an explicit `KpointsData` with given path, or a desired kpath distance should be specified.
         """
 
         # if both specified or both not specified
         if ('bands_kpoints' in self.inputs) == ('bands_kpoints_distance' in self.inputs):  # Both are present or both are absent
-            return self.exit_codes['ERROR_INVALID_INPUT_KPOINTS']
+            return self.exit_codes.ERROR_INVALID_INPUT_KPATH
+
+    def validate_scf_parent_folder(self):
+        """Validate that the `scf_parent_folder`, if specified, contains the checkpoint of a `DftkCalculation`."""
+        if self.ctx.scf_parent_folder is None:
+            return None
+
+        creator = self.ctx.scf_parent_folder.creator
+        if (creator is None or creator.process_class is not DftkCalculation
+                or 'checkpointfile' not in creator.inputs.parameters.get('scf', {})):
+            return self.exit_codes.ERROR_INVALID_INPUT_SCF_PARENT_FOLDER
 
-        
     def should_run_seekpath(self):
         """Seekpath should only be run if the `bands_kpoints` input is not specified."""
         return 'bands_kpoints' not in self.inputs
@@ -101,41 +135,122 @@ class DftkBandsWorkChain(WorkChain):
         else:
             self.report('No seekpath parameters found')
 
-    def run_process(self):
+    def should_run_scf(self):
+        """The SCF should only be run if no `scf_parent_folder` was specified."""
+        return self.ctx.scf_parent_folder is None
+
+    def run_scf(self):
+        """Run the DftkBaseWorkChain to perform the SCF calculation, without computing the bands."""
+        inputs = AttributeDict(self.exposed_inputs(DftkBaseWorkChain, namespace='dftk_base'))
+        # Nested input namespaces are frozen, copy the namespace to update it
+        inputs.dftk = AttributeDict(inputs.dftk)
+        parameters = inputs.dftk.parameters.get_dict()
+        parameters['postscf'] = [
+            operation for operation in parameters.get('postscf', []) if operation.get('$function') != 'compute_bands'
+        ]
+        inputs.dftk.parameters = orm.Dict(dict=parameters)
+        inputs.metadata = {'call_link_label': 'scf'}
+
+        running = self.submit(DftkBaseWorkChain, **inputs)
+        self.report(f'Launching DftkBaseWorkChain<{running.pk}> for the SCF')
+        return ToContext(workchain_scf=running)
+
+    def inspect_scf(self):
+        """Verify that the SCF DftkBaseWorkChain finished successfully."""
+        workchain = self.ctx.workchain_scf
+        if not workchain.is_finished_ok:
+            self.report(f'SCF DftkBaseWorkChain<{workchain.pk}> failed with exit status {workchain.exit_status}')
+            return self.exit_codes.ERROR_SUB_PROCESS_FAILED_SCF
+
+        self.ctx.scf_parent_folder = workchain.outputs.remote_folder
+
+    def _get_bands_options(self):
+        """Return the `metadata.options` of the BANDS calculations."""
+        options = dict(self.inputs.dftk_base.dftk.get('metadata', {}).get('options', {}))
+        if 'bands_options' in self.inputs:
+            options.update(self.inputs.bands_options.get_dict())
+        return options
+
+    def _get_number_of_bands_chunks(self, nkpoints):
+        """Return the number of chunks the k-point path is split into.
+
+        Unless set by `bands_chunks`, the path is split such that each MPI rank of a BANDS calculation still gets at
+        least `_min_kpoints_per_rank` k-points, up to `_max_bands_chunks` concurrent calculations.
         """
-        Run the DftkBaseWorkChain to perform the DFT calculation.
-        Ensures 'compute_bands' is appropriately added or updated in 'postscf'.
+        if 'bands_chunks' in self.inputs:
+            return max(1, min(self.inputs.bands_chunks.value, nkpoints))
+
+        resources = self._get_bands_options().get('resources', {})
+        num_mpiprocs = resources.get('num_machines', 1) * resources.get('num_mpiprocs_per_machine', 1)
+        return max(1, min(self._max_bands_chunks, nkpoints // (self._min_kpoints_per_rank * num_mpiprocs)))
+
+    def _get_bands_inputs(self, kpoints):
+        """Return the inputs of a DftkBaseWorkChain computing the bands along the k-points from the SCF checkpoint.
+
+        The checkpoint is used through the `parent_folder` input, so the SCF restarts from the converged density.
+        It is copied rather than symlinked, since several BANDS calculations may restart from it concurrently.
+        Only `compute_bands` is run after the SCF, with the `bands_options` merged on top of the options.
         """
         inputs = AttributeDict(self.exposed_inputs(DftkBaseWorkChain, namespace='dftk_base'))
-        original_parameters = inputs.dftk.parameters.get_dict()
-        postscf_operations = original_parameters.get('postscf', [])
-
-        # Update or add 'compute_bands' in postscf operations
-        for operation in postscf_operations:
-            if operation.get('$function') == 'compute_bands':
-                operation['$kwargs'] = {'kpath': self.ctx.bands_kpoints.get_kpoints().tolist()}
-                break
+        inputs.dftk = AttributeDict(inputs.dftk)
+        scf_calculation = self.ctx.scf_parent_folder.creator
+
+        parameters = inputs.dftk.parameters.get_dict()
+        parameters.setdefault('scf', {})['checkpointfile'] = scf_calculation.inputs.parameters['scf']['checkpointfile']
+        parameters['postscf'] = [{'$function': 'compute_bands'}]
+        inputs.dftk.parameters = orm.Dict(dict=parameters)
+        inputs.dftk.bands_kpoints = kpoints
+        inputs.dftk.parent_folder = self.ctx.scf_parent_folder
+
+        inputs.dftk.metadata = AttributeDict(inputs.dftk.get('metadata', {}))
+        inputs.dftk.metadata.options = {**self._get_bands_options(), 'copy_parent_checkpoint': True}
+
+        return inputs
+
+    def run_bands(self):
+        """Run the DftkBaseWorkChains to compute the bands from the SCF checkpoint, one per chunk of the k-point path."""
+        number_of_chunks = self._get_number_of_bands_chunks(len(self.ctx.bands_kpoints.get_kpoints()))
+        if number_of_chunks == 1:
+            chunks = [self.ctx.bands_kpoints]
         else:
-            postscf_operations.append({
-                '$function': 'compute_bands',
-                '$kwargs': {'kpath': self.ctx.bands_kpoints.get_kpoints().tolist()}
-            })
-
-        # Update and submit with new parameters
-        new_parameters = dict(original_parameters, postscf=postscf_operations)
-        inputs.dftk.parameters = orm.Dict(dict=new_parameters)
-        running = self.submit(DftkBaseWorkChain, **inputs)
-        self.report(f'Launching DftkBaseWorkChain<{running.pk}>')
-        return ToContext(workchain_bands=running)
+            chunks = split_kpoints(
+                self.ctx.bands_kpoints, orm.Int(number_of_chunks), metadata={'call_link_label': 'split_kpoints'}
+            )
+            chunks = [chunks[f'chunk_{index}'] for index in range(number_of_chunks)]
+
+        for index, chunk in enumerate(chunks):
+            inputs = self._get_bands_inputs(chunk)
+            inputs.metadata = {'call_link_label': f'bands_{index}' if len(chunks) > 1 else 'bands'}
+
+            running = self.submit(DftkBaseWorkChain, **inputs)
+            self.report(f'Launching DftkBaseWorkChain<{running.pk}> for the BANDS of {len(chunk.get_kpoints())} k-points')
+            self.to_context(workchain_bands=append_(running))
+
+    def inspect_bands(self):
+        """Verify that the BANDS DftkBaseWorkChains finished successfully."""
+        for workchain in self.ctx.workchain_bands:
+            if not workchain.is_finished_ok:
+                self.report(f'BANDS DftkBaseWorkChain<{workchain.pk}> failed with exit status {workchain.exit_status}')
+                return self.exit_codes.ERROR_SUB_PROCESS_FAILED_BANDS
 
     def results(self):
-        """Attach the desired output nodes directly as outputs of the workchain."""
+        """Attach the desired output nodes directly as outputs of the workchain.
+
+        If the k-point path was split in chunks, the bands of the chunks are merged in a single band structure.
+        """
         self.report('workchain succesfully completed')
-        if 'output_parameters' in self.ctx.workchain_bands.outputs:
-            self.out('band_parameters', self.ctx.workchain_bands.outputs.output_parameters)
+        workchains = self.ctx.workchain_bands
+        if 'output_parameters' in workchains[0].outputs:
+            self.out('band_parameters', workchains[0].outputs.output_parameters)
         else:
             self.report('No output parameters found in workchain_bands.outputs')
-        if 'output_bands' in self.ctx.workchain_bands.outputs:
-            self.out('band_structure', self.ctx.workchain_bands.outputs.output_bands)
+
+        if not all('output_bands' in workchain.outputs for workchain in workchains):
+            self.report('No output bands found in workchain_bands.outputs')
+        elif len(workchains) == 1:
+            self.out('band_structure', workchains[0].outputs.output_bands)
         else:
-            self.report('No output bands found in workchain_bands.outputs')
\ No newline at end of file
+            bands = {f'chunk_{index}': workchain.outputs.output_bands for index, workchain in enumerate(workchains)}
+            self.out('band_structure', merge_bands(
+                self.ctx.bands_kpoints, **bands, metadata={'call_link_label': 'merge_bands'}
+            ))
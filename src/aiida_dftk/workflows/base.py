@@ -1,11 +1,33 @@
 # -*- coding: utf-8 -*-
 """Base DFTK WorkChain implementation."""
+import math
+
 from aiida import orm
 from aiida.common import AttributeDict, exceptions
 from aiida.engine import BaseRestartWorkChain, ProcessHandlerReport, process_handler, while_, if_, ToContext
 from aiida.plugins import CalculationFactory
 
-from aiida_dftk.utils import create_kpoints_from_distance, validate_and_prepare_pseudos_inputs
+from aiida_dftk.calculations import _AIIDA_DFTK_VERSION_SPEC
+from aiida_dftk.utils import (
+    PRECOMPILATION_FAILED,
+    PRECOMPILATION_SUCCEEDED,
+    acquire_precompilation_lock,
+    create_kpoints_from_distance,
+    estimate_plane_waves,
+    estimate_scf_restart,
+    get_automatic_parallelization,
+    get_irreducible_kpoints_count,
+    get_precompilation_state,
+    get_running_precompilation,
+    merge_scf_traces,
+    predict_walltime,
+    release_precompilation_lock,
+    set_precompilation_lock_process,
+    set_precompilation_state,
+    unregister_sysimage,
+    validate_and_prepare_pseudos_inputs,
+)
+from aiida_dftk.utils.sysimage import SYSIMAGE_USED_EXTRA
 
 DftkCalculation = CalculationFactory('dftk')
 PrecompileCalculation = CalculationFactory('dftk.precompile')
@@ -17,6 +39,15 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
     _process_class = DftkCalculation
 
     _attempted_precompilation_extra = "attempted_precompilation"
+    # Default damping of the DFTK SCF, and the factor it is reduced by when the SCF stagnates or diverges
+    _default_scf_damping = 0.8
+    _scf_damping_reduction = 0.5
+    # Upper bound of the walltime of restarts, which is estimated from the failed calculation
+    _max_restart_wallclock_seconds = 24 * 3600
+    # Default maximum number of iterations of the DFTK SCF
+    _default_scf_maxiter = 100
+    # Upper bound of the number of machines of restarts after running out of memory, without `automatic_parallelization`
+    _max_restart_num_machines = 8
 
     @classmethod
     def define(cls, spec):
@@ -35,6 +66,31 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
                    help='The minimum desired distance in 1/Å between k-points in reciprocal space. The explicit '
                         'k-point mesh will be generated automatically by a calculation function based on the input '
                         'structure.')
+        spec.input('scf_chunk_wallclock_seconds',
+                   valid_type=orm.Int,
+                   required=False,
+                   help='If set, the SCF is split into a chain of jobs of this walltime, each continuing from the '
+                        'checkpoint of the previous one, for example to fit in the backfill windows of the scheduler. '
+                        'The `max_wallclock_seconds` of the calculation is then the total walltime of the chain. '
+                        'Requires `scf.checkpointfile`, and `max_iterations` at least the number of jobs.')
+        spec.input('automatic_parallelization',
+                   valid_type=orm.Dict,
+                   required=False,
+                   help='If set, the resources of the calculations are chosen from the number of irreducible k-points '
+                        'and the estimated number of plane waves. Keys: `max_wallclock_seconds` (required without '
+                        '`cost_model`), `max_num_machines` (default 1) and `num_cores_per_machine` (default: the '
+                        'default number of MPI processes per machine of the computer).')
+        spec.input('cost_model',
+                   valid_type=orm.Dict,
+                   required=False,
+                   help='A cost model fitted with `aiida_dftk.utils.fit_cost_model`. If set, the '
+                        '`max_wallclock_seconds` of the calculations is predicted from their size.')
+        spec.input('low_memory_parameters',
+                   valid_type=orm.Dict,
+                   required=False,
+                   help='Parameters merged into the `parameters` of the calculations if they still run out of memory '
+                        'with the most machines and the fewest MPI ranks per machine, e.g. a diagonalization setting '
+                        'with fewer extra bands or a shorter mixing history.')
         spec.expose_inputs(DftkCalculation,
                            namespace='dftk',
                            exclude=('kpoints',))
@@ -45,6 +101,10 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
             cls.validate_pseudos,
             cls.validate_resources,
             while_(cls.should_run_process)(
+                if_(cls.should_wait_for_precompilation)(
+                    cls.wait_for_precompilation,
+                    cls.inspect_precompilation,
+                ),
                 cls.prepare_process,
                 cls.run_process,
                 if_(cls.should_attempt_precompilation)(
@@ -64,11 +124,18 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
         spec.exit_code(202, 'ERROR_INVALID_INPUT_KPOINTS',
             message='Neither the `kpoints` nor the `kpoints_distance` input was specified.')
         spec.exit_code(203, 'ERROR_INVALID_INPUT_RESOURCES',
-            message='Neither the `options` nor `automatic_parallelization` input was specified.')
+            message='The `automatic_parallelization` input is invalid, or the number of cores per machine is unknown.')
         spec.exit_code(204, 'ERROR_INVALID_INPUT_RESOURCES_UNDERSPECIFIED',
             message='The `metadata.options` did not specify both `resources.num_machines` and `max_wallclock_seconds`.')
+        spec.exit_code(205, 'ERROR_INVALID_INPUT_SCF_CHUNK',
+            message='`scf_chunk_wallclock_seconds` requires `scf.checkpointfile`, a walltime long enough for a chunk '
+                    'and `max_iterations` at least the number of chunks.')
         spec.exit_code(300, 'ERROR_PRECOMPILATION_FAILURE',
             message='Failed to precompile AiidaDFTK. Typically indicates an environment issue.')
+        spec.exit_code(301, 'ERROR_OUT_OF_MEMORY_UNRECOVERABLE',
+            message='The calculation ran out of memory with the largest resources and lowest memory settings allowed.')
+        spec.exit_code(302, 'ERROR_SCF_CHUNKS_EXHAUSTED',
+            message='The SCF did not converge within the {iterations} iterations of its {nchunks} chunks.')
 
     def setup(self):
         """Call the `setup` of the `BaseRestartWorkChain` and then create the inputs dictionary in `self.ctx.inputs`.
@@ -78,7 +145,15 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
         """
         super().setup()
         self.ctx.restart_calc = None
+        self.ctx.low_memory_parameters_applied = False
         self.ctx.inputs = AttributeDict(self.exposed_inputs(DftkCalculation, 'dftk'))
+        # Nested input namespaces are frozen, copy the options so that the handlers can update them
+        self.ctx.inputs.metadata = AttributeDict(self.ctx.inputs.get('metadata', {}))
+        self.ctx.inputs.metadata.options = AttributeDict(self.ctx.inputs.metadata.get('options', {}))
+        # Total number of SCF iterations allowed over a chain of chunks
+        self.ctx.scf_maxiter = self.ctx.inputs.parameters.get('scf', {}).get('$kwargs', {}).get(
+            'maxiter', self._default_scf_maxiter
+        )
 
     # TODO: We probably want to handle the kpoint distance on the Julia side instead.
     def validate_kpoints(self):
@@ -126,14 +201,95 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
         """Validate the inputs related to the resources.
 
         `metadata.options` should at least contain the options `resources` and `max_wallclock_seconds`,
-        where `resources` should define the `num_machines`.
+        where `resources` should define the `num_machines`. With `automatic_parallelization`, they are set first,
+        and with a `cost_model` the `max_wallclock_seconds` is predicted for the resources.
         """
+        if 'automatic_parallelization' in self.inputs:
+            exit_code = self._set_automatic_parallelization()
+            if exit_code is not None:
+                return exit_code
+
+        if 'cost_model' in self.inputs:
+            prediction = predict_walltime(self.inputs.cost_model, self.ctx.inputs)
+            if prediction is None:
+                self.report('cannot predict the walltime without `basis_kwargs.Ecut`, keeping `max_wallclock_seconds`')
+            else:
+                self.ctx.inputs.metadata.options.max_wallclock_seconds = prediction['max_wallclock_seconds']
+                self.report(
+                    f"cost model predicts {prediction['dftk_time']:.0f} s in DFTK, "
+                    f"setting `max_wallclock_seconds` to {prediction['max_wallclock_seconds']}"
+                )
+
         num_machines = self.ctx.inputs.metadata.options.get('resources', {}).get('num_machines', None)
         max_wallclock_seconds = self.ctx.inputs.metadata.options.get('max_wallclock_seconds', None)
 
         if num_machines is None or max_wallclock_seconds is None:
             return self.exit_codes.ERROR_INVALID_INPUT_RESOURCES_UNDERSPECIFIED  # pylint: disable=no-member
 
+        if 'scf_chunk_wallclock_seconds' in self.inputs:
+            chunk_wallclock_seconds = self.inputs.scf_chunk_wallclock_seconds.value
+            if ('checkpointfile' not in self.ctx.inputs.parameters.get('scf', {})
+                    or chunk_wallclock_seconds <= 2 * DftkCalculation._MIN_OUTPUT_BUFFER_TIME):
+                return self.exit_codes.ERROR_INVALID_INPUT_SCF_CHUNK  # pylint: disable=no-member
+            # The walltime of the calculation is the total walltime of the SCF, which sets the number of chunks
+            self.ctx.scf_max_chunks = math.ceil(max_wallclock_seconds / chunk_wallclock_seconds)
+            if self.ctx.scf_max_chunks > self.inputs.max_iterations.value:
+                self.report(
+                    f'{self.ctx.scf_max_chunks} chunks of {chunk_wallclock_seconds}s are needed for a total SCF '
+                    f'walltime of {max_wallclock_seconds}s, but `max_iterations` is {self.inputs.max_iterations.value}'
+                )
+                return self.exit_codes.ERROR_INVALID_INPUT_SCF_CHUNK  # pylint: disable=no-member
+            self.ctx.inputs.metadata.options.max_wallclock_seconds = min(chunk_wallclock_seconds, max_wallclock_seconds)
+
+
+    def _set_automatic_parallelization(self):
+        """Set the resources of the calculations from the `automatic_parallelization` input.
+
+        The MPI ranks distribute the irreducible k-points, counted twice for collinear spin, and the remaining cores
+        are used as Julia threads of the ranks. See `aiida_dftk.utils.get_automatic_parallelization`.
+        """
+        settings = self.inputs.automatic_parallelization.get_dict()
+        unknown = set(settings) - {'max_wallclock_seconds', 'max_num_machines', 'num_cores_per_machine'}
+        num_cores_per_machine = settings.get(
+            'num_cores_per_machine', self.ctx.inputs.code.computer.get_default_mpiprocs_per_machine()
+        )
+        if (
+            unknown or not num_cores_per_machine
+            or ('max_wallclock_seconds' not in settings and 'cost_model' not in self.inputs)
+        ):
+            self.report(f'invalid `automatic_parallelization` {settings}, or unknown number of cores per machine')
+            return self.exit_codes.ERROR_INVALID_INPUT_RESOURCES  # pylint: disable=no-member
+
+        structure = self.ctx.inputs.structure
+        parameters = self.ctx.inputs.parameters.get_dict()
+        model_kwargs = parameters.get('model_kwargs', {})
+        nspin = 2 if model_kwargs.get('spin_polarization') == ':collinear' or 'magnetic_moments' in model_kwargs else 1
+        nkpoints = nspin * get_irreducible_kpoints_count(structure, self.ctx.inputs.kpoints)
+        ecut = parameters.get('basis_kwargs', {}).get('Ecut', None)
+        nplanewaves = estimate_plane_waves(structure, ecut) if ecut is not None else None
+
+        parallelization = get_automatic_parallelization(
+            nkpoints, num_cores_per_machine, settings.get('max_num_machines', 1), nplanewaves
+        )
+        options = self.ctx.inputs.metadata.options
+        options.resources = {
+            'num_machines': parallelization['num_machines'],
+            'num_mpiprocs_per_machine': parallelization['num_mpiprocs_per_machine'],
+            'num_cores_per_mpiproc': parallelization['num_threads_per_mpiproc'],
+        }
+        options.withmpi = True
+        if 'max_wallclock_seconds' in settings:
+            options.max_wallclock_seconds = settings['max_wallclock_seconds']
+        options.environment_variables = {
+            **options.get('environment_variables', {}),
+            'JULIA_NUM_THREADS': str(parallelization['num_threads_per_mpiproc']),
+        }
+        self.report(
+            f"automatic parallelization for {nkpoints} k-points and ~{nplanewaves} plane waves: "
+            f"{parallelization['num_machines']} machine(s) with {parallelization['num_mpiprocs_per_machine']} MPI "
+            f"ranks of {parallelization['num_threads_per_mpiproc']} thread(s), "
+            f"k-point parallel efficiency {parallelization['kpoint_parallel_efficiency']:.0%}"
+        )
 
     def prepare_process(self):
         """Prepare the inputs for the next calculation.
@@ -147,6 +303,59 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
         if self.ctx.restart_calc:
             self.ctx.inputs.parent_folder = self.ctx.restart_calc.outputs.remote_folder
 
+    def _get_restart_chain(self, calculation):
+        """Return the calculations of this workchain the calculation was restarted from, oldest first, and itself."""
+        children = {child.pk for child in self.ctx.children}
+        chain = [calculation]
+        while 'parent_folder' in chain[0].inputs:
+            parent = chain[0].inputs.parent_folder.creator
+            if parent is None or parent.pk not in children:
+                break
+            chain.insert(0, parent)
+        return chain
+
+    def results(self):
+        """Attach the outputs of the last calculation.
+
+        If the SCF was run in chunks, the SCF traces of the chain of calculations are merged in `output_scf_trace`.
+        """
+        if 'scf_chunk_wallclock_seconds' not in self.inputs:
+            return super().results()
+
+        node = self.ctx.children[self.ctx.iteration - 1]
+        self.report(f'work chain completed after {self.ctx.iteration} iterations')
+
+        outputs = self.exposed_outputs(node, self._process_class)
+        traces = {
+            f'chunk_{index}': chunk.outputs.output_scf_trace
+            for index, chunk in enumerate(self._get_restart_chain(node)) if 'output_scf_trace' in chunk.outputs
+        }
+        if len(traces) > 1:
+            outputs['output_scf_trace'] = merge_scf_traces(**traces, metadata={'call_link_label': 'merge_scf_traces'})
+        self.out_many(outputs)
+        return None
+
+    def _set_restart_resources(self, calculation):
+        """Set the walltime and maxiter of the restart from the measured cost and convergence rate of the calculation.
+
+        :return: a description of the resources set, to be reported
+        """
+        max_wallclock_seconds = self.inputs.get('scf_chunk_wallclock_seconds', self._max_restart_wallclock_seconds)
+        estimate = estimate_scf_restart(calculation, max_wallclock_seconds=int(max_wallclock_seconds))
+        if estimate is None:
+            return 'keeping max_wallclock_seconds and maxiter since the SCF cost could not be measured'
+
+        self.ctx.inputs.metadata.options.max_wallclock_seconds = estimate['max_wallclock_seconds']
+        parameters = self.ctx.inputs.parameters.get_dict()
+        parameters.setdefault('scf', {}).setdefault('$kwargs', {})['maxiter'] = estimate['maxiter']
+        self.ctx.inputs.parameters = orm.Dict(parameters)
+
+        return (
+            f"set max_wallclock_seconds as {estimate['max_wallclock_seconds']}s, maxiter as {estimate['maxiter']} "
+            f"({estimate['seconds_per_iteration']:.3g}s per iteration, {estimate['remaining_iterations']} iterations "
+            'expected to converge)'
+        )
+
     def report_error_handled(self, calculation, action):
         """Report an action taken for a calculation that has failed.
 
@@ -158,6 +367,26 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
         self.report(f'{calculation.process_label}<{calculation.pk}> failed with exit status {calculation.exit_status}: {calculation.exit_message}')
         self.report(f'action taken: {action}')
 
+    def should_wait_for_precompilation(self):
+        """Return whether another workchain is currently precompiling AiidaDFTK with the same code.
+
+        In that case, the precompilation is awaited before running the calculation, to avoid failing the calculation.
+        When the code is known to be precompiled, the lookup is skipped entirely.
+        """
+        code = self.ctx.inputs.code
+        state = get_precompilation_state(code, _AIIDA_DFTK_VERSION_SPEC)
+        if state is not None and state['state'] == PRECOMPILATION_SUCCEEDED:
+            return False
+
+        self.ctx.precompile_job = get_running_precompilation(code, _AIIDA_DFTK_VERSION_SPEC)
+        return self.ctx.precompile_job is not None
+
+    def wait_for_precompilation(self):
+        """Wait for the precompilation launched by another workchain."""
+        running = self.ctx.precompile_job
+        self.report(f'waiting for {running.process_label}<{running.pk}> precompiling {running.inputs.code.full_label}')
+        return ToContext(precompile_job=running)
+
     def should_attempt_precompilation(self):
         if self.node.base.extras.get(self._attempted_precompilation_extra, False):
             return False
@@ -165,23 +394,63 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
         return node.exit_code == DftkCalculation.exit_codes.ERROR_PACKAGE_IMPORT_FAILED
 
     def run_precompilation(self):
+        """Precompile AiidaDFTK with the code of the last calculation, or wait for the result of an earlier attempt.
+
+        The outcome of the precompilation is recorded on the code, and a lock on the code makes sure that only one
+        workchain precompiles at a time: the others wait for its result instead of submitting their own.
+        """
         self.node.base.extras.set(self._attempted_precompilation_extra, True)
         calculation = self.ctx.children[self.ctx.iteration - 1]
-        self.report_error_handled(calculation, 'attempting to precompile')
+        code = calculation.inputs.code
+
+        running = get_running_precompilation(code, _AIIDA_DFTK_VERSION_SPEC)
+        if running is not None:
+            self.report_error_handled(calculation, f'waiting for {running.process_label}<{running.pk}> to precompile')
+            return ToContext(precompile_job=running)
+
+        state = get_precompilation_state(code, _AIIDA_DFTK_VERSION_SPEC)
+        if state is not None and state['state'] == PRECOMPILATION_FAILED:
+            # Do not precompile again in every workchain if the environment is known to be broken
+            self.ctx.precompile_job = orm.load_node(state['process'])
+            self.report_error_handled(calculation, f'precompilation already failed in <{self.ctx.precompile_job.pk}>')
+            return None
+
+        # The lock is taken before submitting, such that concurrent workchains never submit more than one precompilation
+        if not acquire_precompilation_lock(code, _AIIDA_DFTK_VERSION_SPEC, self.node):
+            running = get_running_precompilation(code, _AIIDA_DFTK_VERSION_SPEC)
+            if running is not None:
+                self.report_error_handled(calculation, f'waiting for {running.process_label}<{running.pk}> to precompile')
+                return ToContext(precompile_job=running)
+            # Either the lock was stale and has been released, or its holder has not submitted its precompilation yet
+            if not acquire_precompilation_lock(code, _AIIDA_DFTK_VERSION_SPEC, self.node):
+                self.ctx.precompile_job = None
+                self.report_error_handled(calculation, f'another workchain is precompiling {code.full_label}')
+                return None
 
+        self.report_error_handled(calculation, 'attempting to precompile')
         node = self.submit(PrecompileCalculation, inputs={
-            "code": calculation.inputs.code,
+            "code": code,
         })
+        set_precompilation_lock_process(code, _AIIDA_DFTK_VERSION_SPEC, self.node, node)
         self.report(f'launching {node.process_label}<{node.pk}>')
 
         return ToContext(precompile_job=node)
 
     def inspect_precompilation(self):
         calculation = self.ctx.precompile_job
+        if calculation is None:
+            self.report('restarting the calculation, which waits for the precompilation of the other workchain')
+            return None
+        code = calculation.inputs.code
+
+        state = PRECOMPILATION_SUCCEEDED if calculation.exit_status == 0 else PRECOMPILATION_FAILED
+        set_precompilation_state(code, _AIIDA_DFTK_VERSION_SPEC, state, calculation)
+        release_precompilation_lock(code, _AIIDA_DFTK_VERSION_SPEC, self.node)
 
         if calculation.exit_status != 0:
             self.report(f'{calculation.process_label}<{calculation.pk}> failed with exit status {calculation.exit_status}: {calculation.exit_message}')
             self.report(f'the issue can be diagnosed by running `verdi process report {calculation.pk}` and checking the logs.')
+            self.report(f'once fixed, run `aiida_dftk.utils.reset_precompilation_state` for {code.full_label}.')
             self.report('aborting workchain')
             return self.exit_codes.ERROR_PRECOMPILATION_FAILURE
 
@@ -205,11 +474,150 @@ class DftkBaseWorkChain(BaseRestartWorkChain):
             self.ctx.inputs.structure = calculation.outputs.output_structure
         except exceptions.NotExistent:
             self.ctx.restart_calc = calculation
-            self.ctx.inputs.metadata.options.max_wallclock_seconds = 3600
-            self.ctx.inputs.parameters['scf']['$kwargs']['maxiter'] = 100
-            self.report_error_handled(calculation, 'restart from the last calculation, set max_wallclock_seconds as 3600s, maxiter as 100')
+            if calculation.exit_status == DftkCalculation.exit_codes.ERROR_POSTSCF_OUT_OF_WALLTIME.status:
+                # The SCF converged, but the time the POSTSCF needs is unknown
+                max_wallclock_seconds = min(
+                    2 * calculation.get_option('max_wallclock_seconds'), self._max_restart_wallclock_seconds
+                )
+                self.ctx.inputs.metadata.options.max_wallclock_seconds = max_wallclock_seconds
+                self.report_error_handled(calculation, f'restart from the last calculation, set max_wallclock_seconds as {max_wallclock_seconds}s')
+            else:
+                self.report_error_handled(calculation, f'restart from the last calculation, {self._set_restart_resources(calculation)}')
         else:
             self.ctx.restart_calc = None
             self.report_error_handled(calculation, 'out of walltime: structure changed, so restarting from scratch')
 
         return ProcessHandlerReport(True)
+
+    @process_handler(priority=585, exit_codes=[
+        DftkCalculation.exit_codes.ERROR_SCF_CONVERGENCE_NOT_REACHED,
+        DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED,
+        ])
+    def handle_scf_chunk_finished(self, calculation):
+        """Handle the end of an SCF chunk if `scf_chunk_wallclock_seconds` is set: continue from its checkpoint.
+
+        The next chunk gets the iterations left of the total `maxiter` of the SCF. Once they or the chunks allowed by
+        the total walltime are exhausted, the workchain fails with `ERROR_SCF_CHUNKS_EXHAUSTED`.
+        """
+        if 'scf_chunk_wallclock_seconds' not in self.inputs:
+            return None
+
+        chain = self._get_restart_chain(calculation)
+        iterations = sum(
+            len(chunk.outputs.output_scf_trace.get_array('iteration'))
+            for chunk in chain if 'output_scf_trace' in chunk.outputs
+        )
+        if iterations >= self.ctx.scf_maxiter or len(chain) >= self.ctx.scf_max_chunks:
+            self.report_error_handled(calculation, f'SCF not converged after {iterations} iterations in {len(chain)} chunks: aborting')
+            exit_code = self.exit_codes.ERROR_SCF_CHUNKS_EXHAUSTED.format(iterations=iterations, nchunks=len(chain))  # pylint: disable=no-member
+            return ProcessHandlerReport(True, exit_code)
+
+        parameters = self.ctx.inputs.parameters.get_dict()
+        parameters.setdefault('scf', {}).setdefault('$kwargs', {})['maxiter'] = self.ctx.scf_maxiter - iterations
+        self.ctx.inputs.parameters = orm.Dict(parameters)
+        self.ctx.inputs.metadata.options.max_wallclock_seconds = self.inputs.scf_chunk_wallclock_seconds.value
+        self.ctx.restart_calc = calculation
+        self.report_error_handled(calculation, f'SCF chunk ended after {iterations} iterations in total: continue from the checkpoint')
+        return ProcessHandlerReport(True)
+
+    @process_handler(priority=570, exit_codes=[DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED])
+    def handle_scf_out_of_walltime_checkpointed(self, calculation):
+        """Handle `ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED` exit code: the SCF was killed, but can resume from its checkpoint."""
+        self.ctx.restart_calc = calculation
+        self.report_error_handled(calculation, f'out of walltime: restart from the last checkpoint, {self._set_restart_resources(calculation)}')
+        return ProcessHandlerReport(True)
+
+    @process_handler(priority=600, exit_codes=[DftkCalculation.exit_codes.ERROR_PSEUDO_CACHE_MISS])
+    def handle_pseudo_cache_miss(self, calculation):
+        """Handle `ERROR_PSEUDO_CACHE_MISS` exit code: the missing pseudopotentials are uploaded again on restart."""
+        self.report_error_handled(calculation, 'pseudopotentials missing from the remote cache: restart uploading them')
+        return ProcessHandlerReport(True)
+
+    @process_handler(priority=605, exit_codes=[DftkCalculation.exit_codes.ERROR_SYSIMAGE_MISSING])
+    def handle_sysimage_missing(self, calculation):
+        """Handle `ERROR_SYSIMAGE_MISSING` exit code: unregister the missing sysimage and restart without it."""
+        path = calculation.base.extras.get(SYSIMAGE_USED_EXTRA, None)
+        unregister_sysimage(calculation.inputs.code, path=path)
+        self.report_error_handled(calculation, f'sysimage `{path}` is missing: unregistered it, restart without it')
+        return ProcessHandlerReport(True)
+
+    @process_handler(priority=590, exit_codes=[DftkCalculation.exit_codes.ERROR_SCF_STOPPED_BY_MONITOR])
+    def handle_scf_stopped_by_monitor(self, calculation):
+        """Handle `ERROR_SCF_STOPPED_BY_MONITOR` exit code: restart with a smaller damping.
+
+        The SCF restarts from the last checkpoint if `scf.checkpointfile` is set, and from scratch otherwise.
+        """
+        parameters = self.ctx.inputs.parameters.get_dict()
+        scf_kwargs = parameters.setdefault('scf', {}).setdefault('$kwargs', {})
+        damping = scf_kwargs.get('damping', self._default_scf_damping) * self._scf_damping_reduction
+        scf_kwargs['damping'] = damping
+
+        self.ctx.inputs.parameters = orm.Dict(parameters)
+        if 'checkpointfile' in parameters['scf']:
+            self.ctx.restart_calc = calculation
+            self.report_error_handled(calculation, f'restart from the last checkpoint with damping {damping:.3g}')
+        else:
+            self.ctx.restart_calc = None
+            self.report_error_handled(calculation, f'restart from scratch with damping {damping:.3g}')
+        return ProcessHandlerReport(True)
+
+    @process_handler(priority=595, exit_codes=[
+        DftkCalculation.exit_codes.ERROR_OUT_OF_MEMORY,
+        DftkCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_MEMORY,
+        ])
+    def handle_out_of_memory(self, calculation):
+        """Handle `ERROR_OUT_OF_MEMORY` exit code: restart from scratch with more memory per MPI rank.
+
+        In turn, the MPI ranks are spread over twice as many machines, the machines are doubled to halve the k-points
+        of each rank, the MPI ranks per machine are halved and the `low_memory_parameters` are applied.
+        The cores left by the removed ranks are given to the remaining ones as threads.
+        """
+        options = self.ctx.inputs.metadata.options
+        resources = dict(options.resources)
+        num_machines = resources.get('num_machines', 1)
+        num_mpiprocs_per_machine = (
+            resources.get('num_mpiprocs_per_machine', None)
+            or calculation.computer.get_default_mpiprocs_per_machine() or 1
+        )
+        max_num_machines = self._max_restart_num_machines
+        if 'automatic_parallelization' in self.inputs:
+            max_num_machines = self.inputs.automatic_parallelization.get('max_num_machines', 1)
+        estimate = calculation.get_resource_estimate() or {}
+        nkpoints = estimate.get('nkpoints', 0)
+
+        self.ctx.restart_calc = None
+        if num_mpiprocs_per_machine > 1 and 2 * num_machines <= max_num_machines:
+            resources['num_machines'] = 2 * num_machines
+            self._halve_mpiprocs_per_machine(resources, num_mpiprocs_per_machine)
+            action = f"spread the MPI ranks over {resources['num_machines']} machines"
+        elif 2 * num_machines <= max_num_machines and 2 * num_machines * num_mpiprocs_per_machine <= nkpoints:
+            resources['num_machines'] = 2 * num_machines
+            action = f"distribute the {nkpoints} k-points over {resources['num_machines']} machines"
+        elif num_mpiprocs_per_machine > 1:
+            self._halve_mpiprocs_per_machine(resources, num_mpiprocs_per_machine)
+            action = f"use {resources['num_mpiprocs_per_machine']} MPI ranks per machine"
+        elif 'low_memory_parameters' in self.inputs and not self.ctx.low_memory_parameters_applied:
+            parameters = self.ctx.inputs.parameters.get_dict()
+            DftkCalculation._merge_dicts(parameters, self.inputs.low_memory_parameters.get_dict())
+            self.ctx.inputs.parameters = orm.Dict(parameters)
+            self.ctx.low_memory_parameters_applied = True
+            action = 'apply the `low_memory_parameters`'
+        else:
+            self.report_error_handled(calculation, 'no resources left to escalate to: abort')
+            return ProcessHandlerReport(True, self.exit_codes.ERROR_OUT_OF_MEMORY_UNRECOVERABLE)  # pylint: disable=no-member
+
+        options.resources = resources
+        self.report_error_handled(calculation, f'out of memory: restart from scratch and {action}')
+        return ProcessHandlerReport(True)
+
+    def _halve_mpiprocs_per_machine(self, resources, num_mpiprocs_per_machine):
+        """Halve the MPI ranks per machine in the resources, and double the threads per rank to use the freed cores."""
+        options = self.ctx.inputs.metadata.options
+        resources['num_mpiprocs_per_machine'] = num_mpiprocs_per_machine // 2
+        if 'num_cores_per_mpiproc' in resources:
+            resources['num_cores_per_mpiproc'] *= 2
+        num_threads = options.get('environment_variables', {}).get('JULIA_NUM_THREADS', None)
+        if num_threads is not None and num_threads.isdigit():
+            options.environment_variables = {
+                **options.environment_variables, 'JULIA_NUM_THREADS': str(2 * int(num_threads))
+            }
@@ -0,0 +1,651 @@
+def test_silicon_batch(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp, submit_and_await_success):
+    """
+    Tests that a batch of two silicon SCFs runs in a single job and produces the outputs of each item.
+    """
+    from aiida import orm
+    from aiida.plugins import CalculationFactory
+
+    builder = CalculationFactory('dftk.batch').get_builder()
+    builder.code = get_dftk_code()
+    builder.structures = {
+        'pristine': generate_structure("silicon"),
+        'perturbed': generate_structure("silicon_perturbed"),
+    }
+    builder.kpoints = generate_kpoints_mesh(3)
+    builder.pseudos.Si = load_psp("Si")
+
+    builder.parameters = orm.Dict({
+        "model_kwargs": {
+            "functionals": [":gga_x_pbe", ":gga_c_pbe"],
+            "temperature": 0.001,
+            "smearing": {
+                "$symbol": "Smearing.Gaussian"
+            }
+        },
+        "basis_kwargs": {
+            "Ecut": 10
+        },
+        "scf": {
+            "$function": "self_consistent_field",
+            "checkpointfile": "scfres.jld2",
+            "$kwargs": {
+                "tol": 1e-4,
+                "maxiter": 100
+            }
+        },
+        "postscf": [
+            {
+                "$function": "compute_forces_cart"
+            },
+        ]
+    })
+    builder.metadata.options.withmpi = False
+
+    result = submit_and_await_success(builder, timeout=600)
+
+    for label in ('pristine', 'perturbed'):
+        assert result.outputs.output_parameters[label].get_dict()["converged"]
+        assert result.outputs.output_forces[label].get_array().shape == (2, 3)
+
+
+def test_batch_input_generation(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp, tmp_path, monkeypatch):
+    """
+    Tests the input files of a batch: the default SCF time is split between the items, an explicit one is kept.
+    """
+    import json
+    import os
+    from aiida import orm
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory
+
+    # Dry runs write the submission folder to the working directory
+    monkeypatch.chdir(tmp_path)
+
+    builder = CalculationFactory('dftk.batch').get_builder()
+    builder.code = get_dftk_code()
+    builder.structures = {
+        'pristine': generate_structure("silicon"),
+        'perturbed': generate_structure("silicon_perturbed"),
+    }
+    builder.kpoints = generate_kpoints_mesh(3)
+    builder.pseudos.Si = load_psp("Si")
+    builder.parameters = orm.Dict({
+        "basis_kwargs": {"Ecut": 10},
+        "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2"},
+        "postscf": [],
+    })
+    builder.item_parameters = {'perturbed': orm.Dict({"scf": {"maxtime": 100}})}
+    builder.metadata.options.max_wallclock_seconds = 1800
+    builder.metadata.dry_run = True
+    builder.metadata.store_provenance = False
+
+    _, node = run_get_node(builder)
+    folder = node.dry_run_info['folder']
+
+    def read_input(label):
+        with open(os.path.join(folder, label, 'run_dftk.json'), encoding='utf-8') as handle:
+            return json.load(handle)
+
+    pristine = read_input('pristine')
+    assert pristine['scf']['maxtime'] == 0.9 * 1800 / 2
+    assert pristine['pseudopotentials']['Si'].startswith('../')
+    assert read_input('perturbed')['scf']['maxtime'] == 100
+    assert ('pristine/self_consistent_field.json', '.', 2) in [tuple(entry) for entry in node.get_retrieve_list()]
+
+    # The job script records the checkpoints written during the job, for the parser to know whether they can be resumed
+    assert ('pristine/aiida_dftk_checkpoint.txt', '.', 2) in [tuple(entry) for entry in node.get_retrieve_list()]
+    with open(os.path.join(folder, '_aiidasubmit.sh'), encoding='utf-8') as handle:
+        script = handle.read()
+    assert 'aiida_dftk_job_start=$(date +%s)' in script
+    assert 'stat -L -c %Y pristine/scfres.jld2 > pristine/aiida_dftk_checkpoint.txt' in script
+
+
+def test_sysimage_cmdline(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp, tmp_path, monkeypatch):
+    """
+    Tests that Julia is started with the sysimage registered for the code, unless `use_sysimage` is disabled.
+    """
+    import os
+    from aiida import orm
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory
+    from aiida_dftk.calculations import _AIIDA_DFTK_VERSION_SPEC
+    from aiida_dftk.utils import register_sysimage
+
+    # Dry runs write the submission folder to the working directory
+    monkeypatch.chdir(tmp_path)
+
+    code = get_dftk_code()
+    version = _AIIDA_DFTK_VERSION_SPEC.split(',')[0].strip()
+    register_sysimage(code, version, '/sysimages/aiidadftk.so')
+
+    def get_submit_script(use_sysimage):
+        builder = CalculationFactory('dftk').get_builder()
+        builder.code = code
+        builder.structure = generate_structure("silicon")
+        builder.kpoints = generate_kpoints_mesh(3)
+        builder.pseudos.Si = load_psp("Si")
+        builder.parameters = orm.Dict({
+            "basis_kwargs": {"Ecut": 10},
+            "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2"},
+            "postscf": [],
+        })
+        builder.metadata.options.use_sysimage = use_sysimage
+        builder.metadata.dry_run = True
+        builder.metadata.store_provenance = False
+        _, node = run_get_node(builder)
+        with open(os.path.join(node.dry_run_info['folder'], '_aiidasubmit.sh'), encoding='utf-8') as handle:
+            return handle.read()
+
+    assert "'--sysimage=/sysimages/aiidadftk.so'" in get_submit_script(True)
+    assert '--sysimage' not in get_submit_script(False)
+
+
+def test_prepare_for_submission_scaling(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp, tmp_path, monkeypatch):
+    """
+    Tests that the submission of silicon supercells of increasing size does not create an object per atom, and that
+    the input file grows linearly and compactly with the number of atoms.
+    """
+    import os
+    from aiida import orm
+    from aiida.engine import run_get_node
+    from aiida.orm.nodes.data.structure import Site
+    from aiida.plugins import CalculationFactory
+
+    # Dry runs write the submission folder to the working directory
+    monkeypatch.chdir(tmp_path)
+
+    # Count the `Site` objects, which `StructureData.sites` creates for every atom
+    sites_created = []
+    site_init = Site.__init__
+
+    def counting_site_init(self, *args, **kwargs):
+        sites_created.append(1)
+        site_init(self, *args, **kwargs)
+
+    monkeypatch.setattr(Site, '__init__', counting_site_init)
+
+    code = get_dftk_code()
+    pseudo = load_psp("Si")
+    primitive = generate_structure("silicon").get_ase()
+
+    sizes = {}
+    for repetitions in (4, 8, 16):
+        structure = orm.StructureData(ase=primitive.repeat(repetitions))
+        builder = CalculationFactory('dftk').get_builder()
+        builder.code = code
+        builder.structure = structure
+        builder.kpoints = generate_kpoints_mesh(1)
+        builder.pseudos.Si = pseudo
+        builder.parameters = orm.Dict({
+            "basis_kwargs": {"Ecut": 10},
+            "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2"},
+            "postscf": [],
+        })
+        builder.metadata.dry_run = True
+        builder.metadata.store_provenance = False
+
+        sites_created.clear()
+        _, node = run_get_node(builder)
+        natoms = len(structure.base.attributes.get('sites'))
+        sizes[natoms] = os.path.getsize(os.path.join(node.dry_run_info['folder'], 'run_dftk.json'))
+
+        assert not sites_created
+        # Large inputs are written compactly
+        assert sizes[natoms] / natoms < 100
+
+    # The input file grows linearly with the number of atoms
+    natoms = sorted(sizes)
+    per_atom = [(sizes[large] - sizes[small]) / (large - small) for small, large in zip(natoms, natoms[1:])]
+    assert max(per_atom) < 1.1 * min(per_atom)
+
+
+def test_parse_scf_out_of_walltime(get_dftk_code):
+    """
+    Tests that an SCF killed by the walltime can only be resumed if the job script recorded a fresh checkpoint.
+    """
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida_dftk.calculations import DftkCalculation
+    from aiida_dftk.parsers import DftkParser
+
+    log = """\
+[ Info: Imports succeeded
+n     Energy            log10(ΔE)   log10(Δρ)   Diag   Δtime
+---   ---------------   ---------   ---------   ----   ------
+  1   -7.921245648316                   -0.69    5.0    27.4s
+  2   -7.926109669767       -2.31       -1.22    1.0    11.2s
+"""
+
+    def parse(checkpointfile, files):
+        node = orm.CalcJobNode(computer=get_dftk_code().computer, process_type='aiida.calculations:dftk')
+        scf = {'$function': 'self_consistent_field'}
+        if checkpointfile:
+            scf['checkpointfile'] = 'scfres.jld2'
+        parameters = orm.Dict({'scf': scf}).store()
+        node.base.links.add_incoming(parameters, LinkType.INPUT_CALC, 'parameters')
+        node.set_exit_status(DftkCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status)
+        node.store()
+        retrieved = orm.FolderData()
+        for name, content in files.items():
+            retrieved.base.repository.put_object_from_bytes(content.encode(), name)
+        retrieved.base.links.add_incoming(node, LinkType.CREATE, 'retrieved')
+        retrieved.store()
+
+        parser = DftkParser(node)
+        return parser.parse(), parser.outputs
+
+    files = {DftkCalculation.LOGFILE: log, DftkCalculation.CHECKPOINT_STATFILE: '1760000000\n'}
+    exit_code, outputs = parse(True, files)
+    assert exit_code.status == DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED.status
+    assert list(outputs.output_scf_trace.get_array('iteration')) == [1, 2]
+
+    # No checkpoint was written since the start of the job, or none was requested
+    exit_code, _ = parse(True, {DftkCalculation.LOGFILE: log})
+    assert exit_code.status == DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME.status
+    exit_code, _ = parse(False, files)
+    assert exit_code.status == DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME.status
+
+
+def test_parse_batch_out_of_walltime(get_dftk_code, generate_structure):
+    """
+    Tests that a batch killed by the walltime reports whether the SCF of the interrupted item converged, and that
+    failed batches are not used as cache source.
+    """
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida_dftk.calculations import DftkBatchCalculation, DftkCalculation
+    from aiida_dftk.parsers import DftkBatchParser
+
+    log = """\
+[ Info: Imports succeeded
+n     Energy            log10(ΔE)   log10(Δρ)   Diag   Δtime
+---   ---------------   ---------   ---------   ----   ------
+  1   -7.921245648316                   -0.69    5.0    27.4s
+"""
+
+    def parse(files):
+        node = orm.CalcJobNode(computer=get_dftk_code().computer, process_type='aiida.calculations:dftk.batch')
+        parameters = orm.Dict({'scf': {'$function': 'self_consistent_field'}}).store()
+        node.base.links.add_incoming(parameters, LinkType.INPUT_CALC, 'parameters')
+        for label in ('a', 'b'):
+            node.base.links.add_incoming(generate_structure("silicon").store(), LinkType.INPUT_CALC, f'structures__{label}')
+        node.set_exit_status(DftkCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status)
+        node.store()
+        retrieved = orm.FolderData()
+        for name, content in files.items():
+            retrieved.base.repository.put_object_from_bytes(content.encode(), name)
+        retrieved.base.links.add_incoming(node, LinkType.CREATE, 'retrieved')
+        retrieved.store()
+        return DftkBatchParser(node).parse()
+
+    exit_code = parse({f'a/{DftkCalculation.LOGFILE}': log})
+    assert exit_code.status == DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME.status
+    exit_code = parse({f'a/{DftkCalculation.LOGFILE}': log, f'a/{DftkCalculation.SCFRES_SUMMARY_NAME}': '{}'})
+    assert exit_code.status == DftkCalculation.exit_codes.ERROR_POSTSCF_OUT_OF_WALLTIME.status
+
+    assert DftkBatchCalculation.exit_codes.ERROR_BATCH_ITEMS_FAILED.invalidates_cache
+
+
+def test_parse_output_eigenvalues(get_dftk_code, tmp_path):
+    """
+    Tests that the eigenvalues and occupations of the SCF summary are shaped (spin, k-point, band).
+    """
+    import json
+    import numpy as np
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida_dftk.parsers import DftkParser
+
+    nkpoints, nbands = 3, 4
+    for nspin in (1, 2):
+        eigenvalues = np.arange(nspin * nkpoints * nbands, dtype=float).reshape(nspin, nkpoints, nbands)
+        # DFTK lists the k-points of all spin components one spin after the other
+        with open(tmp_path / 'self_consistent_field.json', 'w', encoding='utf-8') as handle:
+            json.dump({
+                'energies': {'total': -8.0},
+                'converged': True,
+                'eigenvalues': eigenvalues.reshape(nspin * nkpoints, nbands).tolist(),
+                'occupation': (eigenvalues / 100).reshape(nspin * nkpoints, nbands).tolist(),
+                'kweights': [1 / nkpoints] * nkpoints,
+                'kcoords': np.zeros((nkpoints, 3)).tolist(),
+                'n_spin_components': nspin,
+                'n_kpoints': nkpoints,
+            }, handle)
+
+        node = orm.CalcJobNode(computer=get_dftk_code().computer, process_type='aiida.calculations:dftk').store()
+        retrieved = orm.FolderData()
+        retrieved.base.links.add_incoming(node, LinkType.CREATE, 'retrieved')
+        retrieved.store()
+        parser = DftkParser(node)
+        assert parser._parse_output_parameters(tmp_path / 'self_consistent_field.json') is None
+
+        output = parser.outputs.output_eigenvalues
+        np.testing.assert_array_equal(output.get_array('eigenvalues'), eigenvalues)
+        np.testing.assert_array_equal(output.get_array('occupations'), eigenvalues / 100)
+        assert output.get_array('kpoints').shape == (nkpoints, 3)
+        assert 'eigenvalues' not in parser.outputs.output_parameters.get_dict()
+
+
+def test_move_large_lists(get_dftk_code, tmp_path):
+    """
+    Tests that the long numeric lists of the SCF summary, also nested ones, are moved to `output_arrays`.
+    """
+    import json
+    import numpy as np
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida_dftk.parsers import DftkParser
+
+    data = {
+        'short': [1.0, 2.0],
+        'long': [1.0, 2.0, 3.0],
+        'strings': ['a', 'b', 'c'],
+        'ragged': [[1.0], [2.0, 3.0], [4.0]],
+        'nested': {'norm Δρ': [[1, 2], [3, 4]], 'short': [1]},
+    }
+    arrays = orm.ArrayData()
+    DftkParser._move_large_lists(data, arrays, max_list_size=2)
+
+    assert sorted(arrays.get_arraynames()) == ['long', 'nested__norm___']
+    assert data['long'] == {'array_output': 'output_arrays', 'array_name': 'long', 'shape': [3]}
+    assert data['nested']['norm Δρ'] == {'array_output': 'output_arrays', 'array_name': 'nested__norm___', 'shape': [2, 2]}
+    np.testing.assert_array_equal(arrays.get_array(data['nested']['norm Δρ']['array_name']), [[1, 2], [3, 4]])
+    assert data['short'] == [1.0, 2.0] and data['nested']['short'] == [1]
+    assert data['strings'] == ['a', 'b', 'c'] and data['ragged'] == [[1.0], [2.0, 3.0], [4.0]]
+
+    # The `max_parameters_list_size` option of the calculation is respected
+    with open(tmp_path / 'self_consistent_field.json', 'w', encoding='utf-8') as handle:
+        json.dump({'energies': {'total': -8.0}, 'converged': True, 'history': {'energy': [1.0, 2.0, 3.0]}}, handle)
+    for max_list_size, moved in ((2, True), (3, False)):
+        node = orm.CalcJobNode(computer=get_dftk_code().computer, process_type='aiida.calculations:dftk')
+        node.set_option('max_parameters_list_size', max_list_size)
+        node.store()
+        retrieved = orm.FolderData()
+        retrieved.base.links.add_incoming(node, LinkType.CREATE, 'retrieved')
+        retrieved.store()
+        parser = DftkParser(node)
+        parser._parse_output_parameters(tmp_path / 'self_consistent_field.json')
+
+        history = parser.outputs.output_parameters['history']['energy']
+        assert ('output_arrays' in parser.outputs) == moved
+        if moved:
+            assert history['array_name'] == 'history__energy'
+            np.testing.assert_array_equal(parser.outputs.output_arrays.get_array('history__energy'), [1.0, 2.0, 3.0])
+        else:
+            assert history == [1.0, 2.0, 3.0]
+
+
+def test_monitor_scf_convergence(get_dftk_code, tmp_path):
+    """
+    Tests that the monitor detects stagnating and diverging SCF runs, and only stops them once the checkpoint of the
+    last iteration is completely written.
+    """
+    import json
+    import os
+    import subprocess
+    import time
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida_dftk.calculations import DftkCalculation
+    from aiida_dftk.monitors import get_scf_stop_reason, monitor_scf_convergence
+
+    assert get_scf_stop_reason([10.0**-n for n in range(4)], 2, 0.9, 100.0) is None
+    assert get_scf_stop_reason([1e-1, 1e-2], 2, 0.9, 100.0) is None
+    assert get_scf_stop_reason([1e-1, 1e-2, 1e-2, 1e-2], 2, 0.9, 100.0).startswith('stagnating')
+    assert get_scf_stop_reason([1e-1, 1e-2, 1e-1, 1e1], 2, 0.9, 100.0).startswith('diverging')
+
+    class LocalTransport:
+        """Run the commands of the monitor on the local machine."""
+
+        def exec_command_wait(self, command):
+            process = subprocess.run(['bash', '-c', command], capture_output=True, text=True, check=False)
+            return process.returncode, process.stdout, process.stderr
+
+    rows = '\n'.join(f'  {n}   -7.9{n:02d}   -2.00   -1.00    1.0    1.00s' for n in range(1, 21))
+    (tmp_path / DftkCalculation.LOGFILE).write_text(
+        '[ Info: Imports succeeded\n'
+        'n     Energy            log10(ΔE)   log10(Δρ)   Diag   Δtime\n'
+        '---   ---------------   ---------   ---------   ----   ------\n'
+        f'{rows}\n'
+    )
+    checkpointfile = tmp_path / 'scfres.jld2'
+    checkpointfile.write_bytes(b'checkpoint')
+
+    node = orm.CalcJobNode(computer=get_dftk_code().computer, process_type='aiida.calculations:dftk')
+    parameters = orm.Dict({'scf': {'checkpointfile': 'scfres.jld2'}}).store()
+    node.base.links.add_incoming(parameters, LinkType.INPUT_CALC, 'parameters')
+    node.set_remote_workdir(str(tmp_path))
+    node.store()
+
+    def monitor():
+        return monitor_scf_convergence(node, LocalTransport(), window=10, settle_seconds=10)
+
+    stopfile = tmp_path / DftkCalculation.MONITOR_STOPFILE
+    now = time.time()
+    # The checkpoint of the last iteration is being written
+    os.utime(tmp_path / DftkCalculation.LOGFILE, (now - 5, now - 5))
+    os.utime(checkpointfile, (now, now))
+    assert monitor() is None
+    assert not stopfile.exists()
+    # The checkpoint of the last iteration is not written yet
+    os.utime(tmp_path / DftkCalculation.LOGFILE, (now - 5, now - 5))
+    os.utime(checkpointfile, (now - 60, now - 60))
+    assert monitor() is None
+    # The checkpoint of the last iteration is complete
+    os.utime(tmp_path / DftkCalculation.LOGFILE, (now - 60, now - 60))
+    os.utime(checkpointfile, (now - 30, now - 30))
+    result = monitor()
+    assert result is not None and not result.override_exit_code
+    assert json.loads(stopfile.read_text())['reason'].startswith('stagnating')
+
+
+def test_parse_output_forces_memory(aiida_profile, tmp_path):
+    """
+    Tests that a large forces file is copied into the output `ArrayData` without loading it fully in memory.
+    """
+    import tracemalloc
+    import h5py
+    import numpy as np
+    from aiida import orm
+    from aiida_dftk.parsers import DftkParser
+
+    # 96 MiB of forces
+    forces = np.random.default_rng(0).random((4 * 1024**2, 3))
+    with h5py.File(tmp_path / 'compute_forces_cart.hdf5', 'w') as h5file:
+        h5file['results'] = forces
+
+    node = orm.CalcJobNode()
+    node.set_process_type('aiida.calculations:dftk')
+    parser = DftkParser(node)
+
+    tracemalloc.start()
+    parser._parse_output_forces(tmp_path / 'compute_forces_cart.hdf5')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The copy goes through blocks of at most 16 MiB
+    assert peak < 32 * 1024**2
+    np.testing.assert_array_equal(parser.outputs.output_forces.get_array('output_forces'), forces)
+
+
+def test_parse_output_bands_formats(aiida_profile, tmp_path):
+    """
+    Tests that the binary and the JSON band output give the same band structure, and that the binary output is
+    parsed without going through Python objects for every eigenvalue.
+    """
+    import json
+    import tracemalloc
+    import h5py
+    import numpy as np
+    from aiida import orm
+    from aiida_dftk.parsers import DftkParser
+
+    nspin, nkpoints, nbands = 2, 1000, 200
+    rng = np.random.default_rng(0)
+    eigenvalues = rng.random((nspin, nkpoints, nbands))
+    kcoords = rng.random((nkpoints, 3))
+
+    with open(tmp_path / 'compute_bands.json', 'w', encoding='utf-8') as json_file:
+        json.dump({
+            'diagonalization': {'converged': True},
+            'kcoords': kcoords.tolist(),
+            'eigenvalues': eigenvalues.tolist(),
+            'n_spin_components': nspin,
+            'n_kpoints': nkpoints,
+            'n_bands': nbands,
+        }, json_file)
+    # Julia writes the arrays in column-major order, which reverses their axes in the file
+    with h5py.File(tmp_path / 'compute_bands.hdf5', 'w') as h5file:
+        h5file['diagonalization/converged'] = True
+        h5file['kcoords'] = kcoords.T
+        h5file['eigenvalues'] = eigenvalues.T
+        h5file['n_spin_components'] = nspin
+        h5file['n_kpoints'] = nkpoints
+        h5file['n_bands'] = nbands
+
+    peaks = {}
+    for file_name in ('compute_bands.json', 'compute_bands.hdf5'):
+        node = orm.CalcJobNode()
+        node.set_process_type('aiida.calculations:dftk')
+        parser = DftkParser(node)
+
+        tracemalloc.start()
+        assert parser._parse_output_bands(tmp_path / file_name) is None
+        _, peaks[file_name] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        np.testing.assert_array_equal(parser.outputs.output_bands.get_bands(), eigenvalues)
+        np.testing.assert_array_equal(parser.outputs.output_bands.get_kpoints(), kcoords)
+
+    # The binary output holds at most a few copies of the arrays in memory
+    assert peaks['compute_bands.hdf5'] < 4 * eigenvalues.nbytes + 4 * 1024**2
+    assert peaks['compute_bands.hdf5'] < peaks['compute_bands.json']
+
+
+def test_read_bands_hdf5_layout(tmp_path):
+    """
+    Tests that the binary band output is read in the layout written by Julia, also when the shapes of the arrays are
+    symmetric, with 3 k-points and as many spins as bands.
+    """
+    import h5py
+    import numpy as np
+    from aiida_dftk.parsers import DftkParser
+
+    nspin, nkpoints, nbands = 2, 3, 2
+    eigenvalues = np.arange(nspin * nkpoints * nbands, dtype=float).reshape(nspin, nkpoints, nbands)
+    kcoords = np.arange(nkpoints * 3, dtype=float).reshape(nkpoints, 3)
+
+    with h5py.File(tmp_path / 'compute_bands.hdf5', 'w') as h5file:
+        h5file['diagonalization/converged'] = True
+        h5file['kcoords'] = kcoords.T
+        h5file['eigenvalues'] = eigenvalues.T
+        h5file['n_spin_components'] = nspin
+        h5file['n_kpoints'] = nkpoints
+        h5file['n_bands'] = nbands
+
+    converged, kpath, bands = DftkParser._read_bands_hdf5(tmp_path / 'compute_bands.hdf5')
+    assert converged
+    np.testing.assert_array_equal(kpath, kcoords)
+    np.testing.assert_array_equal(bands, eigenvalues)
+
+
+def test_hash_ignores_runtime_settings(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp):
+    """
+    Tests that the hash of a DFTK calculation does not depend on its runtime options and parameters.
+    """
+    import copy
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida_dftk.nodes import DftkCalculationNode
+
+    code = get_dftk_code()
+    inputs = {
+        'code': code,
+        'structure': generate_structure("silicon").store(),
+        'kpoints': generate_kpoints_mesh(2).store(),
+        'pseudos__Si': load_psp("Si").store(),
+    }
+    parameters = {
+        "basis_kwargs": {"Ecut": 10},
+        "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2", "$kwargs": {"tol": 1e-6}},
+        "postscf": [],
+    }
+
+    def get_hash(parameters, **options):
+        node = DftkCalculationNode(computer=code.computer)
+        node.set_process_type('aiida.calculations:dftk')
+        for key, value in {'resources': {'num_machines': 1}, 'max_wallclock_seconds': 1800, **options}.items():
+            node.set_option(key, value)
+        for label, input_node in {**inputs, 'parameters': orm.Dict(parameters).store()}.items():
+            node.base.links.add_incoming(input_node, LinkType.INPUT_CALC, label)
+        node.store()
+        return node.base.caching.get_hash()
+
+    reference = get_hash(parameters)
+
+    runtime_parameters = copy.deepcopy(parameters)
+    runtime_parameters['scf']['maxtime'] = 100
+    runtime_parameters['scf']['$kwargs']['callback'] = {'$symbol': 'ScfDefaultCallback'}
+    assert get_hash(
+        runtime_parameters, resources={'num_machines': 4}, max_wallclock_seconds=7200,
+        environment_variables={'JULIA_NUM_THREADS': '4'},
+    ) == reference
+
+    # The environment can select another version of DFTK
+    for options in (
+        {'prepend_text': 'module load julia/1.11'},
+        {'environment_variables': {'JULIA_PROJECT': '/other/project'}},
+        {'custom_scheduler_commands': '#SBATCH --constraint=other'},
+        {'import_sys_environment': False},
+        {'use_sysimage': False},
+    ):
+        assert get_hash(parameters, **options) != reference, options
+
+    physical_parameters = copy.deepcopy(parameters)
+    physical_parameters['scf']['$kwargs']['tol'] = 1e-8
+    assert get_hash(physical_parameters) != reference
+
+    # Later calculations restart from the checkpoint in the remote folder
+    checkpoint_parameters = copy.deepcopy(parameters)
+    checkpoint_parameters['scf'].pop('checkpointfile')
+    assert get_hash(checkpoint_parameters) != reference
+    checkpoint_parameters['scf']['checkpointfile'] = 'other.jld2'
+    assert get_hash(checkpoint_parameters) != reference
+
+
+def test_memory_check(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp, tmp_path, monkeypatch):
+    """
+    Tests that the estimated memory is stored on the node, and that a submission that does not fit is refused.
+    """
+    import pytest
+    from aiida import orm
+    from aiida.common import exceptions
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory
+
+    # Dry runs write the submission folder to the working directory
+    monkeypatch.chdir(tmp_path)
+
+    builder = CalculationFactory('dftk').get_builder()
+    builder.code = get_dftk_code()
+    builder.structure = generate_structure("silicon")
+    builder.kpoints = generate_kpoints_mesh(4)
+    builder.pseudos.Si = load_psp("Si")
+    builder.parameters = orm.Dict({
+        "basis_kwargs": {"Ecut": 10},
+        "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2"},
+        "postscf": [],
+    })
+    builder.metadata.dry_run = True
+    builder.metadata.store_provenance = False
+
+    _, node = run_get_node(builder)
+    estimate = node.get_resource_estimate()
+    assert estimate['nkpoints'] == 8
+    assert estimate['nbands'] > 4
+    assert estimate['memory_per_machine'] == estimate['memory_per_mpiproc']
+
+    builder.metadata.options.max_memory_kb = 1024
+    builder.metadata.options.memory_check = 'error'
+    with pytest.raises(exceptions.InputValidationError):
+        run_get_node(builder)
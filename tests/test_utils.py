@@ -0,0 +1,217 @@
+def test_parse_dftk_log():
+    """
+    Tests that the SCF table is extracted from the log, including the first iteration without energy change.
+    """
+    import io
+    from aiida_dftk.utils import parse_dftk_log
+    from numpy.testing import assert_allclose
+
+    log = parse_dftk_log(io.StringIO("""\
+[ Info: Imports succeeded
+n     Energy            log10(ΔE)   log10(Δρ)   Diag   Δtime
+---   ---------------   ---------   ---------   ----   ------
+  1   -7.921245648316                   -0.69    5.0    27.4ms
+  2   -7.926109669767       -2.31       -1.22    1.0    1.20s
+
+[ Info: Finished successfully
+"""))
+
+    assert log['imports_succeeded']
+    assert log['finished_successfully']
+    assert log['trace']['iteration'] == [1, 2]
+    assert_allclose(log['trace']['energy'], [-7.921245648316, -7.926109669767])
+    assert_allclose(log['trace']['norm_delta_rho'], [10**-0.69, 10**-1.22])
+    assert_allclose(log['trace']['diagonalization_iterations'], [5.0, 1.0])
+    assert_allclose(log['trace']['wall_time'], [0.0274, 1.2])
+
+
+def test_get_automatic_parallelization():
+    """
+    Tests that the MPI ranks distribute the k-points evenly and the remaining cores are used as threads.
+    """
+    from aiida_dftk.utils import get_automatic_parallelization
+
+    parallelization = get_automatic_parallelization(100, 36, max_num_machines=4, nplanewaves=50000)
+    assert parallelization['num_machines'] * parallelization['num_mpiprocs_per_machine'] == 100
+    assert parallelization['kpoint_parallel_efficiency'] == 1.0
+
+    parallelization = get_automatic_parallelization(1, 16, nplanewaves=4000)
+    assert parallelization['num_mpiprocs_per_machine'] == 1
+    assert parallelization['num_threads_per_mpiproc'] == 2
+
+
+def test_cost_model(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp):
+    """
+    Tests that the cost model recovers the walltime of calculations whose time scales with their size.
+    """
+    import math
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida.plugins import CalculationFactory
+    from aiida_dftk.nodes import DftkCalculationNode
+    from aiida_dftk.utils import estimate_memory, fit_cost_model, predict_walltime
+
+    code = get_dftk_code()
+    structure = generate_structure("silicon").store()
+    pseudo = load_psp("Si").store()
+
+    def get_time(parameters, kpoints):
+        estimate = estimate_memory(structure, {'Si': pseudo}, parameters, kpoints)
+        return 1e-3 * estimate['nkpoints_per_mpiproc'] * estimate['nplanewaves']**1.5
+
+    nodes = []
+    for ecut in (10, 15, 20):
+        for npoints in (2, 3, 4):
+            parameters = {"basis_kwargs": {"Ecut": ecut}, "scf": {"$function": "self_consistent_field"}}
+            kpoints = generate_kpoints_mesh(npoints)
+            node = DftkCalculationNode(computer=code.computer)
+            node.set_process_type('aiida.calculations:dftk')
+            node.set_option('resources', {'num_machines': 1, 'num_mpiprocs_per_machine': 1})
+            inputs = {
+                'code': code, 'structure': structure, 'pseudos__Si': pseudo,
+                'kpoints': kpoints.store(), 'parameters': orm.Dict(parameters).store(),
+            }
+            for label, input_node in inputs.items():
+                node.base.links.add_incoming(input_node, LinkType.INPUT_CALC, label)
+            node.set_process_state('finished')
+            node.set_exit_status(0)
+            node.store()
+            timings = orm.Dict({'total_time': get_time(parameters, kpoints)})
+            timings.base.links.add_incoming(node, LinkType.CREATE, 'output_timings')
+            timings.store()
+            nodes.append(node)
+
+    model = fit_cost_model(nodes)
+    assert model['num_calculations'] == 9
+
+    builder = CalculationFactory('dftk').get_builder()
+    builder.code = code
+    builder.structure = structure
+    builder.pseudos.Si = pseudo
+    builder.kpoints = generate_kpoints_mesh(6)
+    builder.parameters = orm.Dict({"basis_kwargs": {"Ecut": 30}, "scf": {"$function": "self_consistent_field"}})
+    prediction = predict_walltime(model, builder)
+    assert math.isclose(prediction['dftk_time'], get_time(builder.parameters.get_dict(), builder.kpoints), rel_tol=0.1)
+    assert prediction['max_wallclock_seconds'] > prediction['dftk_time']
+
+
+def test_out_of_memory():
+    """
+    Tests that out-of-memory errors are detected, and that the peak memory is recovered from stdout or from SLURM.
+    """
+    from aiida_dftk.utils import is_out_of_memory, parse_peak_memory
+
+    assert is_out_of_memory('ERROR: LoadError: OutOfMemoryError()')
+    assert is_out_of_memory('slurmstepd: error: Detected 1 oom-kill event(s) in StepId=42.batch.')
+    assert not is_out_of_memory('[ Info: Finished successfully')
+
+    stdout = 'AiidaDFTK peak memory (bytes): 1000\nAiidaDFTK peak memory (bytes): 3000\n'
+    assert parse_peak_memory(stdout) == 3000
+    detailed_job_info = {'stdout': 'JobID|State|MaxRSS\n42|OUT_OF_MEMORY|\n42.batch|OUT_OF_MEMORY|2G\n'}
+    assert parse_peak_memory('', detailed_job_info) == 2 * 1024**3
+    assert parse_peak_memory('') is None
+
+
+def test_sysimage_registry(get_dftk_code):
+    """
+    Tests that sysimages are registered per AiidaDFTK version and looked up with the version spec of the plugin.
+    """
+    from aiida_dftk.utils import get_sysimage, is_version_allowed, register_sysimage, unregister_sysimage
+
+    assert is_version_allowed('0.2.5', '0.2.0')
+    assert not is_version_allowed('0.3.0', '0.2.0')
+    assert is_version_allowed('1.4.0', '1.2')
+    assert not is_version_allowed('0.0.4', '0.0.3')
+    assert not is_version_allowed('nightly', '0.2.0')
+
+    code = get_dftk_code()
+    assert get_sysimage(code, '0.2.0') is None
+
+    register_sysimage(code, '0.2.1', '/sysimages/0.2.1.so')
+    register_sysimage(code, '0.2.3', '/sysimages/0.2.3.so')
+    register_sysimage(code, '0.3.0', '/sysimages/0.3.0.so')
+    assert get_sysimage(code, '0.2.0') == '/sysimages/0.2.3.so'
+    assert get_sysimage(code, '0.3.0') == '/sysimages/0.3.0.so'
+    assert get_sysimage(code, '0.4.0') is None
+
+    unregister_sysimage(code, '0.2.3')
+    assert get_sysimage(code, '0.2.0') == '/sysimages/0.2.1.so'
+    unregister_sysimage(code, path='/sysimages/0.2.1.so')
+    assert get_sysimage(code, '0.2.0') is None
+    assert get_sysimage(code, '0.3.0') == '/sysimages/0.3.0.so'
+    unregister_sysimage(code)
+    assert get_sysimage(code, '0.3.0') is None
+
+
+def test_precompilation_lock(get_dftk_code):
+    """
+    Tests that the precompilation lock has a single owner, exposes the precompilation it submitted and is released
+    when its owner terminates.
+    """
+    from aiida import orm
+    from aiida_dftk.utils import (
+        PrecompilationLockGroup,
+        acquire_precompilation_lock,
+        get_running_precompilation,
+        release_precompilation_lock,
+        set_precompilation_lock_process,
+    )
+
+    code = get_dftk_code()
+    owner, other = orm.WorkflowNode().store(), orm.WorkflowNode().store()
+    for node in (owner, other):
+        node.set_process_state('running')
+
+    assert acquire_precompilation_lock(code, '0.2.0', owner)
+    assert not acquire_precompilation_lock(code, '0.2.0', other)
+    # The owner has not submitted its precompilation yet
+    assert get_running_precompilation(code, '0.2.0') is None
+
+    precompilation = orm.CalcJobNode(computer=code.computer)
+    precompilation.set_process_state('running')
+    precompilation.store()
+    set_precompilation_lock_process(code, '0.2.0', owner, precompilation)
+    assert get_running_precompilation(code, '0.2.0').uuid == precompilation.uuid
+
+    # The lock is not a group of the user
+    filters = {'label': {'like': 'aiida_dftk/precompilation_lock/%'}}
+    assert orm.QueryBuilder().append(orm.Group, filters={'type_string': 'core', **filters}).count() == 0
+    assert orm.QueryBuilder().append(PrecompilationLockGroup, filters=filters).count() == 1
+
+    release_precompilation_lock(code, '0.2.0', other)
+    assert get_running_precompilation(code, '0.2.0') is not None
+    release_precompilation_lock(code, '0.2.0', owner)
+    assert get_running_precompilation(code, '0.2.0') is None
+
+    # A lock whose owner terminated is stale
+    assert acquire_precompilation_lock(code, '0.2.0', other)
+    other.set_process_state('killed')
+    assert get_running_precompilation(code, '0.2.0') is None
+    assert acquire_precompilation_lock(code, '0.2.0', owner)
+
+
+def test_parse_timings():
+    """
+    Tests that the phases are accumulated over the hierarchy of timers, and the postscf only over top-level timers.
+    """
+    from aiida_dftk.utils import parse_timings
+
+    def timer(seconds, ncalls, **children):
+        return {'time_ns': int(seconds * 1e9), 'n_calls': ncalls, 'inner_timers': children}
+
+    timings = parse_timings({'inner_timers': {
+        'self_consistent_field': timer(
+            10.0, 1,
+            compute_density=timer(4.0, 20, fft=timer(1.0, 40)),
+            LOBPCG=timer(5.0, 20, **{'Hamiltonian multiplication': timer(3.0, 100, fft=timer(2.0, 200))}),
+        ),
+        'compute_forces_cart': timer(1.0, 1),
+    }})
+
+    assert timings['total_time'] == 11.0
+    assert (timings['scf_time'], timings['scf_ncalls']) == (10.0, 1)
+    assert (timings['diagonalization_time'], timings['diagonalization_ncalls']) == (5.0, 20)
+    assert (timings['hamiltonian_time'], timings['hamiltonian_ncalls']) == (3.0, 100)
+    assert (timings['fft_time'], timings['fft_ncalls']) == (3.0, 240)
+    assert (timings['postscf_time'], timings['postscf_ncalls']) == (1.0, 1)
+    assert timings['timers']['self_consistent_field']['children']['compute_density']['ncalls'] == 20
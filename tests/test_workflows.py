@@ -66,3 +66,179 @@ def test_silicon_workflow(get_dftk_code, generate_structure, generate_kpoints_me
     assert_allclose(output_parameters["energies"]["total"], _REFERENCE_ENERGY, rtol=1e-2)
     assert_allclose(result.outputs.output_forces.get_array(), _REFERENCE_FORCES, rtol=1e-2)
     assert_allclose(result.outputs.output_stresses.get_array(), _REFERENCE_STRESSES, rtol=1e-2)
+
+
+def test_scf_chunks(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp):
+    """
+    Tests that the SCF chunks share the total `maxiter`, that the workchain fails once they are exhausted, and that the
+    SCF traces of the chunks are merged.
+    """
+    import numpy as np
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida.engine.runners import Runner
+    from aiida_dftk.workflows.base import DftkBaseWorkChain, DftkCalculation
+
+    code = get_dftk_code()
+    builder = DftkBaseWorkChain.get_builder()
+    builder.dftk.code = code
+    builder.dftk.structure = generate_structure("silicon")
+    builder.dftk.pseudos.Si = load_psp("Si")
+    builder.kpoints = generate_kpoints_mesh(3)
+    builder.dftk.parameters = orm.Dict({
+        "basis_kwargs": {"Ecut": 10},
+        "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2", "$kwargs": {"maxiter": 10}},
+        "postscf": [],
+    })
+    builder.dftk.metadata.options.resources = {'num_machines': 1}
+    builder.dftk.metadata.options.max_wallclock_seconds = 3 * 3600
+    builder.scf_chunk_wallclock_seconds = orm.Int(3600)
+
+    def get_workchain(max_iterations):
+        builder.max_iterations = orm.Int(max_iterations)
+        workchain = DftkBaseWorkChain(inputs=dict(builder), runner=Runner(communicator=None))
+        workchain.setup()
+        workchain.validate_kpoints()
+        workchain.validate_pseudos()
+        return workchain
+
+    # Three chunks are needed for the total walltime
+    assert get_workchain(2).validate_resources() == DftkBaseWorkChain.exit_codes.ERROR_INVALID_INPUT_SCF_CHUNK
+    workchain = get_workchain(5)
+    assert workchain.validate_resources() is None
+    assert workchain.ctx.inputs.metadata.options.max_wallclock_seconds == 3600
+    workchain.ctx.children = []
+
+    def run_chunk(parent, energies):
+        node = orm.CalcJobNode(computer=code.computer, process_type='aiida.calculations:dftk')
+        if parent is not None:
+            node.base.links.add_incoming(parent.outputs.remote_folder, LinkType.INPUT_CALC, 'parent_folder')
+        node.set_process_state('finished')
+        node.set_exit_status(DftkCalculation.exit_codes.ERROR_SCF_OUT_OF_WALLTIME_CHECKPOINTED.status)
+        node.store()
+        trace = orm.ArrayData()
+        trace.set_array('iteration', np.arange(1, len(energies) + 1))
+        trace.set_array('energy', np.array(energies))
+        remote_folder = orm.RemoteData(computer=code.computer, remote_path='/tmp')
+        for output, label in ((trace, 'output_scf_trace'), (remote_folder, 'remote_folder')):
+            output.base.links.add_incoming(node, LinkType.CREATE, label)
+            output.store()
+        workchain.ctx.children.append(node)
+        workchain.ctx.iteration = len(workchain.ctx.children)
+        return node
+
+    def get_maxiter():
+        return workchain.ctx.inputs.parameters['scf']['$kwargs']['maxiter']
+
+    first = run_chunk(None, [-1.0, -2.0, -3.0, -4.0])
+    report = workchain.handle_scf_chunk_finished(first)
+    assert report.do_break and report.exit_code.status == 0
+    assert workchain.ctx.restart_calc.pk == first.pk
+    assert get_maxiter() == 6
+
+    second = run_chunk(first, [-5.0, -6.0, -7.0, -8.0])
+    assert workchain.handle_scf_chunk_finished(second).exit_code.status == 0
+    assert get_maxiter() == 2
+
+    # The iterations are exhausted: the other handlers must not restart the SCF
+    third = run_chunk(second, [-9.0, -10.0])
+    report = workchain.handle_scf_chunk_finished(third)
+    assert report.do_break
+    assert report.exit_code.status == DftkBaseWorkChain.exit_codes.ERROR_SCF_CHUNKS_EXHAUSTED.status
+
+    workchain.results()
+    merged = workchain.outputs['output_scf_trace']
+    np.testing.assert_array_equal(merged.get_array('iteration'), np.arange(1, 11))
+    np.testing.assert_array_equal(merged.get_array('energy'), -np.arange(1.0, 11.0))
+
+
+def test_scf_stopped_by_monitor(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp):
+    """
+    Tests that an SCF stopped by the monitor is restarted from its checkpoint with a smaller damping.
+    """
+    from aiida import orm
+    from aiida.engine.runners import Runner
+    from aiida_dftk.workflows.base import DftkBaseWorkChain, DftkCalculation
+
+    code = get_dftk_code()
+    builder = DftkBaseWorkChain.get_builder()
+    builder.dftk.code = code
+    builder.dftk.structure = generate_structure("silicon")
+    builder.dftk.pseudos.Si = load_psp("Si")
+    builder.kpoints = generate_kpoints_mesh(3)
+    builder.dftk.parameters = orm.Dict({
+        "basis_kwargs": {"Ecut": 10},
+        "scf": {"$function": "self_consistent_field", "checkpointfile": "scfres.jld2"},
+        "postscf": [],
+    })
+    builder.dftk.metadata.options.resources = {'num_machines': 1}
+    builder.dftk.metadata.options.max_wallclock_seconds = 3600
+
+    workchain = DftkBaseWorkChain(inputs=dict(builder), runner=Runner(communicator=None))
+    workchain.setup()
+
+    node = orm.CalcJobNode(computer=code.computer, process_type='aiida.calculations:dftk')
+    node.set_process_state('finished')
+    node.set_exit_status(DftkCalculation.exit_codes.ERROR_SCF_STOPPED_BY_MONITOR.status)
+    node.store()
+
+    for damping in (0.4, 0.2):
+        report = workchain.handle_scf_stopped_by_monitor(node)
+        assert report.do_break and report.exit_code.status == 0
+        assert workchain.ctx.restart_calc.pk == node.pk
+        assert workchain.ctx.inputs.parameters['scf']['$kwargs']['damping'] == damping
+
+
+def test_scf_stopped_by_monitor_without_checkpoint(get_dftk_code, generate_structure, generate_kpoints_mesh, load_psp):
+    """
+    Tests that an SCF without checkpoint stopped by the monitor is restarted from scratch with a smaller damping, and
+    that a restart from a `parent_folder` is refused without checkpoint.
+    """
+    import pytest
+    from aiida import orm
+    from aiida.common import exceptions
+    from aiida.engine import run_get_node
+    from aiida.engine.runners import Runner
+    from aiida_dftk.workflows.base import DftkBaseWorkChain, DftkCalculation
+
+    code = get_dftk_code()
+    builder = DftkBaseWorkChain.get_builder()
+    builder.dftk.code = code
+    builder.dftk.structure = generate_structure("silicon")
+    builder.dftk.pseudos.Si = load_psp("Si")
+    builder.kpoints = generate_kpoints_mesh(3)
+    builder.dftk.parameters = orm.Dict({
+        "basis_kwargs": {"Ecut": 10},
+        "scf": {"$function": "self_consistent_field"},
+        "postscf": [],
+    })
+    builder.dftk.metadata.options.resources = {'num_machines': 1}
+    builder.dftk.metadata.options.max_wallclock_seconds = 3600
+
+    workchain = DftkBaseWorkChain(inputs=dict(builder), runner=Runner(communicator=None))
+    workchain.setup()
+
+    node = orm.CalcJobNode(computer=code.computer, process_type='aiida.calculations:dftk')
+    node.set_process_state('finished')
+    node.set_exit_status(DftkCalculation.exit_codes.ERROR_SCF_STOPPED_BY_MONITOR.status)
+    node.store()
+
+    report = workchain.handle_scf_stopped_by_monitor(node)
+    assert report.do_break and report.exit_code.status == 0
+    assert workchain.ctx.restart_calc is None
+    assert workchain.ctx.inputs.parameters['scf']['$kwargs']['damping'] == 0.4
+    workchain.prepare_process()
+    assert 'parent_folder' not in workchain.ctx.inputs
+
+    calculation = DftkCalculation.get_builder()
+    calculation.code = code
+    calculation.structure = workchain.ctx.inputs.structure
+    calculation.pseudos = workchain.ctx.inputs.pseudos
+    calculation.kpoints = generate_kpoints_mesh(3)
+    calculation.parameters = workchain.ctx.inputs.parameters
+    calculation.parent_folder = orm.RemoteData(computer=code.computer, remote_path='/tmp')
+    calculation.metadata.options.resources = {'num_machines': 1}
+    calculation.metadata.dry_run = True
+    calculation.metadata.store_provenance = False
+    with pytest.raises(exceptions.InputValidationError, match='checkpointfile'):
+        run_get_node(calculation)